@@ -1,42 +1,111 @@
-import copy
-import random
-import numpy as np
+from contextlib import nullcontext
 
-from game import Game, states
+from game import Game, HIT, STAND
+from tables import Tables, TableViews, legal_mask
+from snapshot import SnapshotError, save_snapshot, load_snapshot, is_snapshot, read_text, write_text
+from traces import EligibilityTraces
 
-HIT = 0
-STAND = 1
 DISCOUNT = 0.95 #This is the gamma value for all value calculations
+EPSILON = 0.4   # The exploration rate of Q_run
+LAMBDA = 0.3    # The trace decay of TDLambda_run and QLambda_run
 
-class Agent:
-    def __init__(self):
 
-        # For MC values
-        self.MC_values = {} # Dictionary: Store the MC value of each state
-        self.S_MC = {}      # Dictionary: Store the sum of returns in each state
-        self.N_MC = {}      # Dictionary: Store the number of samples of each state
-        # MC_values should be equal to S_MC divided by N_MC on each state (important for passing tests)
+class AlphaSchedule:
+    """
+    Learning rate of the n-th update of a state, for TD and Q learning:
+        alpha(n) = (c / (c - 1 + n)) ** power
+    which is 1 on the first update and decays like n ** -power, or a constant rate. The
+    default c=10, power=1 is the 10/(9+n) the testers expect. It takes an int or a NumPy
+    array of them.
+    """
+    def __init__(self, c=10.0, power=1.0, constant=None):
+        if constant is not None and not 0 < constant <= 1:
+            raise ValueError(f"a constant learning rate must be in (0, 1], not {constant}")
+        if c < 1 or power <= 0:
+            raise ValueError(f"the learning rate needs c >= 1 and power > 0, not c={c}, power={power}")
+        self.c = c
+        self.power = power
+        self.constant = constant
 
-        # For TD values
-        self.TD_values = {}  # Dictionary storing the TD value of each state
-        self.N_TD = {}       # Dictionary: Store the number of samples of each state
+    def __call__(self, n):
+        if self.constant is not None:
+            return n * 0 + self.constant
+        if self.power == 1:
+            return self.c / (self.c - 1 + n)
+        return (self.c / (self.c - 1 + n)) ** self.power
 
-        # For Q-learning values
-        self.Q_values = {}   # Dictionary storing the Q-Learning value of each state and action
-        self.N_Q = {}        # Dictionary: Store the number of samples of each state
+    def to_dict(self):
+        if self.constant is not None:
+            return {"constant": self.constant}
+        return {"c": self.c, "power": self.power}
 
-        self.counter = 0
+    def __eq__(self, other):
+        return isinstance(other, AlphaSchedule) and self.to_dict() == other.to_dict()
 
-        # Initialization of the values
-        for s in states:
-            self.MC_values[s] = 0
-            self.S_MC[s] = 0
-            self.N_MC[s] = 0
-            self.TD_values[s] = 0
-            self.N_TD[s] = 0
-            self.Q_values[s] = [0,0] # First element is the Q value of "Hit", second element is the Q value of "Stand"
-            self.N_Q[s] = 0
-        self.simulator = Game()
+    def __repr__(self):
+        return "AlphaSchedule(" + ", ".join(f"{k}={v!r}" for k, v in self.to_dict().items()) + ")"
+
+    @staticmethod
+    def parse(text):
+        # An AlphaSchedule from "c=10,power=0.8" or "constant=0.05"
+        try:
+            return AlphaSchedule(**{key.strip(): float(value) for key, value in
+                                    (item.split("=") for item in text.split(",") if item.strip())})
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"bad learning rate {text!r}: {e}")
+
+
+ALPHA = AlphaSchedule()
+
+class Agent(TableViews):
+    # MC_values, S_MC, N_MC, TD_values, N_TD, Q_values and N_Q are dict-like views of
+    # self.tables, keyed by state tuples (see tables.py)
+
+    def __init__(self, game=None, rules=None, rng=None, discount=DISCOUNT, epsilon=EPSILON, alpha=ALPHA):
+        """
+        :param game:        the Game to learn from, e.g. Game(Shoe()) for a finite shoe
+        :param rules:       a rules.RuleSet for the default Game, when game is not given
+        :param rng:         the random stream for exploration (see rng.py), also used by the
+                            default Game; by default the one of the Game
+        :param discount:    the gamma of all value calculations
+        :param epsilon:     the exploration rate of Q_run
+        :param alpha:       the learning rate of TD_run and Q_run, a function of the number of
+                            updates of the state such as an AlphaSchedule
+        """
+        self.simulator = game if game is not None else Game(rules=rules, rng=rng)
+        self.rng = rng if rng is not None else self.simulator.rng
+        self.discount = discount
+        self.epsilon = epsilon
+        self.alpha = alpha
+        self.rules = self.simulator.rules
+        self.actions = self.simulator.actions
+
+        # All values are kept in arrays indexed by state index. MC_values should be equal to
+        # S_MC divided by N_MC on each state (important for passing tests)
+        self.tables = Tables(self.simulator.index, self.actions.num_actions)
+        self.index = self.tables.index
+        self.legal = self.actions.legal_table(self.index)  # Legal actions by state index
+        self.legal_mask = legal_mask(self.index, self.actions)
+        self.stats = None   # An instrument.Stats, see enable_stats
+
+    def enable_stats(self, stats=None):
+        """
+        Turn on instrumentation of this Agent and its Game (see instrument.py)
+
+        :param stats:   the instrument.Stats to collect into, by default a new one
+        :return:        the Stats
+        """
+        if stats is None:
+            from instrument import Stats
+            stats = Stats()
+        self.stats = self.simulator.stats = stats
+        return stats
+
+    def disable_stats(self):
+        self.stats = self.simulator.stats = None
+
+    def __timer(self, name):
+        return self.stats.timer(name) if self.stats is not None else nullcontext()
 
     # This is the policy for MC and TD learning.
     @staticmethod
@@ -49,23 +118,28 @@ class Agent:
         else:
             return 1
 
-    # This is the fixed learning rate for TD and Q learning.
-    @staticmethod
-    def alpha(n):
-        return 10.0/(9 + n)
-
-    def rewards_to_go(self, state, list):
-        reward = 0
-        isBreak = False
-        for i in list:
-            if i == state:
-                isBreak = True
-            if isBreak:
-                reward += np.power(DISCOUNT, self.counter) * i[1]
-                self.counter += 1
-        return reward
-    
-    def MC_run(self, num_simulation, tester=False):
+    def parameters(self):
+        # The learning parameters, as keyword arguments of Agent
+        return {"discount": self.discount, "epsilon": self.epsilon, "alpha": self.alpha}
+
+    def MC_run(self, num_simulation, tester=False, first_visit=False, source=None):
+        """
+        Monte Carlo evaluation of default_policy
+
+        :param num_simulation:  the number of episodes to simulate
+        :param first_visit:     only count the return of the first visit of a state in each
+                                episode, instead of every visit
+        :param source:          learn from the next num_simulation episodes of this iterator of
+                                logged episodes (see episodelog.py) instead of simulating
+        """
+        stats = self.stats
+        if source is not None:
+            for _, (states, actions, rewards) in zip(range(num_simulation), source):
+                self.MC_update_indices(states, rewards, first_visit)
+                if stats is not None:
+                    stats.end_episode("MC", len(states))
+            return
+
         # Perform num_simulation rounds of simulations in each cycle of the overall game loop
         for simulation in range(num_simulation):
             if tester:
@@ -73,13 +147,55 @@ class Agent:
             self.simulator.reset()  # Restart the simulator
 
             episode = self.simulator.simulate_sequence(self.default_policy)
-            for s in episode:
-                self.counter = 0
-                self.S_MC[s[0]] += self.rewards_to_go(s, episode)
-                self.N_MC[s[0]] += 1
-                self.MC_values[s[0]] = self.S_MC[s[0]] / self.N_MC[s[0]]
+            self.MC_update(episode, first_visit)
+            if stats is not None:
+                stats.end_episode("MC", len(episode))
+
+    def MC_update(self, episode, first_visit=False):
+        # Add the returns of one episode of (state, reward) pairs to S_MC and N_MC
+        encode = self.index.encode
+        self.MC_update_indices([encode(s) for s, _ in episode], [reward for _, reward in episode], first_visit)
+
+    def MC_update_indices(self, states, rewards, first_visit=False):
+        # Add the returns of one episode, given by state indices and rewards, to S_MC and N_MC
+        # in a single backward pass, accumulating the discounted return as G = r + discount * G
+        S_MC, SS_MC, N_MC, MC_values = self.tables.views("S_MC", "SS_MC", "N_MC", "MC_values")
+        discount = self.discount
+
+        if first_visit:
+            first = {}
+            for t, i in enumerate(states):
+                first.setdefault(i, t)
+
+        G = 0
+        for t in range(len(states) - 1, -1, -1):
+            i = states[t]
+            G = rewards[t] + discount * G
+            if first_visit and first[i] != t:
+                continue
+            S_MC[i] += G
+            SS_MC[i] += G * G
+            N_MC[i] += 1
+            MC_values[i] = S_MC[i] / N_MC[i]
+
+    def TD_run(self, num_simulation, tester=False, source=None):
+        # With source, learn from logged episodes instead of simulating, see MC_run
+        N_TD, TD_values = self.tables.views("N_TD", "TD_values")
+        encode = self.index.encode
+        alpha, discount = self.alpha, self.discount
+        stats = self.stats
+
+        if source is not None:
+            for _, (states, actions, rewards) in zip(range(num_simulation), source):
+                last = len(states) - 1
+                for t, i in enumerate(states):
+                    N_TD[i] += 1
+                    next_value = 0 if t == last else TD_values[states[t + 1]]
+                    TD_values[i] += alpha(N_TD[i])*(rewards[t] + discount*next_value - TD_values[i])
+                if stats is not None:
+                    stats.end_episode("TD", len(states))
+            return
 
-    def TD_run(self, num_simulation, tester=False):
         #Perform num_simulation rounds of simulations in each cycle of the overall game loop
         for simulation in range(num_simulation):
             # Do not modify the following three lines
@@ -91,16 +207,42 @@ class Agent:
             reward = self.simulator.check_reward()
 
             while s is not None:
-                self.N_TD[s] += 1
+                i = encode(s)
+                N_TD[i] += 1
                 next_s, hold = self.simulator.simulate_one_step(self.default_policy(s))
-                if next_s == None:
-                    self.TD_values[next_s] = 0
-                self.TD_values[s] += self.alpha(self.N_TD[s])*(reward
-                                                               + DISCOUNT*self.TD_values[next_s] - self.TD_values[s])
+                # The value after a terminal state is 0
+                next_value = 0 if next_s is None else TD_values[encode(next_s)]
+                TD_values[i] += alpha(N_TD[i])*(reward + discount*next_value - TD_values[i])
                 reward = hold
                 s = next_s
+            if stats is not None:
+                stats.end_episode("TD")
+
+    def Q_run(self, num_simulation, tester=False, source=None):
+        # With source, learn from the actions of logged episodes instead of exploring, see MC_run
+        N_Q, Q_values = self.tables.views("N_Q", "Q_values")
+        encode = self.index.encode
+        legal = self.legal
+        hit_or_stand = self.actions.num_actions == 2
+        alpha, discount, epsilon = self.alpha, self.discount, self.epsilon
+        stats = self.stats
+
+        if source is not None:
+            for _, (states, actions, rewards) in zip(range(num_simulation), source):
+                last = len(states) - 1
+                for t, i in enumerate(states):
+                    N_Q[i] += 1
+                    a = actions[t]
+                    if t == last:
+                        next_value = 0
+                    else:
+                        j = states[t + 1]
+                        next_value = max([Q_values[j, b] for b in legal[j]])
+                    Q_values[i, a] += alpha(N_Q[i])*(rewards[t] + discount*next_value - Q_values[i, a])
+                if stats is not None:
+                    stats.end_episode("Q", len(states))
+            return
 
-    def Q_run(self, num_simulation, tester=False):
         #Perform num_simulation rounds of simulations in each cycle of the overall game loop
         for simulation in range(num_simulation):
             if tester:
@@ -110,55 +252,187 @@ class Agent:
             s = self.simulator.state
             reward = self.simulator.check_reward()
             while s is not None:
-                self.N_Q[s] += 1
-                a = self.pick_action(s, 0.4)
+                i = encode(s)
+                N_Q[i] += 1
+                a = self.pick_action(s, epsilon)
+                next_s, hold = self.simulator.simulate_one_step(a)
+                # The Q values after a terminal state are 0
+                if next_s is None:
+                    next_value = 0
+                else:
+                    j = encode(next_s)
+                    if hit_or_stand:
+                        next_value = max(Q_values[j, HIT], Q_values[j, STAND])
+                    else:
+                        next_value = max([Q_values[j, b] for b in legal[j]])
+                Q_values[i, a] += alpha(N_Q[i])*(reward + discount*next_value - Q_values[i, a])
+                reward = hold
+                s = next_s
+            if stats is not None:
+                stats.end_episode("Q")
+
+    def TDLambda_run(self, num_simulation, lam=LAMBDA, replacing=False, tester=False):
+        """
+        TD(lambda) evaluation of default_policy with eligibility traces, into the TD values
+
+        Every step's TD error updates all the states of the episode so far, in proportion to
+        their traces, so a reward reaches the earlier states of its episode right away rather
+        than one step per visit. lam=0 gives the updates of TD_run.
+
+        :param lam:         the lambda of the traces, in [0, 1]
+        :param replacing:   replacing traces instead of accumulating ones (see traces.py)
+        """
+        N_TD, TD_values = self.tables.views("N_TD", "TD_values")
+        encode = self.index.encode
+        alpha, discount = self.alpha, self.discount
+        decay = discount * lam
+        traces = EligibilityTraces(replacing)
+        keys, values = traces.keys, traces.values
+        stats = self.stats
+
+        for simulation in range(num_simulation):
+            if tester:
+                self.tester_print(simulation, num_simulation, "TD(lambda)")
+            self.simulator.reset()
+            traces.clear()
+
+            s = self.simulator.state
+            reward = self.simulator.check_reward()
+            while s is not None:
+                i = encode(s)
+                N_TD[i] += 1
+                next_s, hold = self.simulator.simulate_one_step(self.default_policy(s))
+                next_value = 0 if next_s is None else TD_values[encode(next_s)]
+                delta = reward + discount*next_value - TD_values[i]
+                traces.visit(i)
+                for j, e in zip(keys, values):
+                    TD_values[j] += alpha(N_TD[j])*delta*e
+                traces.decay(decay)
+                reward = hold
+                s = next_s
+            if stats is not None:
+                stats.end_episode("TD")
+
+    def QLambda_run(self, num_simulation, lam=LAMBDA, replacing=False, tester=False):
+        """
+        Watkins' Q(lambda) with eligibility traces, into the Q values
+
+        Like Q_run, but the TD error of every step also updates the earlier state-action pairs
+        of the episode in proportion to their traces. The traces are cut after an exploratory
+        action, one whose Q value is below the best one of its state when it is picked, since
+        the returns after it no longer follow the greedy policy being learned. lam=0 gives the
+        updates of Q_run.
+
+        :param lam:         the lambda of the traces, in [0, 1]
+        :param replacing:   replacing traces instead of accumulating ones (see traces.py)
+        """
+        N_Q, Q_values = self.tables.views("N_Q", "Q_values")
+        encode = self.index.encode
+        legal = self.legal
+        alpha, discount, epsilon = self.alpha, self.discount, self.epsilon
+        decay = discount * lam
+        traces = EligibilityTraces(replacing)
+        keys, values = traces.keys, traces.values
+        stats = self.stats
+
+        for simulation in range(num_simulation):
+            if tester:
+                self.tester_print(simulation, num_simulation, "Q(lambda)")
+            self.simulator.reset()
+            traces.clear()
+
+            s = self.simulator.state
+            reward = self.simulator.check_reward()
+            while s is not None:
+                i = encode(s)
+                N_Q[i] += 1
+                a = self.pick_action(s, epsilon)
+                if Q_values[i, a] < Q_values[i, self.greedy_action(i)]:
+                    traces.clear()
                 next_s, hold = self.simulator.simulate_one_step(a)
-                if next_s == None:
-                    self.Q_values[next_s] = [0, 0]
-                self.Q_values[s][a] += self.alpha(self.N_Q[s])*(reward
-                                                                + DISCOUNT*max(self.Q_values[next_s][0], self.Q_values[next_s][1]) - self.Q_values[s][a])
+                if next_s is None:
+                    next_value = 0
+                else:
+                    j = encode(next_s)
+                    next_value = max([Q_values[j, b] for b in legal[j]])
+                delta = reward + discount*next_value - Q_values[i, a]
+                traces.visit((i, a))
+                for key, e in zip(keys, values):
+                    Q_values[key] += alpha(N_Q[key[0]])*delta*e
+                traces.decay(decay)
                 reward = hold
                 s = next_s
+            if stats is not None:
+                stats.end_episode("Q")
+
+    def parallel_run(self, algorithm, num_episodes, workers=2, sync_interval=10000, seed=0):
+        # Train with MC_run, TD_run or Q_run ("MC", "TD" or "Q") in several worker processes.
+        # See parallel.py for how the workers' results are merged
+        from parallel import parallel_run
+        parallel_run(self, algorithm, num_episodes, workers, sync_interval, seed)
+
+    def replay_run(self, algorithm, buffer, batch_size=256):
+        # Learn TD ("TD") or Q ("Q") values from the transitions of a replay.ReplayBuffer, in
+        # vectorized minibatches. See replay.py
+        from replay import replay
+        replay(self, algorithm, buffer, batch_size)
 
     def pick_action(self, s, epsilon):
-        if random.random() < epsilon:
-            return random.randint(0, 1)
+        i = self.index.encode(s)
+        legal = self.legal[i]
+        if self.rng.random() < epsilon:
+            return legal[self.rng.randint(0, len(legal) - 1)]
         else:
-            return np.argmax(self.Q_values[s])
+            return self.greedy_action(i)
+
+    def greedy_action(self, i):
+        # The legal action with the largest Q value in state index i, the first one on ties
+        Q = self.tables.Q_values[i]
+        return max(self.legal[i], key=Q.__getitem__)
 
     def autoplay_decision(self, state):
-        hitQ, standQ = self.Q_values[state][HIT], self.Q_values[state][STAND]
-        if hitQ > standQ:
-            return HIT
-        if standQ > hitQ:
-            return STAND
-        return HIT #Before Q-learning takes effect, just always HIT
-
-    def save(self, filename):
-        with open(filename, "w") as file:
-            for table in [self.MC_values, self.TD_values, self.Q_values, self.S_MC, self.N_MC, self.N_TD, self.N_Q]:
-                for key in table:
-                    key_str = str(key).replace(" ", "")
-                    entry_str = str(table[key]).replace(" ", "")
-                    file.write(f"{key_str} {entry_str}\n")
-                file.write("\n")
-
-    def load(self, filename):
-        with open(filename) as file:
-            text = file.read()
-            MC_values_text, TD_values_text, Q_values_text, S_MC_text, N_MC_text, NTD_text, NQ_text, _  = text.split("\n\n")
-            
-            def extract_key(key_str):
-                return tuple([int(x) for x in key_str[1:-1].split(",")])
-            
-            for table, text in zip(
-                [self.MC_values, self.TD_values, self.Q_values, self.S_MC, self.N_MC, self.N_TD, self.N_Q], 
-                [MC_values_text, TD_values_text, Q_values_text, S_MC_text, N_MC_text, NTD_text, NQ_text]
-            ):
-                for line in text.split("\n"):
-                    key_str, entry_str = line.split(" ")
-                    key = extract_key(key_str)
-                    table[key] = eval(entry_str)
+        # Before Q-learning takes effect, the Q values are all equal and this is always HIT
+        return self.greedy_action(self.index.encode(state))
+
+    def save(self, filename, meta=None):
+        # Write the tables to a binary snapshot (see snapshot.py)
+        with self.__timer("agent.save"):
+            save_snapshot(filename, self.tables, self.discount, meta)
+
+    def save_text(self, filename):
+        # Write the tables in the text format of earlier versions
+        write_text(filename, self.tables)
+
+    def load(self, filename, mmap_mode=None, check_discount=True):
+        """
+        Load the tables from a snapshot, or from a text file written by earlier versions
+
+        :param mmap_mode:       for snapshots, None to read the tables into memory, or a np.memmap
+                                mode ("r" read-only, "c" copy-on-write) to share them between processes
+        :param check_discount:  refuse a snapshot trained with another discount than this Agent's,
+                                since training on would mix the targets of both. Text files
+                                don't record their discount
+        :return:                the "meta" entry of the snapshot header ({} for text files)
+        """
+        with self.__timer("agent.load"):
+            if is_snapshot(filename):
+                tables, header = load_snapshot(filename, mmap_mode)
+                discount = header.get("discount")
+                if check_discount and discount is not None and discount != self.discount:
+                    raise SnapshotError(f"{filename} was trained with discount {discount}, the agent has "
+                                        f"{self.discount}; create the Agent with discount={discount} to use it")
+                meta = header["meta"]
+            else:
+                tables, meta = read_text(filename, self.simulator.index), {}
+        if tables.index.states != self.simulator.index.states:
+            raise SnapshotError(f"{filename} has a different state layout from the game: "
+                                f"true count range {tables.index.count_range}, phases {tables.index.phases}")
+        if tables.Q_values.shape[1] != self.actions.num_actions:
+            raise SnapshotError(f"{filename} has {tables.Q_values.shape[1]} actions, the game has "
+                                f"{self.actions.num_actions}")
+        self.tables = tables
+        self.index = self.tables.index
+        return meta
 
     @staticmethod
     def tester_print(i, n, name):
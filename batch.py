@@ -0,0 +1,185 @@
+import numpy as np
+
+from game import HIT, STAND, ActionSpace, WIN_STATE, LOSE_STATE, ranks, states, state_index, get_amt
+from rules import DEFAULT_RULES
+from dealer import dealer_table
+
+'''
+    Vectorized version of game.Game that plays many hands at once.
+
+    Every hand is a row in a set of NumPy arrays (user_sum, user_A, dealer_sum, dealer_A,
+    dealer_first, stand, done), and states are kept as state indices (see game.StateIndex).
+    Stands are resolved with one draw from the dealer.DealerTable of the rules rather than by
+    drawing the dealer's cards, so the dealer's final total has the same distribution as in
+    Game, but not the same cards.
+'''
+WIN = state_index.encode(WIN_STATE)
+LOSE = state_index.encode(LOSE_STATE)
+
+# Cards are drawn with replacement from game.cards, and every rank has the same number of
+# suits, so drawing a card is the same as drawing a rank uniformly.
+RANK_VALUES = np.array([get_amt((rank, None)) for rank in ranks], dtype=np.int64)
+
+# Most cards a hand can use: 4 dealt and at most 19 user hits (user_sum goes from 2 to 21)
+MAX_CARDS = 23
+
+
+def calculate_hands(card_sum, card_A):
+    # Vectorized Game.calculate_hand
+    A_active = ((card_A > 0) & (card_sum + 10 <= 21)).astype(np.int64)
+    return card_sum + A_active * 10, A_active
+
+
+def policy_table(policy):
+    """
+    Turn a policy into an action lookup array indexed by state index
+
+    :param policy:  either a function taking a state tuple (like Agent.default_policy),
+                    or an array that already holds one action per entry of game.states
+    :return:        an int array with one action per entry of game.states
+    """
+    if callable(policy):
+        table = [HIT if s in (WIN_STATE, LOSE_STATE) else policy(s) for s in states]
+        return np.array(table, dtype=np.int64)
+    table = np.asarray(policy, dtype=np.int64)
+    if table.shape != (len(states),):
+        raise ValueError(f"policy table must have {len(states)} entries, got shape {table.shape}")
+    return table
+
+
+class BatchGame:
+    def __init__(self, n, seed=None, crn=False, rules=None):
+        """
+        :param n:       the number of hands
+        :param seed:    seed of the NumPy generator
+        :param crn:     use common random numbers: every hand gets its own pre-drawn sequence of
+                        cards, so two runs with the same seed deal the same cards to the same hand
+                        whatever the policy does, which makes comparisons between policies much
+                        less noisy
+        :param rules:   a rules.RuleSet, by default rules.DEFAULT_RULES
+        """
+        self.n = n
+        self.rng = np.random.default_rng(seed)
+        self.crn = crn
+        self.rules = rules if rules is not None else DEFAULT_RULES
+        if ActionSpace(self.rules).phases:
+            raise ValueError("BatchGame only plays hit and stand")
+        self.dealer = dealer_table(self.rules)
+        self.reset()
+
+    def reset(self):
+        # Restart all the hands: two cards for the user and two for the dealer
+        if self.crn:
+            self.cards = RANK_VALUES[self.rng.integers(0, len(RANK_VALUES), (self.n, MAX_CARDS))]
+            self.stand_draws = self.rng.random(self.n)
+            self.cursor = np.full(self.n, 4)
+            values = self.cards[:, :4].T
+        else:
+            values = RANK_VALUES[self.rng.integers(0, len(RANK_VALUES), (4, self.n))]
+
+        self.user_sum = values[0] + values[2]
+        self.user_A = (values[0] == 1).astype(np.int64) + (values[2] == 1)
+        self.user_cards = np.full(self.n, 2)
+        self.dealer_sum = values[1] + values[3]
+        self.dealer_A = (values[1] == 1).astype(np.int64) + (values[3] == 1)
+        self.dealer_first = values[1].copy()
+        self.dealer_hidden = values[3].copy()
+        self.dealer_final = np.zeros(self.n, dtype=np.int64)  # Set when the user stands
+
+        self.stand = np.zeros(self.n, dtype=bool)
+        self.state = np.empty(self.n, dtype=np.int64)
+        self.done = np.zeros(self.n, dtype=bool)
+        self.make_state(np.arange(self.n))
+
+    def draw(self, idx):
+        # Draw the values of one card for each hand in idx, with a single RNG call
+        if self.crn:
+            values = self.cards[idx, self.cursor[idx]]
+            self.cursor[idx] += 1
+            return values
+        return RANK_VALUES[self.rng.integers(0, len(RANK_VALUES), len(idx))]
+
+    def make_state(self, idx):
+        # Same rules as Game.make_state, applied to the hands in idx
+        actual_user_sum, user_A_active = calculate_hands(self.user_sum[idx], self.user_A[idx])
+        dealt_dealer_sum, _ = calculate_hands(self.dealer_sum[idx], self.dealer_A[idx])
+        stand = self.stand[idx]
+        actual_dealer_sum = np.where(stand, self.dealer_final[idx], dealt_dealer_sum)
+
+        peeked = (dealt_dealer_sum == 21) & ~stand if self.rules.dealer_peeks else np.zeros(len(idx), dtype=bool)
+        user_21 = actual_user_sum == 21
+        user_bust = actual_user_sum > 21
+        user_better = (actual_dealer_sum > 21) | (actual_user_sum > actual_dealer_sum)
+
+        win = ~peeked & ((user_21 & (actual_dealer_sum != 21)) | (~user_21 & ~user_bust & stand & user_better))
+        lose = peeked | (user_21 & (actual_dealer_sum == 21)) | user_bust | (~user_21 & stand & ~user_better)
+
+        state = state_index.encode_parts(self.user_sum[idx], user_A_active, self.dealer_first[idx])
+        state[win] = WIN
+        state[lose] = LOSE
+        self.state[idx] = state
+        self.done[idx] = win | lose
+
+    def act_hit(self, idx):
+        # Give one card to each hand in idx
+        values = self.draw(idx)
+        self.user_A[idx] += values == 1
+        self.user_sum[idx] += values
+        self.user_cards[idx] += 1
+        self.make_state(idx)
+
+    def act_stand(self, idx):
+        # Sample the dealer's final total of each hand in idx from the dealer table, which
+        # follows the same rules as the loop in Game.act_stand
+        actual_user_sum, _ = calculate_hands(self.user_sum[idx], self.user_A[idx])
+        u = self.stand_draws[idx] if self.crn else self.rng.random(len(idx))
+        self.dealer_final[idx] = self.dealer.sample(self.dealer_first[idx], self.dealer_hidden[idx], actual_user_sum, u)
+
+        self.stand[idx] = True
+        self.make_state(idx)
+
+    def rewards(self):
+        # Same as Game.check_reward for every hand
+        reward = np.zeros(self.n)
+        reward[self.state == WIN] = 1
+        reward[(self.state == WIN) & (self.user_cards == 2) & ~self.stand] = self.rules.blackjack_payout
+        reward[self.state == LOSE] = -1
+        return reward
+
+    def play(self, policy):
+        """
+        Play all the hands from their current states to terminal
+
+        :param policy:  a policy function or action table (see policy_table)
+        :return:        (state_history, lengths, rewards), where state_history[i, :lengths[i]]
+                        are the state indices of hand i from its initial state to terminal,
+                        and rewards[i] is the reward of the terminal state
+        """
+        actions = policy_table(policy)
+        history = [self.state.copy()]
+        lengths = np.ones(self.n, dtype=np.int64)
+
+        while not self.done.all():
+            live = np.flatnonzero(~self.done)
+            action = actions[self.state[live]]
+            self.act_hit(live[action == HIT])
+            self.act_stand(live[action == STAND])
+            lengths[live] += 1
+            history.append(self.state.copy())
+
+        return np.stack(history, axis=1), lengths, self.rewards()
+
+    def simulate_sequences(self, policy):
+        """
+        Simulate one sequence per hand based on the passed in policy
+
+        :param policy:  a policy function or action table (see policy_table)
+        :return:        a list of episodes in the same form as Game.simulate_sequence
+        """
+        history, lengths, rewards = self.play(policy)
+        episodes = []
+        for row, length, reward in zip(history.tolist(), lengths.tolist(), rewards.tolist()):
+            episode = [(states[s], 0) for s in row[:length - 1]]
+            episode.append((states[row[length - 1]], reward))
+            episodes.append(episode)
+        return episodes
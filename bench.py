@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+'''
+    Performance benchmarks of the simulator and the learning algorithms.
+
+    Every benchmark sets up its own Game or Agent, outside of the timing, and then does a
+    fixed amount of work: episodes, hands, transitions or files. `random` is seeded with the
+    same seed before every run, so all runs do the same work. The first `warmup` runs are not
+    counted, and the rate of the others is reported as the mean and standard deviation of
+    units per second.
+
+    Results are saved as JSON under `bench-results/`, named by the git commit they were
+    measured on (with "-dirty" when the tree has uncommitted changes), and can be compared
+    with the results of another commit. A benchmark regressed when its mean rate dropped by
+    more than `threshold` and by more than twice the standard error of the difference:
+
+        python bench.py --save
+        python bench.py --compare HEAD~1
+'''
+RESULTS_DIR = "bench-results"
+EPISODES = 10000
+
+# name -> (setup function, number of units, unit name)
+BENCHMARKS = {}
+_scratch = None
+
+
+def scratch_path(name):
+    # A path in a temporary directory that is removed when the process exits
+    global _scratch
+    if _scratch is None:
+        _scratch = tempfile.TemporaryDirectory(prefix="bench-")
+    return os.path.join(_scratch.name, name)
+
+
+def benchmark(name, units, unit):
+    # Register setup(units) as a benchmark; it returns the function that does the timed work
+    def register(setup):
+        BENCHMARKS[name] = (setup, units, unit)
+        return setup
+    return register
+
+
+@benchmark("game.reset", EPISODES, "hands")
+def bench_reset(n):
+    from game import Game
+    game = Game()
+
+    def run():
+        for _ in range(n):
+            game.reset()
+    return run
+
+
+@benchmark("game.act_hit", EPISODES, "hands")
+def bench_act_hit(n):
+    # A new hand and one hit, which also makes the new state
+    from game import Game
+    game = Game()
+
+    def run():
+        for _ in range(n):
+            game.reset()
+            game.act_hit()
+    return run
+
+
+@benchmark("game.act_stand", EPISODES, "hands")
+def bench_act_stand(n):
+    # A new hand played out by the dealer
+    from game import Game
+    game = Game()
+
+    def run():
+        for _ in range(n):
+            game.reset()
+            game.act_stand()
+    return run
+
+
+@benchmark("game.fast_hit_stand", EPISODES, "hands")
+def bench_fast_hit_stand(n):
+    # A new hand, a hit and a stand, with Game(fast=True)
+    from game import Game
+    game = Game(fast=True)
+
+    def run():
+        for _ in range(n):
+            game.reset()
+            game.act_hit()
+            game.act_stand()
+    return run
+
+
+@benchmark("game.simulate_sequence", EPISODES, "episodes")
+def bench_simulate_sequence(n):
+    from ai import Agent
+    from game import Game
+    game = Game()
+
+    def run():
+        for _ in range(n):
+            game.reset()
+            game.simulate_sequence(Agent.default_policy)
+    return run
+
+
+def _agent_run(name, rng=None, fast=False):
+    def setup(n):
+        from ai import Agent
+        from game import Game
+        from rng import make_rng
+        agent = Agent(Game(rng=make_rng(rng, 0) if rng else None, fast=fast))
+        return lambda: getattr(agent, name)(n)
+    return setup
+
+
+benchmark("agent.MC_run", EPISODES, "episodes")(_agent_run("MC_run"))
+benchmark("agent.TD_run", EPISODES, "episodes")(_agent_run("TD_run"))
+benchmark("agent.Q_run", EPISODES, "episodes")(_agent_run("Q_run"))
+benchmark("agent.TDLambda_run", EPISODES, "episodes")(_agent_run("TDLambda_run"))
+benchmark("agent.QLambda_run", EPISODES, "episodes")(_agent_run("QLambda_run"))
+benchmark("agent.Q_run.fast_rng", EPISODES, "episodes")(_agent_run("Q_run", "fast"))
+benchmark("agent.Q_run.fast_game", EPISODES, "episodes")(_agent_run("Q_run", fast=True))
+
+
+@benchmark("agent.save", 20, "files")
+def bench_save(n):
+    from ai import Agent
+    agent = Agent()
+    agent.Q_run(1000)
+
+    def run():
+        for k in range(n):
+            agent.save(scratch_path(f"agent{k}"))
+    return run
+
+
+@benchmark("agent.load", 20, "files")
+def bench_load(n):
+    from ai import Agent
+    agent = Agent()
+    agent.Q_run(1000)
+    path = scratch_path("agent")
+    agent.save(path)
+
+    def run():
+        for _ in range(n):
+            Agent().load(path)
+    return run
+
+
+@benchmark("batch.play", 100 * EPISODES, "hands")
+def bench_batch(n):
+    from ai import Agent
+    from batch import BatchGame, policy_table
+    table = policy_table(Agent.default_policy)
+
+    def run():
+        BatchGame(n, seed=0).play(table)
+    return run
+
+
+@benchmark("parallel.Q", 4 * EPISODES, "episodes")
+def bench_parallel(n):
+    # Two worker processes, including starting them
+    from ai import Agent
+    agent = Agent()
+    return lambda: agent.parallel_run("Q", n, workers=2, sync_interval=n // 4, seed=0)
+
+
+@benchmark("replay.TD", EPISODES, "episodes")
+def bench_replay(n):
+    from ai import Agent
+    from replay import ReplayBuffer
+    buffer = ReplayBuffer(4 * n)
+    buffer.fill(Agent(), n)
+
+    def run():
+        Agent().replay_run("TD", buffer)
+    return run
+
+
+@benchmark("episodelog.MC", EPISODES, "episodes")
+def bench_episodelog(n):
+    from ai import Agent
+    from episodelog import EpisodeWriter, EpisodeReader
+    agent = Agent()
+    path = scratch_path("episodes.bjl")
+    with EpisodeWriter(path, agent.simulator):
+        agent.MC_run(n)
+
+    def run():
+        Agent().MC_run(n, source=EpisodeReader(path).episodes())
+    return run
+
+
+@benchmark("policyserver.lookup", 100 * EPISODES, "states")
+def bench_policy_lookup(n):
+    # Encoding and answering a batch of states, as the server does for every batch of requests
+    import numpy as np
+    from ai import Agent
+    from policyserver import Policy
+    agent = Agent()
+    agent.Q_run(1000)
+    policy = Policy(agent.tables)
+    generator = np.random.default_rng(0)
+    states = np.stack([generator.integers(2, 21, n), generator.integers(0, 2, n), generator.integers(1, 11, n)], axis=1)
+    return lambda: policy.decide(policy.encode(states))
+
+
+def _render(full):
+    # Frames of the board on SDL's dummy video driver while values change, see render.frame_times
+    def setup(n):
+        from ai import Agent
+        from render import headless_board, frame_times
+        board = headless_board()
+        agent = Agent()
+        return lambda: frame_times(board, agent, n, full)
+    return setup
+
+
+benchmark("render.frame", 2000, "frames")(_render(False))
+benchmark("render.full_frame", 2000, "frames")(_render(True))
+
+
+def _startup(*command):
+    # Start a fresh interpreter with command, so that the imports it does are timed
+    def setup(n):
+        def run():
+            for _ in range(n):
+                subprocess.run([sys.executable, *command], stdout=subprocess.DEVNULL, check=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        return run
+    return setup
+
+
+benchmark("startup.import_game", 10, "starts")(_startup("-c", "import game"))
+benchmark("startup.agent", 10, "starts")(_startup("-c", "import ai; ai.Agent()"))
+benchmark("startup.main_help", 10, "starts")(_startup("main.py", "--help"))
+
+
+def measure(name, repeat=5, warmup=1, seed=0, scale=1.0):
+    """
+    Time one benchmark
+
+    :param repeat:  the number of timed runs
+    :param warmup:  the number of runs done first and not counted
+    :param scale:   a factor on the amount of work of every run
+    :return:        a dict with the unit, the work per run, the rates of all runs and their mean
+                    and standard deviation
+    """
+    setup, units, unit = BENCHMARKS[name]
+    units = max(1, int(units * scale))
+    rates = []
+    for k in range(warmup + repeat):
+        random.seed(seed)
+        run = setup(units)
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        if k >= warmup:
+            rates.append(units / elapsed)
+    return {"unit": unit, "units": units, "rates": rates, "mean": statistics.mean(rates),
+            "stdev": statistics.stdev(rates) if len(rates) > 1 else 0.0}
+
+
+def git_commit():
+    # The commit of the working tree, with "-dirty" if it has uncommitted changes
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if status.strip() else "")
+
+
+def results_path(ref, directory=RESULTS_DIR):
+    # The results file of ref: a path, a commit as saved, or anything `git rev-parse` resolves
+    if os.path.exists(ref):
+        return ref
+    path = os.path.join(directory, ref + ".json")
+    if not os.path.exists(path):
+        try:
+            commit = subprocess.run(["git", "rev-parse", ref], capture_output=True, text=True, check=True).stdout.strip()
+            path = os.path.join(directory, commit + ".json")
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    if not os.path.exists(path):
+        raise SystemExit(f"no saved results for {ref!r} in {directory}")
+    return path
+
+
+def compare(base, results, threshold=0.1):
+    """
+    Compare results with the results of a base run
+
+    :param threshold:   the relative drop in mean rate that counts as a regression, if it is
+                        also larger than twice the standard error of the difference
+    :return:            lines of the report, and the names of the benchmarks that regressed
+    """
+    lines, regressed = [], []
+    for name, new in results.items():
+        old = base.get(name)
+        if old is None:
+            lines.append(f"{name:26} {new['mean']:14.0f} {new['unit']}/s  (new)")
+            continue
+        change = new["mean"] / old["mean"] - 1
+        noise = 2 * math.sqrt(new["stdev"] ** 2 / len(new["rates"]) + old["stdev"] ** 2 / len(old["rates"]))
+        flag = ""
+        if change < -threshold and old["mean"] - new["mean"] > noise:
+            flag = "  REGRESSION"
+            regressed.append(name)
+        elif change > threshold and new["mean"] - old["mean"] > noise:
+            flag = "  faster"
+        lines.append(f"{name:26} {old['mean']:14.0f} -> {new['mean']:14.0f} {new['unit']}/s  {change * 100:+6.1f}%{flag}")
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the simulator and the learning algorithms')
+    parser.add_argument('--only', '-k', action='append', help='run the benchmarks whose name contains this; repeatable')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    parser.add_argument('--repeat', '-r', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs before them')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scale', type=float, default=1.0, help='factor on the work of every run')
+    parser.add_argument('--save', action='store_true', help=f'save the results under {RESULTS_DIR}/ by git commit')
+    parser.add_argument('--output', '-o', help='save the results to this file instead')
+    parser.add_argument('--compare', metavar='REF', help='compare with the saved results of a commit, or a results file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown that counts as a regression')
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if not args.only or any(k in name for k in args.only)]
+    if args.list:
+        print("\n".join(names))
+        return 0
+    base = None
+    if args.compare:
+        with open(results_path(args.compare)) as file:
+            base = json.load(file)
+
+    results = {}
+    for name in names:
+        results[name] = result = measure(name, args.repeat, args.warmup, args.seed, args.scale)
+        print(f"{name:26} {result['mean']:14.0f} {result['unit']}/s  +- {result['stdev'] / result['mean'] * 100:.1f}%")
+
+    commit = git_commit()
+    report = {"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+              "machine": platform.machine(), "repeat": args.repeat, "warmup": args.warmup, "seed": args.seed,
+              "scale": args.scale, "results": results}
+    if args.save or args.output:
+        path = args.output or os.path.join(RESULTS_DIR, commit + ".json")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Saved to {path}")
+
+    if base is not None:
+        print(f"\nCompared with {base['commit']}:")
+        lines, regressed = compare(base["results"], results, args.threshold)
+        print("\n".join(lines))
+        if regressed:
+            print(f"{len(regressed)} regression(s): {', '.join(regressed)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
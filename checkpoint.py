@@ -0,0 +1,133 @@
+import os
+import glob
+import time
+import queue
+import threading
+
+from snapshot import save_snapshot
+
+'''
+    Periodic checkpoints of an Agent during long training runs.
+
+    A checkpoint is an Agent snapshot (see snapshot.py) whose meta data holds the number of
+    episodes trained so far and the state of the random streams of the Agent and its Game (see
+    rng.py), as well as the state of the Game's Shoe if it has one. Restoring them at an
+    episode boundary continues the run exactly as if it had never stopped.
+
+    The tables are copied on the training thread, which is cheap, and written by a background
+    thread: first to a temporary file that is fsynced, then renamed over the final name, so a
+    crash never leaves a partial checkpoint behind. Only the last `keep` checkpoints are kept.
+'''
+PATTERN = "checkpoint-*.snap"
+
+
+def checkpoint_name(directory, episode):
+    return os.path.join(directory, f"checkpoint-{episode:012d}.snap")
+
+
+def latest_checkpoint(directory):
+    # Path of the most recent checkpoint in directory, or None
+    paths = sorted(glob.glob(os.path.join(directory, PATTERN)))
+    return paths[-1] if paths else None
+
+
+def restore(agent, path):
+    """
+    Load a checkpoint into agent and restore the state of its random streams
+
+    :return:    the meta data of the checkpoint
+    """
+    meta = agent.load(path)
+    if "rng_state" in meta:
+        agent.rng.setstate(meta["rng_state"])
+    else:
+        # Checkpoints of earlier versions hold the state of the `random` module
+        agent.rng.setstate({"kind": "legacy", "state": meta["random_state"]})
+    if "game_rng_state" in meta:
+        agent.simulator.rng.setstate(meta["game_rng_state"])
+    if "shoe_state" in meta:
+        agent.simulator.shoe.setstate(meta["shoe_state"])
+    return meta
+
+
+class Checkpointer:
+    def __init__(self, directory, every_episodes=None, every_seconds=None, keep=3, start=0):
+        """
+        :param directory:       where checkpoints are written
+        :param every_episodes:  write a checkpoint after this many episodes
+        :param every_seconds:   write a checkpoint after this many seconds
+        :param keep:            the number of most recent checkpoints to keep
+        :param start:           the episode training starts from
+        """
+        if keep < 1:
+            raise ValueError(f"a Checkpointer must keep at least 1 checkpoint, not {keep}")
+        self.directory = directory
+        self.every_episodes = every_episodes
+        self.every_seconds = every_seconds
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+        self.last_episode = start
+        self.last_time = time.monotonic()
+
+        self.pending = queue.Queue()
+        self.error = None
+        self.writer = threading.Thread(target=self.__write_loop, daemon=True)
+        self.writer.start()
+
+    def due(self, episode):
+        if self.every_episodes and episode - self.last_episode >= self.every_episodes:
+            return True
+        return bool(self.every_seconds) and time.monotonic() - self.last_time >= self.every_seconds
+
+    def maybe_save(self, agent, episode, meta=None):
+        # Checkpoint if enough episodes or time have passed since the last checkpoint
+        if self.due(episode):
+            self.save(agent, episode, meta)
+
+    def save(self, agent, episode, meta=None):
+        # Take a copy of the tables and the random state now, and write them in the background
+        if self.error:
+            raise self.error
+        meta = dict(meta or {}, episode=episode, rng_state=agent.rng.getstate())
+        if agent.simulator.rng is not agent.rng:
+            meta["game_rng_state"] = agent.simulator.rng.getstate()
+        shoe = agent.simulator.shoe
+        if shoe is not None:
+            meta["shoe_state"] = shoe.getstate()
+        self.pending.put((agent.tables.copy(), agent.discount, episode, meta))
+        self.last_episode = episode
+        self.last_time = time.monotonic()
+
+    def close(self):
+        # Wait for the pending checkpoints to be written
+        self.pending.put(None)
+        self.writer.join()
+        if self.error:
+            raise self.error
+
+    def __write_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            try:
+                self.__write(*item)
+            except Exception as e:
+                self.error = e
+
+    def __write(self, tables, discount, episode, meta):
+        path = checkpoint_name(self.directory, episode)
+        tmp = path + ".tmp"
+        save_snapshot(tmp, tables, discount, meta, fsync=True)
+        os.replace(tmp, path)
+
+        # Make the rename itself durable
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        for old in sorted(glob.glob(os.path.join(self.directory, PATTERN)))[:-self.keep]:
+            os.remove(old)
@@ -0,0 +1,219 @@
+import io
+import os
+import random
+import contextlib
+import tempfile
+
+import numpy as np
+
+from ai import Agent
+from tables import TABLE_NAMES
+
+'''
+    Regression checks of the machinery around the learners, for `main.py -t 5`.
+
+    Every check trains or plays a few thousand episodes from fixed seeds and compares two ways
+    of getting the same result (e.g. saving and loading the tables), which must agree exactly.
+    The whole run takes seconds, so it is worth running after every change.
+'''
+
+
+def _same_tables(a, b, names=TABLE_NAMES):
+    # The names of the tables that differ between the tables a and b
+    return [name for name in names if not np.array_equal(getattr(a, name), getattr(b, name))]
+
+
+def _trained(episodes=2000, seed=0, game=None):
+    random.seed(seed)
+    agent = Agent(game)
+    agent.MC_run(episodes)
+    agent.TD_run(episodes)
+    agent.Q_run(episodes)
+    return agent
+
+
+def check_snapshot():
+    # Snapshots load back the tables they saved, in memory and memory-mapped, and refuse
+    # tables trained with another discount
+    from snapshot import SnapshotError, save_snapshot
+    agent = _trained()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "agent.snap")
+        agent.save(path)
+        for mmap_mode in (None, "r"):
+            loaded = Agent()
+            loaded.load(path, mmap_mode)
+            differ = _same_tables(agent.tables, loaded.tables)
+            if differ:
+                return f"{', '.join(differ)} differ after loading with mmap_mode={mmap_mode}"
+        save_snapshot(path, agent.tables, 0.5)
+        try:
+            Agent().load(path)
+        except SnapshotError:
+            return None
+        return "loaded a snapshot with another discount"
+
+
+def check_resume():
+    # A training run resumed from a checkpoint ends with the same tables and convergence
+    # metrics as one that ran without interruption
+    from train import build_parser, run
+    with tempfile.TemporaryDirectory() as directory:
+        def train(name, episodes, *options):
+            path = os.path.join(directory, name)
+            args = build_parser().parse_args(["-n", str(episodes), "--checkpoint-dir", path,
+                                              "--checkpoint-episodes", "1000", "--chunk", "500",
+                                              "--metrics", path + ".csv", "--window", "500",
+                                              "-o", path + ".snap", *options])
+            with contextlib.redirect_stdout(io.StringIO()):
+                run(args)
+            with open(path + ".snap", "rb") as snap, open(path + ".csv") as metrics:
+                return snap.read(), metrics.read()
+
+        uninterrupted = train("uninterrupted", 3000)
+        train("resumed", 1500)
+        resumed = train("resumed", 3000, "--resume")
+        if resumed[0] != uninterrupted[0]:
+            return "the resumed run saved different tables"
+        if resumed[1] != uninterrupted[1]:
+            return "the resumed run wrote different convergence metrics"
+    return None
+
+
+def check_shoe():
+    # A shoe only takes a penetration between 0 and 1, its true count stays defined when its
+    # last card is dealt, and agents with true-count states train in and out of process
+    from game import Game, Shoe
+    try:
+        Shoe(1, 1.0)
+        return "accepted a penetration of 1"
+    except ValueError:
+        pass
+    shoe = Shoe(1, 0.5, seed=0)
+    for _ in shoe.order:
+        shoe.deal()
+    if shoe.true_count() != 0:
+        return f"the true count of an empty shoe is {shoe.true_count()}, not 0"
+
+    random.seed(0)
+    agent = Agent(Game(Shoe(1, 0.99, seed=0), count_range=(-3, 3)))
+    agent.MC_run(2000)
+    agent.TD_run(2000)
+    agent.Q_run(2000)
+    agent.parallel_run("TD", 2000, workers=2, sync_interval=500)
+    if agent.tables.N_TD.sum() <= agent.tables.N_MC.sum():
+        return "the workers didn't train the true-count states"
+    return None
+
+
+def check_parallel_rules():
+    # Workers play by the rules of the agent's Game: the same seeds give other MC returns when
+    # the dealer hits a soft 17
+    from game import Game
+    from rules import RuleSet
+    agents = [Agent(Game(rules=RuleSet(hit_soft_17=h17))) for h17 in (False, True)]
+    for agent in agents:
+        agent.parallel_run("MC", 2000, workers=2, sync_interval=500)
+    if not _same_tables(*(agent.tables for agent in agents), names=["S_MC"]):
+        return "the workers ignored the rules"
+    return None
+
+
+def check_replay():
+    # Replaying the transitions of TD_run's episodes in minibatches of 1 repeats TD_run
+    from replay import ReplayBuffer
+    random.seed(0)
+    expected = Agent()
+    expected.TD_run(2000)
+    random.seed(0)
+    buffer = ReplayBuffer(100000)
+    buffer.fill(Agent(), 2000)
+    agent = Agent()
+    agent.replay_run("TD", buffer, batch_size=1)
+    if not np.array_equal(agent.tables.N_TD, expected.tables.N_TD):
+        return "N_TD differs from TD_run"
+    if not np.allclose(agent.tables.TD_values, expected.tables.TD_values, rtol=0, atol=1e-9):
+        return "TD_values differ from TD_run"
+    return None
+
+
+def check_fast_game():
+    # Game(fast=True) draws the same cards as the normal Game, so training gives the same tables
+    from game import Game, Shoe
+    from rules import RuleSet
+    for rules in (None, RuleSet(hit_soft_17=True, dealer_peeks=True, blackjack_payout=1.5)):
+        for decks in (None, 2):
+            normal, fast = (_trained(game=Game(Shoe(decks, seed=0) if decks else None, rules=rules, fast=fast))
+                            for fast in (False, True))
+            differ = _same_tables(normal.tables, fast.tables)
+            if differ:
+                return f"{', '.join(differ)} differ with {rules or 'the default rules'} and {decks or 'infinite'} decks"
+    return None
+
+
+def check_replay_rates():
+    # The closed-form batch updates of replay.py match one-at-a-time updates with every kind of
+    # learning rate, including a constant rate of 1 that replaces the value on every update
+    from ai import AlphaSchedule
+    from replay import _apply, _visits
+    generator = np.random.default_rng(0)
+    keys = generator.integers(0, 8, 200)
+    counts = generator.integers(0, 3, 8)
+    targets = generator.normal(size=200)
+    n = _visits(keys, counts)
+    for alpha in (AlphaSchedule(), AlphaSchedule(4, 0.7), AlphaSchedule(constant=0.05), AlphaSchedule(constant=1)):
+        values = generator.normal(size=8)
+        expected = values.copy()
+        for key, visit, target in zip(keys, n, targets):
+            expected[key] += alpha(visit) * (target - expected[key])
+        _apply(values, keys, n, targets, alpha)
+        if not np.allclose(values, expected, rtol=0, atol=1e-9):
+            return f"the batch updates differ from one at a time with {alpha}"
+    return None
+
+
+def check_lambda():
+    # TD(lambda) and Q(lambda) with lambda 0 repeat TD_run and Q_run on the same episodes
+    for run, lambda_run, names in (("TD_run", "TDLambda_run", ("TD_values", "N_TD")),
+                                   ("Q_run", "QLambda_run", ("Q_values", "N_Q"))):
+        random.seed(0)
+        expected = Agent()
+        getattr(expected, run)(2000)
+        for replacing in (False, True):
+            random.seed(0)
+            agent = Agent()
+            getattr(agent, lambda_run)(2000, lam=0, replacing=replacing)
+            for name in names:
+                if not np.allclose(getattr(agent.tables, name), getattr(expected.tables, name), rtol=0, atol=1e-9):
+                    return f"{name} of {lambda_run} with lambda 0 differ from {run}"
+    return None
+
+
+CHECKS = [
+    ("snapshot", check_snapshot),
+    ("checkpoint resume", check_resume),
+    ("shoe and true count", check_shoe),
+    ("parallel rules", check_parallel_rules),
+    ("replay batch of 1", check_replay),
+    ("replay learning rates", check_replay_rates),
+    ("fast game", check_fast_game),
+    ("lambda 0", check_lambda),
+]
+
+
+def test_regressions():
+    """
+    Run all the checks and print their results like the other testers
+
+    :return:    whether all of them passed
+    """
+    passed = True
+    for name, check in CHECKS:
+        failure = check()
+        if failure is None:
+            print(f"++++ PASSED {name}")
+        else:
+            print(f"---- FAILED {name}: {failure}")
+            passed = False
+    print()
+    return passed
@@ -0,0 +1,195 @@
+import os
+import csv
+
+import numpy as np
+
+from game import HIT, STAND
+
+'''
+    Online convergence tracking for training runs.
+
+    Every `window` episodes the monitor looks at the Agent tables and computes, per algorithm:
+        - max_change, mean_change:  the max and mean absolute change of the values of the
+                                    visited states since the previous window
+        - max_stderr (MC):          the largest standard error of an MC value, from the running
+                                    variance of the returns seen since the monitor started
+        - policy_flips (Q):         the number of states whose greedy action (as picked by
+                                    Agent.autoplay_decision) changed since the previous window
+    An algorithm has converged when max_change <= tolerance, max_stderr <= stderr_tolerance and
+    policy_flips <= max_flips (for the metrics it has), and training stops once every algorithm
+    has converged in `patience` windows in a row.
+
+    The state of a monitor (getstate) is stored in the checkpoints of train.py, so a run resumed
+    from a checkpoint stops at the same window as one that wasn't interrupted.
+
+    Only states visited in at least a min_share fraction of the episodes are taken into account,
+    so that states too rare to ever settle do not keep a run going forever. The share is used
+    rather than a fixed count so that a state is not judged before it has been sampled in
+    proportion to its frequency.
+'''
+FIELDS = ("episode", "algorithm", "max_change", "mean_change", "max_stderr", "policy_flips", "converged")
+
+# Values and visit counts of each algorithm in Tables
+TABLES = {
+    "MC": ("MC_values", "N_MC"),
+    "TD": ("TD_values", "N_TD"),
+    "Q": ("Q_values", "N_Q"),
+}
+
+
+def greedy_actions(Q_values, mask=None):
+    # Action of Agent.autoplay_decision in every state: the legal action with the largest
+    # Q value, the first one on ties, so HIT unless another action is strictly better
+    if mask is None:
+        return np.where(Q_values[:, STAND] > Q_values[:, HIT], STAND, HIT)
+    return np.argmax(np.where(mask, Q_values, -np.inf), axis=1)
+
+
+class ConvergenceMonitor:
+    def __init__(self, algorithms, window=10000, tolerance=0.1, stderr_tolerance=0.1, max_flips=1,
+                 patience=3, min_share=1e-4, output=None, state=None):
+        """
+        :param algorithms:          the algorithms to track: "MC", "TD" and/or "Q"
+        :param window:              the number of episodes between two measurements
+        :param output:              an optional CSV file the metrics of every window are written to
+        :param state:               the getstate of a monitor to continue from, e.g. when resuming
+                                    from a checkpoint. The rows of output up to its last window
+                                    are kept
+        """
+        self.algorithms = list(algorithms)
+        self.window = window
+        self.tolerance = tolerance
+        self.stderr_tolerance = stderr_tolerance
+        self.max_flips = max_flips
+        self.patience = patience
+        self.min_share = min_share
+
+        self.last_episode = None
+        self.mask = None        # Legal actions of the Agent, see greedy_actions
+        self.previous = {}      # Values and greedy actions at the previous window
+        self.baseline = None    # S_MC, SS_MC and N_MC when the monitor started
+        self.streak = 0         # Consecutive windows where all algorithms converged
+        self.history = []       # Metrics of every window, as dicts with FIELDS
+
+        self.output = output
+        kept = []
+        if state is not None:
+            self.setstate(state)
+            if output and os.path.exists(output):
+                with open(output, newline="") as file:
+                    kept = [row for row in csv.DictReader(file) if int(row["episode"]) <= self.last_episode]
+        if output:
+            with open(output, "w", newline="") as file:
+                writer = csv.DictWriter(file, FIELDS)
+                writer.writeheader()
+                writer.writerows(kept)
+
+    def settings(self):
+        return {"algorithms": self.algorithms, "window": self.window, "tolerance": self.tolerance,
+                "stderr_tolerance": self.stderr_tolerance, "max_flips": self.max_flips,
+                "patience": self.patience, "min_share": self.min_share}
+
+    def getstate(self):
+        # The measurements so far and the settings, as JSON-serializable data
+        if self.last_episode is None:
+            return None
+        return {
+            "settings": self.settings(),
+            "last_episode": self.last_episode,
+            "streak": self.streak,
+            "previous": {name: [values.tolist(), None if actions is None else actions.tolist()]
+                         for name, (values, actions) in self.previous.items()},
+            "baseline": [table.tolist() for table in self.baseline],
+        }
+
+    def setstate(self, state):
+        # Continue from a getstate; the settings must be the same
+        settings = self.settings()
+        changed = sorted(key for key in settings if state["settings"][key] != settings[key])
+        if changed:
+            raise ValueError(f"the monitor was saved with different {', '.join(changed)}")
+        self.last_episode = state["last_episode"]
+        self.streak = state["streak"]
+        self.previous = {name: (np.array(values), None if actions is None else np.array(actions))
+                         for name, (values, actions) in state["previous"].items()}
+        S, SS, N = state["baseline"]
+        self.baseline = (np.array(S), np.array(SS), np.array(N, dtype=np.int64))
+
+    def update(self, agent, episode):
+        """
+        Measure at the end of a window
+
+        :param agent:   the Agent being trained
+        :param episode: the number of episodes done so far
+        :return:        whether training should stop
+        """
+        tables = agent.tables
+        self.mask = agent.legal_mask
+        if self.last_episode is None:
+            self.start(tables, episode)
+            return False
+        if episode - self.last_episode < self.window:
+            return False
+        self.last_episode = episode
+
+        rows = [self.measure(tables, name, episode) for name in self.algorithms]
+        self.history += rows
+        if self.output:
+            with open(self.output, "a", newline="") as file:
+                writer = csv.DictWriter(file, FIELDS)
+                writer.writerows(rows)
+
+        if all(row["converged"] for row in rows):
+            self.streak += 1
+        else:
+            self.streak = 0
+        return self.streak >= self.patience
+
+    def start(self, tables, episode):
+        self.last_episode = episode
+        self.baseline = (tables.S_MC.copy(), tables.SS_MC.copy(), tables.N_MC.copy())
+        for name, (values_name, _) in TABLES.items():
+            values = getattr(tables, values_name)
+            self.previous[name] = (values.copy(), greedy_actions(values, self.mask) if name == "Q" else None)
+
+    def measure(self, tables, name, episode):
+        values_name, counts_name = TABLES[name]
+        values = getattr(tables, values_name)
+        visited = getattr(tables, counts_name) >= max(self.min_share * episode, 1)
+        previous_values, previous_actions = self.previous[name]
+
+        change = np.abs(values - previous_values)[visited]
+        row = {
+            "episode": episode,
+            "algorithm": name,
+            "max_change": float(change.max()) if change.size else 0.0,
+            "mean_change": float(change.mean()) if change.size else 0.0,
+            "max_stderr": "",
+            "policy_flips": "",
+        }
+        converged = row["max_change"] <= self.tolerance
+
+        if name == "MC":
+            row["max_stderr"] = self.max_stderr(tables, visited)
+            converged = converged and row["max_stderr"] <= self.stderr_tolerance
+
+        actions = None
+        if name == "Q":
+            actions = greedy_actions(values, self.mask)
+            row["policy_flips"] = int((actions != previous_actions)[visited].sum())
+            converged = converged and row["policy_flips"] <= self.max_flips
+
+        row["converged"] = converged
+        self.previous[name] = (values.copy(), actions)
+        return row
+
+    def max_stderr(self, tables, visited):
+        # Standard error of the MC values, with the variance of the returns estimated from the
+        # returns seen since the monitor started
+        S, SS, N = (table - base for table, base in zip((tables.S_MC, tables.SS_MC, tables.N_MC), self.baseline))
+        sampled = visited & (N > 1)
+        if not sampled.any():
+            return float("inf")
+        mean = S[sampled] / N[sampled]
+        variance = np.maximum(SS[sampled] / N[sampled] - mean * mean, 0) * N[sampled] / (N[sampled] - 1)
+        return float(np.sqrt(variance / tables.N_MC[sampled]).max())
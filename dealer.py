@@ -0,0 +1,103 @@
+import numpy as np
+
+from game import Game, ranks, get_amt
+from rules import DEFAULT_RULES
+
+'''
+    Precomputed distributions of the dealer's final total, for the infinite deck.
+
+    Once the user stands, what the dealer ends with only depends on the rules, the dealer's two
+    cards and the user's total. A DealerTable holds that distribution for every dealer upcard,
+    hidden card and user total, so that a stand can be resolved with a single uniform draw
+    instead of drawing the dealer's cards one by one. Tables are built once per RuleSet and
+    cached by its hash.
+'''
+BUST = 22           # Final total of a dealer that went over 21
+MAX_TOTAL = 21      # Largest user total the user can stand on
+
+# Probability of drawing each card value
+CARD_PROBS = {}
+for rank in ranks:
+    value = get_amt((rank, None))
+    CARD_PROBS[value] = CARD_PROBS.get(value, 0) + 1 / len(ranks)
+
+
+class DealerTable:
+    """
+    probs[dealer_first, hidden, user_total, final] is the probability that the dealer ends with
+    `final` (BUST for over 21) when it shows dealer_first, its hidden card is worth `hidden`, and
+    the user stands with the actual sum user_total. cdf is the cumulative sum over `final`.
+    """
+    def __init__(self, rules=DEFAULT_RULES):
+        self.rules = rules
+        self.probs = np.zeros((11, 11, MAX_TOTAL + 1, BUST + 1))
+
+        memo = {}
+        for dealer_first in CARD_PROBS:
+            for hidden in CARD_PROBS:
+                for user_total in range(2, MAX_TOTAL + 1):
+                    dealer_A = int(dealer_first == 1 or hidden == 1)
+                    self.probs[dealer_first, hidden, user_total] = \
+                        self.__finals(memo, dealer_first + hidden, dealer_A, user_total)
+        self.cdf = np.cumsum(self.probs, axis=-1)
+
+    def __finals(self, memo, dealer_sum, dealer_A, user_total):
+        # Distribution of the final total from a dealer hand, following Game.act_stand
+        key = dealer_sum, dealer_A, user_total
+        if key in memo:
+            return memo[key]
+        finals = np.zeros(BUST + 1)
+        actual_dealer_sum, dealer_A_active = Game.calculate_hand(dealer_sum, dealer_A)
+        if actual_dealer_sum > 21:
+            finals[BUST] = 1
+        elif actual_dealer_sum == 21 or self.rules.dealer_stands(actual_dealer_sum, dealer_A_active, user_total):
+            finals[actual_dealer_sum] = 1
+        else:
+            for value, p in CARD_PROBS.items():
+                finals += p * self.__finals(memo, dealer_sum + value, int(dealer_A or value == 1), user_total)
+        memo[key] = finals
+        return finals
+
+    def sample(self, dealer_first, hidden, user_total, u):
+        """
+        Final totals of many dealer hands at once
+
+        :param dealer_first, hidden, user_total:    int arrays, one entry per hand
+        :param u:                                   uniform draws in [0, 1), one per hand
+        :return:                                    the final totals, BUST for over 21
+        """
+        cdf = self.cdf[dealer_first, hidden, user_total]
+        return np.minimum((u[:, None] >= cdf).sum(axis=1), BUST)
+
+    def distribution(self, dealer_first, user_total):
+        """
+        Distribution of the final total when only the dealer's upcard is known. With
+        RuleSet.dealer_peeks, the round only gets to a stand if the dealer has no 21, so the
+        hidden cards that would make 21 are left out.
+
+        :return:    an array of probabilities indexed by final total, BUST for over 21
+        """
+        # The dealer plays the same against any total from 21 up
+        user_total = min(user_total, MAX_TOTAL)
+        finals = np.zeros(BUST + 1)
+        for hidden, p in CARD_PROBS.items():
+            if self.rules.dealer_peeks and self.is_21(dealer_first, hidden):
+                continue
+            finals += p * self.probs[dealer_first, hidden, user_total]
+        return finals / finals.sum()
+
+    @staticmethod
+    def is_21(dealer_first, hidden):
+        # Whether two cards make 21
+        return {dealer_first, hidden} == {1, 10}
+
+
+_tables = {}
+
+
+def dealer_table(rules=DEFAULT_RULES):
+    # The DealerTable of rules, built on first use
+    key = rules.hash()
+    if key not in _tables:
+        _tables[key] = DealerTable(rules)
+    return _tables[key]
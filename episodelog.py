@@ -0,0 +1,250 @@
+import os
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from game import make_index
+from rules import RuleSet
+
+'''
+    Append-only binary log of episodes, for training offline from episodes simulated once.
+
+    A log file is laid out as
+        - MAGIC (8 bytes) and the header length (little-endian uint32)
+        - the header, a JSON object:
+            - "version":  the format version
+            - "count_range", "phases": the state index layout (see game.make_index)
+            - "num_states", "num_actions"
+            - "rules":    the rules.RuleSet of the Game, as a dict
+            - "meta":     free-form JSON
+        - chunks of up to chunk_episodes episodes, each a CHUNK struct (episodes, records,
+          compressed length, CRC-32 of the compressed data) followed by the zlib-compressed
+          episode offsets (uint32, episodes + 1 of them) and records (RECORD, one per step)
+
+    A record is the state index, the action taken in the state and the reward of the state,
+    so an episode is its records from the first state to the terminal one, and the next
+    state of a record is the following record. The action of a terminal record is the one
+    passed to Game.simulate_one_step, or 0 for Game.simulate_sequence.
+
+    An EpisodeWriter hooks into a Game, which then logs every episode of simulate_sequence and
+    simulate_one_step. An EpisodeReader streams the episodes back one chunk at a time, so
+    Agent.MC_run, TD_run and Q_run can train from a log of any size (their `source`
+    parameter) without loading it into memory. A chunk left incomplete by a crash is ignored
+    by readers and cut off when appending.
+'''
+MAGIC = b"BJEPLOG\x01"
+VERSION = 1
+PREAMBLE = struct.Struct("<8sI")
+CHUNK = struct.Struct("<IIII")
+RECORD = np.dtype([("state", "<u2"), ("action", "u1"), ("reward", "<f4")])
+CHUNK_EPISODES = 4096
+
+
+class EpisodeLogError(ValueError):
+    pass
+
+
+def _read_header(file):
+    magic, length = PREAMBLE.unpack(file.read(PREAMBLE.size) or bytes(PREAMBLE.size))
+    if magic != MAGIC:
+        raise EpisodeLogError(f"{file.name} is not an episode log")
+    header = json.loads(file.read(length))
+    if header["version"] != VERSION:
+        raise EpisodeLogError(f"{file.name} has format version {header['version']}, expected {VERSION}")
+    return header
+
+
+def _read_chunk(file):
+    # (offsets, records) of the next chunk, or None at the end of the file or of its complete chunks
+    head = file.read(CHUNK.size)
+    if len(head) < CHUNK.size:
+        return None
+    episodes, records, length, checksum = CHUNK.unpack(head)
+    data = file.read(length)
+    if len(data) < length or zlib.crc32(data) != checksum:
+        return None
+    data = zlib.decompress(data)
+    offsets = np.frombuffer(data, dtype="<u4", count=episodes + 1)
+    return offsets, np.frombuffer(data, dtype=RECORD, count=records, offset=offsets.nbytes)
+
+
+class EpisodeWriter:
+    def __init__(self, filename, game, chunk_episodes=CHUNK_EPISODES, append=False, meta=None, level=6):
+        """
+        Log the episodes played by game to filename, from now until close()
+
+        :param game:            the Game to hook into; its state layout and rules go in the header
+        :param chunk_episodes:  the number of episodes compressed together
+        :param append:          add to an existing log of the same Game layout and rules
+        :param meta:            JSON-serializable data for the header of a new log
+        :param level:           the zlib compression level
+        """
+        self.index = game.index
+        self.chunk_episodes = chunk_episodes
+        self.level = level
+        if len(self.index) > 1 << 16:
+            raise EpisodeLogError(f"{len(self.index)} states don't fit in the 16-bit state of a record")
+        header = {"version": VERSION, "count_range": self.index.count_range, "phases": self.index.phases,
+                  "num_states": len(self.index), "num_actions": game.actions.num_actions,
+                  "rules": game.rules.to_dict(), "meta": meta or {}}
+        if header["count_range"] is not None:
+            header["count_range"] = list(header["count_range"])
+
+        if append and os.path.exists(filename):
+            self.file = open(filename, "r+b")
+            saved = _read_header(self.file)
+            if {k: v for k, v in saved.items() if k != "meta"} != {k: v for k, v in header.items() if k != "meta"}:
+                raise EpisodeLogError(f"{filename} was written by a Game with a different layout or rules")
+            # Skip the complete chunks and cut off what follows them
+            end = self.file.tell()
+            while _read_chunk(self.file) is not None:
+                end = self.file.tell()
+            self.file.seek(end)
+            self.file.truncate()
+        else:
+            self.file = open(filename, "wb")
+            data = json.dumps(header).encode()
+            self.file.write(PREAMBLE.pack(MAGIC, len(data)) + data)
+
+        # The chunk being built, and the steps of the episode being played
+        self.offsets, self.states, self.actions, self.rewards = [0], [], [], []
+        self.episode = 0
+        self.episodes = 0       # Episodes written by this writer
+        self.game = game
+        game.recorder = self
+
+    def step(self, state, action, reward):
+        self.states.append(self.index.encode(state))
+        self.actions.append(action)
+        self.rewards.append(reward)
+        self.episode += 1
+
+    def end_episode(self):
+        self.offsets.append(len(self.states))
+        self.episode = 0
+        self.episodes += 1
+        if len(self.offsets) > self.chunk_episodes:
+            self.flush()
+
+    def abandon(self):
+        # Drop the steps of an unfinished episode
+        if self.episode:
+            for steps in (self.states, self.actions, self.rewards):
+                del steps[len(steps) - self.episode:]
+            self.episode = 0
+
+    def flush(self):
+        # Write the finished episodes as a chunk
+        if len(self.offsets) == 1:
+            return
+        n = self.offsets[-1]
+        records = np.empty(n, dtype=RECORD)
+        records["state"] = self.states[:n]
+        records["action"] = self.actions[:n]
+        records["reward"] = self.rewards[:n]
+        data = zlib.compress(np.array(self.offsets, dtype="<u4").tobytes() + records.tobytes(), self.level)
+        self.file.write(CHUNK.pack(len(self.offsets) - 1, n, len(data), zlib.crc32(data)) + data)
+        self.offsets = [0]
+        for steps in (self.states, self.actions, self.rewards):
+            del steps[:n]
+
+    def close(self):
+        # Write the finished episodes and unhook from the Game
+        self.flush()
+        self.file.close()
+        if self.game.recorder is self:
+            self.game.recorder = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EpisodeReader:
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as file:
+            self.header = _read_header(file)
+        count_range = self.header["count_range"]
+        self.index = make_index(tuple(count_range) if count_range else None, self.header["phases"])
+        self.rules = RuleSet(**self.header["rules"])
+        self.num_actions = self.header["num_actions"]
+        if len(self.index) != self.header["num_states"]:
+            raise EpisodeLogError(f"{filename} has {self.header['num_states']} states, "
+                                  f"its layout has {len(self.index)}")
+
+    def chunks(self):
+        # (offsets, records) arrays of every chunk in turn, see RECORD
+        with open(self.filename, "rb") as file:
+            _read_header(file)
+            chunk = _read_chunk(file)
+            while chunk is not None:
+                yield chunk
+                chunk = _read_chunk(file)
+
+    def episodes(self):
+        # Every episode in turn, as lists (states, actions, rewards)
+        for offsets, records in self.chunks():
+            states, actions, rewards = records["state"].tolist(), records["action"].tolist(), records["reward"].tolist()
+            offsets = offsets.tolist()
+            for start, end in zip(offsets, offsets[1:]):
+                yield states[start:end], actions[start:end], rewards[start:end]
+
+    def count(self):
+        # (episodes, steps) in the log
+        episodes = steps = 0
+        for offsets, records in self.chunks():
+            episodes += len(offsets) - 1
+            steps += len(records)
+        return episodes, steps
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+
+    from ai import Agent
+
+    # Agent methods that play with the default policy (MC) or explore from the Q values (Q)
+    RECORD_RUNS = {"MC": "MC_run", "Q": "Q_run"}
+    TRAIN_RUNS = {"MC": "MC_run", "TD": "TD_run", "Q": "Q_run"}
+
+    parser = argparse.ArgumentParser(description='Episode log files')
+    commands = parser.add_subparsers(dest="command", required=True)
+    record = commands.add_parser("record", help="simulate episodes into a log")
+    record.add_argument("file")
+    record.add_argument("--episodes", "-n", type=int, default=100000)
+    record.add_argument("--algorithm", "-a", choices=RECORD_RUNS, default="MC",
+                        help="MC to follow the default policy, Q to learn and explore as Q_run does")
+    record.add_argument("--append", action="store_true")
+    train = commands.add_parser("train", help="train an agent offline from a log")
+    train.add_argument("file")
+    train.add_argument("--algorithms", "-a", default="MC,TD,Q", help="comma-separated algorithms: MC, TD, Q")
+    train.add_argument("--episodes", "-n", type=int, help="at most this many episodes per algorithm")
+    train.add_argument("--output", "-o", help="save the agent to this file")
+    info = commands.add_parser("info", help="print the header and size of a log")
+    info.add_argument("file")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        agent = Agent()
+        with EpisodeWriter(args.file, agent.simulator, append=args.append):
+            getattr(agent, RECORD_RUNS[args.algorithm])(args.episodes)
+    elif args.command == "train":
+        reader = EpisodeReader(args.file)
+        if reader.index.count_range is not None:
+            raise SystemExit(f"{args.file} has true-count states; train from it with an Agent of the same Game")
+        agent = Agent(rules=reader.rules)
+        for name in args.algorithms.split(","):
+            getattr(agent, TRAIN_RUNS[name])(args.episodes or sys.maxsize, source=reader.episodes())
+        if args.output:
+            agent.save(args.output)
+    else:
+        reader = EpisodeReader(args.file)
+        episodes, steps = reader.count()
+        print(json.dumps(reader.header, indent=2))
+        print(f"{episodes} episodes, {steps} steps, {os.path.getsize(args.file)} bytes")
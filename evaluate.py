@@ -0,0 +1,177 @@
+import math
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from batch import BatchGame, policy_table
+from convergence import greedy_actions
+
+'''
+    Batch evaluation of policies: win rates over millions of hands, with confidence intervals
+    and a breakdown by the dealer's visible card.
+
+    Hands are played by batch.BatchGame in shards of shard_size hands, spread over worker
+    processes. A policy is turned into an action lookup array once (see batch.policy_table), so
+    playing a hand never calls the policy. The greedy Q policy of a trained Agent is given by
+    convergence.greedy_actions(agent.tables.Q_values). Shard i is always seeded from the i-th child of
+    np.random.SeedSequence(seed) and uses common random numbers, so two policies evaluated with
+    the same seed are dealt exactly the same cards, and compare() can measure their difference
+    hand by hand with much less variance than two independent runs.
+'''
+Z_95 = 1.959963984540054
+UPCARDS = range(1, 11)
+
+
+def wilson_interval(wins, n, z=Z_95):
+    # Wilson score interval of a binomial proportion
+    if n == 0:
+        return 0.0, 1.0
+    p = wins / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return center - half, center + half
+
+
+def optimal_policy():
+    # Action table of the optimal policy from the exact solver
+    from solver import ExactSolver
+    return greedy_actions(ExactSolver().to_agent().tables.Q_values)
+
+
+def _play_shard(task):
+    # Rewards and dealer upcards of one shard of hands for each policy
+    tables, n, seed, rules = task
+    results = []
+    for table in tables:
+        game = BatchGame(n, seed, crn=True, rules=rules)
+        _, _, rewards = game.play(table)
+        results.append(rewards)
+    return game.dealer_first, results
+
+
+def _shards(hands, shard_size, seed):
+    seeds = np.random.SeedSequence(seed).spawn(-(-hands // shard_size))
+    for i, child in enumerate(seeds):
+        yield min(shard_size, hands - i * shard_size), child
+
+
+def _run(tables, hands, seed, workers, shard_size, rules):
+    # Yields (dealer upcards, [rewards of each policy]) for every shard, in shard order
+    tasks = [(tables, n, s, rules) for n, s in _shards(hands, shard_size, seed)]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            yield from pool.imap(_play_shard, tasks)
+    else:
+        yield from map(_play_shard, tasks)
+
+
+class Evaluation:
+    def __init__(self, hands_per_upcard, wins_per_upcard):
+        self.hands_per_upcard = hands_per_upcard
+        self.wins_per_upcard = wins_per_upcard
+        self.hands = int(hands_per_upcard.sum())
+        self.wins = int(wins_per_upcard.sum())
+        self.win_rate = self.wins / self.hands
+        self.ci = wilson_interval(self.wins, self.hands)
+
+    def upcard(self, dealer_first):
+        # (win rate, confidence interval, hands) of the hands where the dealer shows dealer_first
+        n, wins = int(self.hands_per_upcard[dealer_first]), int(self.wins_per_upcard[dealer_first])
+        return (wins / n if n else 0.0), wilson_interval(wins, n), n
+
+    def report(self):
+        low, high = self.ci
+        lines = [f"Win rate {self.win_rate * 100:.3f}% (95% CI {low * 100:.3f}% - {high * 100:.3f}%) over {self.hands} hands"]
+        for d in UPCARDS:
+            rate, (low, high), n = self.upcard(d)
+            name = "A" if d == 1 else str(d)
+            lines.append(f"  dealer {name:>2}: {rate * 100:6.2f}% ({low * 100:6.2f}% - {high * 100:6.2f}%) over {n} hands")
+        return "\n".join(lines)
+
+
+class Comparison:
+    def __init__(self, a, b, hands, diff_sum, diff_sq_sum):
+        self.a, self.b = a, b
+        self.hands = hands
+        # Mean of the per-hand difference in reward (a - b), and its confidence interval
+        self.mean_diff = diff_sum / hands
+        variance = max(diff_sq_sum / hands - self.mean_diff ** 2, 0) * hands / max(hands - 1, 1)
+        half = Z_95 * math.sqrt(variance / hands)
+        self.ci = self.mean_diff - half, self.mean_diff + half
+
+    def report(self):
+        low, high = self.ci
+        return "\n".join([
+            "Policy A: " + self.a.report(),
+            "Policy B: " + self.b.report(),
+            f"Mean reward difference A - B: {self.mean_diff:+.5f} (95% CI {low:+.5f} - {high:+.5f}), "
+            f"win rate difference {(self.a.win_rate - self.b.win_rate) * 100:+.3f}%",
+        ])
+
+
+def _evaluate(tables, hands, seed, workers, shard_size, rules):
+    counts = np.zeros((len(tables), 2, 11), dtype=np.int64)
+    diff_sum = diff_sq_sum = 0
+    for upcards, rewards in _run(tables, hands, seed, workers, shard_size, rules):
+        for i, r in enumerate(rewards):
+            counts[i, 0] += np.bincount(upcards, minlength=11)
+            counts[i, 1] += np.bincount(upcards, weights=r > 0, minlength=11).astype(np.int64)
+        if len(rewards) == 2:
+            diff = rewards[0] - rewards[1]
+            diff_sum += float(diff.sum())
+            diff_sq_sum += float((diff * diff).sum())
+    return [Evaluation(c[0], c[1]) for c in counts], diff_sum, diff_sq_sum
+
+
+def evaluate(policy, hands=1000000, seed=0, workers=1, shard_size=100000, rules=None):
+    """
+    Win rate of a policy
+
+    :param policy:  a policy function or action table (see batch.policy_table)
+    :param hands:   the number of hands to play
+    :param seed:    the seed shared by all shards; the same seed deals the same cards
+    :param workers: the number of worker processes
+    :param rules:   a rules.RuleSet, by default rules.DEFAULT_RULES
+    :return:        an Evaluation
+    """
+    evaluations, _, _ = _evaluate([policy_table(policy)], hands, seed, workers, shard_size, rules)
+    return evaluations[0]
+
+
+def compare(policy_a, policy_b, hands=1000000, seed=0, workers=1, shard_size=100000, rules=None):
+    # Evaluate two policies on the same hands, see Comparison
+    tables = [policy_table(policy_a), policy_table(policy_b)]
+    (a, b), diff_sum, diff_sq_sum = _evaluate(tables, hands, seed, workers, shard_size, rules)
+    return Comparison(a, b, hands, diff_sum, diff_sq_sum)
+
+
+def load_policy(name):
+    # "default", "optimal", or the path of a saved Agent for its greedy Q policy
+    from ai import Agent
+    if name == "default":
+        return Agent.default_policy
+    if name == "optimal":
+        return optimal_policy()
+    agent = Agent()
+    # Only the greedy actions are used, whatever discount the Q values were trained with
+    agent.load(name, mmap_mode="r", check_discount=False)
+    return greedy_actions(agent.tables.Q_values)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate Blackjack policies')
+    parser.add_argument('policy', help='"default", "optimal", or a saved Agent file for its greedy Q policy')
+    parser.add_argument('--compare', help='a second policy to compare with on the same hands')
+    parser.add_argument('--hands', '-n', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', '-w', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--shard-size', type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.compare:
+        result = compare(load_policy(args.policy), load_policy(args.compare), args.hands, args.seed,
+                         args.workers, args.shard_size)
+    else:
+        result = evaluate(load_policy(args.policy), args.hands, args.seed, args.workers, args.shard_size)
+    print(result.report())
@@ -1,10 +1,36 @@
-import copy
 import random
+import itertools
+from time import perf_counter
 
+from rules import DEFAULT_RULES
+from rng import LegacyRNG
+
+# Actions. Their ids are the same whatever the rules, see ActionSpace
 HIT = 0
 STAND = 1
+DOUBLE = 2
+SPLIT = 3
+SURRENDER = 4
+ACTION_NAMES = ("Hit", "Stand", "Double", "Split", "Surrender")
+
+# Phases of a hand, the extra state entry that tells which actions are legal
+LATER = 0           # Three cards or more
+FIRST = 1           # The first two cards
+PAIR = 2            # The first two cards, of the same value
+SPLIT_FIRST = 3     # The first two cards of a split hand
+NUM_PHASES = 4
+
+# Outcomes of a hand, the second entry of the terminal states when the states have phases:
+# the stake, and whether the hand was a 21 on the first two cards (wins) or surrendered (losses)
+STAKE_1 = 0
+STAKE_2 = 1
+STAKE_4 = 2
+SPECIAL = 3
+OUTCOMES = (STAKE_1, STAKE_2, STAKE_4, SPECIAL)
+STAKE_OUTCOMES = {1: STAKE_1, 2: STAKE_2, 4: STAKE_4}
 
-ranks = [
+# The deck and the states are built once at import, as tuples, since nothing changes them
+ranks = (
     "ace",
     "2",
     "3",
@@ -18,18 +44,15 @@ ranks = [
     "jack",
     "queen",
     "king",
-]
-suits = [
+)
+suits = (
     "clubs",
     "spades",
     "diamonds",
     "hearts",
-]
+)
 
-cards = []
-for rank in ranks:
-    for suit in suits:
-        cards.append((rank, suit))
+cards = tuple((rank, suit) for rank in ranks for suit in suits)
 
 '''
     State representation: (user_sum, user_has_Ace, dealer_first)
@@ -44,29 +67,258 @@ for rank in ranks:
 WIN_STATE = (0,0,0)
 LOSE_STATE = (1,0,0)
 
-states = []
-states.append(WIN_STATE)
-states.append(LOSE_STATE)
-for user_sum in range(2,21):
-    for user_A_active in range(0,2):
-        for dealer_first in range(1,11):
-            s = (user_sum, user_A_active, dealer_first)
-            states.append(s)
+states = (WIN_STATE, LOSE_STATE) + tuple((user_sum, user_A_active, dealer_first)
+                                         for user_sum in range(2,21)
+                                         for user_A_active in range(0,2)
+                                         for dealer_first in range(1,11))
+
+
+class StateIndex:
+    """
+    Maps the entries of `states` to contiguous ints, so that per-state values can be kept in
+    arrays instead of dicts. The encoding is plain arithmetic and follows the order of `states`:
+        - WIN_STATE is 0 and LOSE_STATE is 1
+        - (user_sum, user_A_active, dealer_first) is 2 + (user_sum - 2) * 20 + user_A_active * 10 + dealer_first - 1
+    """
+    count_range = None
+    phases = False
+
+    def __init__(self):
+        self.states = states
+
+    def __len__(self):
+        return len(self.states)
+
+    def encode(self, state):
+        user_sum, user_A_active, dealer_first = state
+        if user_sum < 2:
+            # WIN_STATE or LOSE_STATE
+            return user_sum
+        return 2 + (user_sum - 2) * 20 + user_A_active * 10 + dealer_first - 1
+
+    @staticmethod
+    def encode_parts(user_sum, user_A_active, dealer_first):
+        # Index of a non-terminal state from its parts; also works on NumPy arrays
+        return 2 + (user_sum - 2) * 20 + user_A_active * 10 + dealer_first - 1
+
+    def decode(self, idx):
+        return self.states[idx]
+
+state_index = StateIndex()
+
+
+class ExtendedStateIndex(StateIndex):
+    """
+    StateIndex of the states extended with extra entries after dealer_first, in this order:
+        - phase, when `phases` is True: which actions the hand allows, see ActionSpace
+        - true_count, when count_range = (low, high) is given: the true count of a Shoe,
+          rounded and clipped to low..high
+    Every non-terminal state of `states` is followed by all the combinations of its extra entries:
+        - terminals + ((user_sum - 2) * 20 + user_A_active * 10 + dealer_first - 1) * size + extra
+    where `extra` numbers the combinations of extra entries in order.
+
+    With phases, hands can end with different rewards, so the terminal states are split by
+    outcome (see OUTCOMES): (0, outcome, 0) for wins and (1, outcome, 0) for losses, with
+    WIN_STATE and LOSE_STATE as outcome 0. Without phases the only terminal states are
+    WIN_STATE and LOSE_STATE.
+    """
+    def __init__(self, count_range=None, phases=False):
+        self.count_range = tuple(count_range) if count_range is not None else None
+        self.phases = phases
+        self.outcomes = len(OUTCOMES) if phases else 1
+        self.terminals = 2 * self.outcomes
+        ranges = []
+        if phases:
+            ranges.append(range(NUM_PHASES))
+        if count_range is not None:
+            self.low, self.high = count_range
+            ranges.append(range(self.low, self.high + 1))
+        self.lows = [r.start for r in ranges]
+        self.lengths = [len(r) for r in ranges]
+        self.size = 1
+        for n in self.lengths:
+            self.size *= n
+        self.states = [(lost, outcome, 0) for lost in (0, 1) for outcome in range(self.outcomes)]
+        self.states += [s + extra for s in states[2:] for extra in itertools.product(*ranges)]
+
+    def encode(self, state):
+        if state[0] < 2:
+            # A terminal state
+            return state[0] * self.outcomes + state[1]
+        user_sum, user_A_active, dealer_first = state[0], state[1], state[2]
+        extra = 0
+        for value, low, n in zip(state[3:], self.lows, self.lengths):
+            extra = extra * n + value - low
+        return self.terminals + ((user_sum - 2) * 20 + user_A_active * 10 + dealer_first - 1) * self.size + extra
+
+    def bucket(self, true_count):
+        # The true_count entry of a state for a true count
+        return min(max(round(true_count), self.low), self.high)
+
+
+def make_index(count_range=None, phases=False):
+    # state_index, or an ExtendedStateIndex when the states have extra entries
+    if count_range is None and not phases:
+        return state_index
+    return ExtendedStateIndex(count_range, phases)
 
                 
+# Value of each rank, where A counts as 1
+RANK_VALUES = {rank: 1 if rank == "ace" else 10 if rank in ("jack", "queen", "king") else int(rank) for rank in ranks}
+# Index of each card in `cards`
+CARD_IDS = {card: i for i, card in enumerate(cards)}
+CARD_INDICES = range(len(cards))
+
+
 def get_amt(card):
-    rank, _ = card
-    if rank == "ace":
-        return 1
-    elif rank in ["jack", "queen", "king"]:
-        return 10
-    # else    
-    return int(rank)
+    return RANK_VALUES[card[0]]
+
+
+# Hi-Lo count of each rank: +1 for 2 to 6, 0 for 7 to 9, -1 for 10s and Aces
+HI_LO = {
+    "ace": -1, "2": 1, "3": 1, "4": 1, "5": 1, "6": 1, "7": 0,
+    "8": 0, "9": 0, "10": -1, "jack": -1, "queen": -1, "king": -1,
+}
+
+
+class Shoe:
+    """
+    A finite shoe of `decks` decks, dealt without replacement.
+
+    The shoe is a list of card indices into `cards` that is shuffled in place with its own
+    random.Random, and dealt by advancing a cursor, so dealing never allocates. Once the cursor
+    passes the cut card (the `penetration` fraction of the shoe), the shoe is reshuffled before
+    the next round. The Hi-Lo running count of the visible cards is kept as cards are dealt; a
+    card dealt face down is counted when it is revealed.
+    """
+    def __init__(self, decks=6, penetration=0.75, seed=None):
+        if not 0 < penetration < 1:
+            raise ValueError(f"the penetration must be between 0 and 1, not {penetration}")
+        self.decks = decks
+        self.penetration = penetration
+        self.order = list(range(len(cards))) * decks
+        self.cut = int(len(self.order) * penetration)
+        self.rng = random.Random(seed)
+        self.shuffle()
+
+    def shuffle(self):
+        self.rng.shuffle(self.order)
+        self.cursor = 0
+        self.running_count = 0
+        self.hidden = None
+
+    def start_round(self):
+        # Reshuffle between rounds once the cut card is reached
+        if self.cursor >= self.cut:
+            self.shuffle()
+
+    def deal(self, visible=True):
+        # Deal the next card, face up or face down
+        if self.cursor == len(self.order):
+            # Out of cards in the middle of a round
+            self.shuffle()
+        card = cards[self.order[self.cursor]]
+        self.cursor += 1
+        if visible:
+            self.running_count += HI_LO[card[0]]
+        else:
+            self.hidden = card
+        return card
+
+    def reveal(self):
+        # Count the card dealt face down, unless the shoe was reshuffled since
+        if self.hidden is not None:
+            self.running_count += HI_LO[self.hidden[0]]
+            self.hidden = None
+
+    def true_count(self):
+        # The running count per deck left in the shoe. Once the last card is dealt, the next
+        # one comes from a reshuffled shoe, whose count is 0
+        left = len(self.order) - self.cursor
+        return self.running_count * len(cards) / left if left else 0
+
+    def getstate(self):
+        # JSON-serializable state of the shoe, e.g. for checkpoints
+        return {"rng": self.rng.getstate(), "order": list(self.order), "cursor": self.cursor,
+                "running_count": self.running_count, "hidden": self.hidden}
+
+    def setstate(self, state):
+        version, internal, gauss_next = state["rng"]
+        self.rng.setstate((version, tuple(internal), gauss_next))
+        self.order[:] = state["order"]
+        self.cursor = state["cursor"]
+        self.running_count = state["running_count"]
+        self.hidden = tuple(state["hidden"]) if state["hidden"] else None
+
+
+# Actions allowed in each phase, when the rules allow them at all
+PHASE_ACTIONS = {
+    LATER: (HIT, STAND),
+    FIRST: (HIT, STAND, DOUBLE, SURRENDER),
+    PAIR: (HIT, STAND, DOUBLE, SPLIT, SURRENDER),
+    SPLIT_FIRST: (HIT, STAND, DOUBLE),
+}
+
+
+class ActionSpace:
+    """
+    The actions of a Game under a RuleSet.
+
+    Actions keep their ids whatever the rules, and Q tables have num_actions columns, one per
+    id up to the largest action the rules allow; the other columns are never legal. With only
+    HIT and STAND every state allows both, as do WIN_STATE and LOSE_STATE. With more actions,
+    the states get a phase entry (see ExtendedStateIndex) and legal_actions depends on it.
+    """
+    def __init__(self, rules):
+        allowed = [HIT, STAND]
+        for action, allow in ((DOUBLE, rules.double), (SPLIT, rules.split), (SURRENDER, rules.surrender)):
+            if allow:
+                allowed.append(action)
+        self.actions = tuple(allowed)
+        self.num_actions = max(allowed) + 1
+        self.phases = len(allowed) > 2
+        self.by_phase = [tuple(a for a in PHASE_ACTIONS[phase] if a in allowed) for phase in range(NUM_PHASES)]
+
+    def legal_actions(self, state):
+        if not self.phases or state[0] < 2:
+            return (HIT, STAND)
+        return self.by_phase[state[3]]
+
+    def legal_table(self, index):
+        # legal_actions of every state, by state index
+        return [self.legal_actions(s) for s in index.states]
+
 
 class Game:
-    def __init__(self):
+    def __init__(self, shoe=None, count_range=None, rules=None, rng=None, fast=False):
+        """
+        :param shoe:        a Shoe to deal from, or None for an infinite deck
+        :param count_range: (low, high) to add the true count of the shoe to the states, see
+                            ExtendedStateIndex
+        :param rules:       a rules.RuleSet, by default rules.DEFAULT_RULES
+        :param rng:         the random stream of the infinite deck (see rng.py), by default
+                            the global `random` module
+        :param fast:        step with the precomputed tables of transitions.py. The game plays
+                            and draws exactly as without them, but only hit and stand are
+                            supported, without true-count states
+        """
+        if count_range is not None and shoe is None:
+            raise ValueError("the true count needs a shoe")
+        self.shoe = shoe
+        self.rng = rng if rng is not None else LegacyRNG()
+        self.rules = rules if rules is not None else DEFAULT_RULES
+        self.actions = ActionSpace(self.rules)
+        self.index = make_index(count_range, self.actions.phases)
+        self.counting = count_range is not None
+        self.extended = self.counting or self.actions.phases
+        self.tracked = shoe is not None or self.actions.phases     # See __end_round
         self.winNum = 0
         self.loseNum = 0
+        self.recorder = None    # An episodelog.EpisodeWriter logging the simulated episodes
+        self.stats = None       # An instrument.Stats, when instrumentation is on
+        self.fast = fast
+        if fast:
+            self.__use_transitions()
         self.reset()
 
     def reset(self):
@@ -74,6 +326,15 @@ class Game:
         self.userCard = []
         self.dealCard = []
         self.stand = False
+        self.stake = 1              # Doubled by DOUBLE and SPLIT
+        self.split_hand = False
+        self.surrendered = False
+        if self.recorder is not None:
+            self.recorder.abandon()
+        if self.shoe is not None:
+            # The hidden card of an unfinished round is shown too
+            self.shoe.reveal()
+            self.shoe.start_round()
         self.init_cards(self.userCard, self.dealCard)
         
     def init_cards(self, uList, dList):
@@ -88,7 +349,7 @@ class Game:
         dealer_A += card_A
         card_3, card_A = self.__gen_card(uList)
         user_A += card_A
-        card_4, card_A = self.__gen_card(dList)
+        card_4, card_A = self.__gen_card(dList, visible=False)
         dealer_A += card_A
 
         # Sum of user's cards
@@ -104,16 +365,20 @@ class Game:
 
         # The state includes only information visible to the player
         self.state = self.make_state()
+        self.__end_round()
 
     def game_over(self):
-        return self.stand or self.state == WIN_STATE or self.state == LOSE_STATE
+        # Terminal states have a user_sum of 0 (win) or 1 (loss)
+        return self.stand or self.state[0] < 2
 
-    @staticmethod
-    def __gen_card(xList):
+    def __gen_card(self, xList, visible=True):
         # Generate and remove an card to append to xList.
         # Return the card, and whether the card is an Ace
         cA = 0
-        card = random.choice(cards)
+        if self.shoe is None:
+            card = self.rng.choice(cards)
+        else:
+            card = self.shoe.deal(visible)
         xList.append(card)
         if card[0] == 'ace':
             cA = 1
@@ -124,6 +389,10 @@ class Game:
         actual_user_sum, user_A_active = self.calculate_hand(self.user_sum, self.user_A)
         actual_dealer_sum, _ = self.calculate_hand(self.__dealer_sum, self.__dealer_A)
 
+        # If dealer peeks and has 21 with the first two cards, the round is over
+        if self.rules.dealer_peeks and actual_dealer_sum == 21 and len(self.dealCard) == 2:
+            return LOSE_STATE
+
         # If user gets 21, user wins unless dealer also gets 21
         if actual_user_sum == 21:
             if actual_dealer_sum == 21:
@@ -141,9 +410,43 @@ class Game:
                 return WIN_STATE
             return LOSE_STATE
 
-        # Otherwise, return the state representation (see line 36 for explaination)
+        # Otherwise, return the state representation (see the docstring of `states`)
+        if self.extended:
+            return self.__extend((self.user_sum, user_A_active, self.dealer_first))
         return (self.user_sum, user_A_active, self.dealer_first)
 
+    def __extend(self, state):
+        # Add the extra entries of ExtendedStateIndex
+        if self.actions.phases:
+            state += (self.phase(),)
+        if self.counting:
+            state += (self.index.bucket(self.shoe.true_count()),)
+        return state
+
+    def phase(self):
+        if len(self.userCard) != 2:
+            return LATER
+        if self.split_hand:
+            return SPLIT_FIRST
+        if self.rules.split and get_amt(self.userCard[0]) == get_amt(self.userCard[1]):
+            return PAIR
+        return FIRST
+
+    def __end_round(self):
+        if not self.tracked or not self.game_over():
+            return
+        # The dealer's hidden card is seen, and counted, once the round is over
+        if self.shoe is not None:
+            self.shoe.reveal()
+        # The terminal state tells the outcome, see ExtendedStateIndex
+        if self.actions.phases and self.state[0] < 2:
+            special = self.natural() if self.state[0] == 0 else self.surrendered
+            self.state = (self.state[0], SPECIAL if special else STAKE_OUTCOMES[self.stake], 0)
+
+    def natural(self):
+        # Whether the hand is a 21 on the first two cards, which ends the round at the deal
+        return len(self.userCard) == 2 and not self.stand and not self.split_hand
+
     def act_hit(self):
         # Give player a card
         card, cA = self.__gen_card(self.userCard)
@@ -152,6 +455,9 @@ class Game:
         
         # Make state based on the updated user cards
         self.state = self.make_state()
+        self.__end_round()
+        if self.stats is not None:
+            self.stats.count("game.hits")
 
     @staticmethod
     def calculate_hand(card_sum, card_A):
@@ -163,34 +469,174 @@ class Game:
         return actual_sum, A_active
 
     def act_stand(self):
-        # H17 rule: if dealer's cards contain A's, there is always one A that's counted as 11
-        actual_dealer_sum, _ = self.calculate_hand(self.__dealer_sum, self.__dealer_A)
+        # If dealer's cards contain A's, there is always one A that's counted as 11 when possible
+        actual_dealer_sum, dealer_A_active = self.calculate_hand(self.__dealer_sum, self.__dealer_A)
         actual_user_sum, _ = self.calculate_hand(self.user_sum, self.user_A)
+        dealer_cards = len(self.dealCard)
 
         if actual_dealer_sum != 21:
-            # Dealer stops when it reaches 17 or it reaches user's card value
-            while actual_dealer_sum < actual_user_sum and actual_dealer_sum < 17:
+            # Dealer stops when it reaches 17 (see RuleSet.hit_soft_17) or, by default, when it
+            # reaches user's card value
+            dealer_stands = self.rules.dealer_stands
+            while not dealer_stands(actual_dealer_sum, dealer_A_active, actual_user_sum):
                 card, cA = self.__gen_card(self.dealCard)
                 self.__dealer_A += cA
                 self.__dealer_sum += get_amt(card)
-                actual_dealer_sum, _ = self.calculate_hand(self.__dealer_sum, self.__dealer_A)
+                actual_dealer_sum, dealer_A_active = self.calculate_hand(self.__dealer_sum, self.__dealer_A)
         
         # Make state based on the updated cards
         self.stand = True
         self.state = self.make_state()
+        self.__end_round()
+        if self.stats is not None:
+            self.stats.count("game.stands")
+            self.stats.count("game.dealer_draws", len(self.dealCard) - dealer_cards)
     
+    def __use_transitions(self):
+        # Replace act_hit and act_stand with lookups in the tables of transitions.py
+        if self.extended:
+            raise ValueError("the fast mode only supports hit and stand, without true-count states")
+        from transitions import transition_table, CARD_VALUES, CARD_RANKS
+        table = transition_table(self.rules)
+        states = self.index.states
+        # Next state by rank, by state, for dealer hands without and with 21
+        self.__hit = [{states[i]: [states[j] for j in row] for i, row in enumerate(hit.tolist()) if row[0] >= 0}
+                      for hit in table.hit]
+        self.__deal = [[[[states[j] for j in row] for row in by_first] for by_first in deal] for deal in table.deal.tolist()]
+        self.__stops = table.stops.tolist()
+        self.__values = CARD_VALUES
+        self.__ranks = CARD_RANKS
+        self.init_cards = self.__fast_init_cards
+        self.act_hit = self.__fast_hit
+        self.act_stand = self.__fast_stand
+
+    def __draw(self, xList, visible=True):
+        # Like __gen_card, but return the index of the card in `cards`
+        if self.shoe is None:
+            c = self.rng.choice(CARD_INDICES)
+            xList.append(cards[c])
+            return c
+        card = self.shoe.deal(visible)
+        xList.append(card)
+        return CARD_IDS[card]
+
+    def __fast_init_cards(self, uList, dList):
+        # init_cards with a lookup of the first state
+        if self.shoe is None:
+            choice = self.rng.choice
+            c1, c2, c3, c4 = choice(CARD_INDICES), choice(CARD_INDICES), choice(CARD_INDICES), choice(CARD_INDICES)
+            uList += cards[c1], cards[c3]
+            dList += cards[c2], cards[c4]
+        else:
+            draw = self.__draw
+            c1, c2, c3, c4 = draw(uList), draw(dList), draw(uList), draw(dList, visible=False)
+        values = self.__values
+        v1, v2, v3, v4 = values[c1], values[c2], values[c3], values[c4]
+        self.user_sum = v1 + v3
+        self.user_A = (v1 == 1) + (v3 == 1)
+        self.__dealer_sum = v2 + v4
+        self.__dealer_A = (v2 == 1) + (v4 == 1)
+        self.dealer_first = v2
+
+        dealer_21 = self.__dealer_sum == 11 and self.__dealer_A > 0
+        if dealer_21 and self.rules.dealer_peeks:
+            self.state = LOSE_STATE
+        else:
+            self.state = self.__deal[dealer_21][v1][v2][self.__ranks[c3]]
+        self.__end_round()
+
+    def __fast_hit(self):
+        # act_hit with a lookup of the next state
+        if self.state[0] < 2:
+            return Game.act_hit(self)
+        c = self.__draw(self.userCard)
+        value = self.__values[c]
+        self.user_A += value == 1
+        self.user_sum += value
+        # With two cards, the dealer has 21 with an Ace and a 10
+        dealer_21 = self.__dealer_sum == 11 and self.__dealer_A > 0
+        self.state = self.__hit[dealer_21][self.state][self.__ranks[c]]
+        self.__end_round()
+        if self.stats is not None:
+            self.stats.count("game.hits")
+
+    def __fast_stand(self):
+        # act_stand with a lookup of whether the dealer stops
+        if self.state[0] < 2:
+            return Game.act_stand(self)
+        user_total = self.state[0] + 10 * self.state[1]
+        stops = self.__stops[user_total]
+        values = self.__values
+        dealer_sum, dealer_A = self.__dealer_sum, self.__dealer_A
+        dealer_cards = len(self.dealCard)
+        while not stops[dealer_sum][dealer_A > 0]:
+            value = values[self.__draw(self.dealCard)]
+            dealer_sum += value
+            dealer_A += value == 1
+        self.__dealer_sum, self.__dealer_A = dealer_sum, dealer_A
+
+        dealer_total = dealer_sum + 10 if dealer_A and dealer_sum <= 11 else dealer_sum
+        self.stand = True
+        self.state = WIN_STATE if dealer_total > 21 or user_total > dealer_total else LOSE_STATE
+        self.__end_round()
+        if self.stats is not None:
+            self.stats.count("game.stands")
+            self.stats.count("game.dealer_draws", len(self.dealCard) - dealer_cards)
+
+    def act_double(self):
+        # Double the stake, take exactly one more card and stand
+        self.stake *= 2
+        self.act_hit()
+        if not self.game_over():
+            self.act_stand()
+
+    def act_split(self):
+        # Double the stake and replace the second card of the pair, see rules.py
+        card = self.userCard.pop()
+        self.user_sum -= get_amt(card)
+        self.user_A -= card[0] == 'ace'
+        self.stake *= 2
+        self.split_hand = True
+        self.act_hit()
+
+    def act_surrender(self):
+        # Give up the hand for half the stake
+        self.surrendered = True
+        self.state = LOSE_STATE
+        self.__end_round()
+
+    def act(self, action):
+        # Perform an action, see ActionSpace
+        if action == HIT:
+            self.act_hit()
+        elif action == STAND:
+            self.act_stand()
+        else:
+            if self.game_over() or action not in self.actions.legal_actions(self.state):
+                raise ValueError(f"{ACTION_NAMES[action]} is not allowed in state {self.state}")
+            if action == DOUBLE:
+                self.act_double()
+            elif action == SPLIT:
+                self.act_split()
+            else:
+                self.act_surrender()
+
     def update_stats(self):
-        if self.state == WIN_STATE:
+        if self.state[0] == 0:
             self.winNum += 1
-        elif self.state == LOSE_STATE:
+        elif self.state[0] == 1:
             self.loseNum += 1
     
     def check_reward(self):
         if not self.game_over():
             return 0
-        if self.state == WIN_STATE:
-            return 1       
-        return -1
+        if self.state[0] == 0:
+            if self.natural():
+                return self.rules.blackjack_payout
+            return self.stake
+        if self.surrendered:
+            return -self.stake / 2
+        return -self.stake
     
     def simulate_sequence(self, policy):
         """
@@ -199,6 +645,9 @@ class Game:
         :param policy:  the policy function that gives an action based on user's sum 
         :return:        a sequence of states from the original state to terminal
         """
+        stats = self.stats
+        if stats is not None:
+            start = perf_counter()
         episode = []
 
         while not self.game_over():
@@ -207,18 +656,28 @@ class Game:
 
             # Pick an action based on policy
             action = policy(self.state)
+            if self.recorder is not None:
+                self.__record(action)
 
             # Perform action
-            if action == HIT:
-                self.act_hit()
-            elif action == STAND:
-                self.act_stand()
+            self.act(action)
         
         # Add the terminal state
         episode.append((self.state, self.check_reward()))
+        if self.recorder is not None:
+            self.__record(0)
 
+        if stats is not None:
+            stats.add_time("game.simulate_sequence", perf_counter() - start)
         return episode
 
+    def __record(self, action):
+        # Log the current state, the action taken in it and its reward, ending the episode
+        # at a terminal state
+        self.recorder.step(self.state, action, self.check_reward())
+        if self.game_over():
+            self.recorder.end_episode()
+
     def simulate_one_step(self, action):
         """
         Simulate one step based on the passed in action
@@ -227,14 +686,21 @@ class Game:
         :return: a sequence of states from the original state to terminal
         """
 
+        stats = self.stats
+        if stats is not None:
+            start = perf_counter()
+        if self.recorder is not None:
+            self.__record(action)
+
         # If the current state is already terminal, return None
         if self.game_over():
-            return None, self.check_reward()
-        
-        # Perform action based on the parameter
-        if action == HIT:
-            self.act_hit()
-        elif action == STAND:
-            self.act_stand()
-        
-        return self.state, self.check_reward()
\ No newline at end of file
+            result = None, self.check_reward()
+        else:
+            # Perform action based on the parameter
+            self.act(action)
+            result = self.state, self.check_reward()
+
+        if stats is not None:
+            stats.add_time("game.step", perf_counter() - start)
+            stats.episode_steps += 1
+        return result
\ No newline at end of file
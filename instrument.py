@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+'''
+    Opt-in instrumentation of Game and Agent.
+
+    A Stats object collects
+        - counters, e.g. "game.hits", "game.dealer_draws", "TD.updates"
+        - timers, as the number of calls and the total seconds, e.g. "game.step", "agent.save"
+        - histograms, e.g. "Q.episode_length"
+    Game and Agent only touch it through `if self.stats is not None` checks, so with the
+    default stats of None the hot paths pay one attribute test per step or per episode.
+    Agent.enable_stats() turns it on for an Agent and its Game.
+
+    StatsDumper appends the stats to a JSON lines file every so often during training, and
+    SamplingProfiler samples the stack of a thread at a fixed interval and writes the samples
+    in the collapsed stack format of flamegraph.pl and speedscope, one "frame;frame;frame count"
+    line per distinct stack.
+'''
+
+
+class Stats:
+    def __init__(self):
+        self.counters = {}          # name -> count
+        self.timers = {}            # name -> [calls, seconds]
+        self.histograms = {}        # name -> {value: count}
+        self.episode_steps = 0      # Steps of the current episode, counted by Game.simulate_one_step
+        self.started = time.perf_counter()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def observe(self, name, value):
+        histogram = self.histograms.setdefault(name, {})
+        histogram[value] = histogram.get(value, 0) + 1
+
+    def end_episode(self, algorithm, length=None):
+        """
+        Count an episode of algorithm and its table updates, one per state
+
+        :param length:  the number of states of the episode, by default the steps counted by
+                        Game.simulate_one_step since the last episode
+        """
+        if length is None:
+            length = self.episode_steps
+        self.episode_steps = 0
+        self.count(f"{algorithm}.episodes")
+        self.count(f"{algorithm}.updates", length)
+        self.observe(f"{algorithm}.episode_length", length)
+
+    def to_dict(self):
+        return {
+            "elapsed": time.perf_counter() - self.started,
+            "counters": dict(self.counters),
+            "timers": {name: {"calls": calls, "seconds": seconds, "mean": seconds / calls}
+                       for name, (calls, seconds) in self.timers.items()},
+            "histograms": {name: {str(value): n for value, n in sorted(histogram.items())}
+                           for name, histogram in self.histograms.items()},
+        }
+
+    def report(self):
+        lines = [f"Stats over {time.perf_counter() - self.started:.1f}s"]
+        for name, n in sorted(self.counters.items()):
+            lines.append(f"  {name:28} {n:14d}")
+        for name, (calls, seconds) in sorted(self.timers.items()):
+            lines.append(f"  {name:28} {calls:14d} calls {seconds:10.3f}s {seconds / calls * 1e6:10.2f}us/call")
+        for name, histogram in sorted(self.histograms.items()):
+            total = sum(histogram.values())
+            mean = sum(value * n for value, n in histogram.items()) / total
+            counts = " ".join(f"{value}:{n}" for value, n in sorted(histogram.items()))
+            lines.append(f"  {name:28} mean {mean:.3f}  {counts}")
+        return "\n".join(lines)
+
+
+class StatsDumper:
+    def __init__(self, stats, filename, every_seconds=10):
+        """
+        :param stats:           the Stats to dump
+        :param filename:        the JSON lines file the dumps are appended to
+        :param every_seconds:   dump at most this often
+        """
+        self.stats = stats
+        self.filename = filename
+        self.every_seconds = every_seconds
+        self.last_time = time.monotonic()
+
+    def maybe_dump(self, episode):
+        if time.monotonic() - self.last_time >= self.every_seconds:
+            self.dump(episode)
+
+    def dump(self, episode):
+        with open(self.filename, "a") as file:
+            file.write(json.dumps(dict(self.stats.to_dict(), episode=episode)) + "\n")
+        self.last_time = time.monotonic()
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005, duration=None, thread=None):
+        """
+        :param interval:    the seconds between two samples
+        :param duration:    stop sampling after this many seconds, or run until stop()
+        :param thread:      the threading.Thread to sample, by default the one that creates the profiler
+        """
+        self.interval = interval
+        self.duration = duration
+        self.target = (thread or threading.current_thread()).ident
+        self.samples = {}           # collapsed stack -> number of samples
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.__loop, daemon=True)
+
+    def start(self):
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    def __loop(self):
+        end = None if self.duration is None else time.perf_counter() + self.duration
+        while not self.stopped.wait(self.interval):
+            if end is not None and time.perf_counter() >= end:
+                return
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def write(self, filename):
+        # Write the samples as collapsed stacks, e.g. for `flamegraph.pl filename > profile.svg`
+        with open(filename, "w") as file:
+            for stack, n in sorted(self.samples.items()):
+                file.write(f"{stack} {n}\n")
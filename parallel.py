@@ -0,0 +1,156 @@
+import multiprocessing
+
+import numpy as np
+
+from ai import Agent
+from game import Game, Shoe
+from rng import FastRNG
+
+'''
+    Multi-process training for Agent.MC_run, TD_run and Q_run.
+
+    Training runs in rounds. In each round every worker process gets a copy of the tables it
+    needs, the learning parameters of the Agent and the configuration of its Game (see
+    game_config), plays up to sync_interval episodes with its own Game and its own
+    rng.FastRNG stream, and sends back what it learned. The parent then merges the results
+    in worker order:
+        - MC: workers start from empty S_MC/SS_MC/N_MC and the parent adds their sums and counts,
+          so the merge is exact.
+        - TD/Q: workers start from the parent's values and counts (so alpha(n) continues where
+          it was) and the parent replaces each value by the average of the workers' values,
+          weighted by how many times each worker visited it in the round. TD values are
+          weighted by state visits and Q values by state-action visits. Values that no worker
+          visited are left unchanged.
+
+    A worker with a shoe deals from a new Shoe of the same size and penetration in every round,
+    shuffled from its stream, so the count of the parent's shoe isn't carried over.
+
+    The stream of every (worker, round) task is a child of np.random.SeedSequence(seed), so the
+    result only depends on the master seed, the worker count and sync_interval, not on how
+    the pool schedules the tasks.
+'''
+ALGORITHMS = ("MC", "TD", "Q")
+
+
+def game_config(game):
+    # What a worker needs to build a Game like game
+    shoe = game.shoe
+    return {"rules": game.rules, "fast": game.fast,
+            "shoe": (shoe.decks, shoe.penetration) if shoe is not None else None,
+            "count_range": game.index.count_range if game.counting else None}
+
+
+def _make_game(config, rng):
+    shoe = None
+    if config["shoe"] is not None:
+        decks, penetration = config["shoe"]
+        shoe = Shoe(decks, penetration, seed=rng.randint(0, 2**32 - 1))
+    return Game(shoe, config["count_range"], config["rules"], rng, config["fast"])
+
+
+class _CountingAgent(Agent):
+    # Agent that also counts the visits of each state-action pair, used to merge Q values
+    def __init__(self, game=None, rng=None, **parameters):
+        super().__init__(game, rng=rng, **parameters)
+        self.N_SA = np.zeros(self.tables.Q_values.shape, dtype=np.int64)
+
+    def pick_action(self, s, epsilon):
+        a = super().pick_action(s, epsilon)
+        self.N_SA[self.index.encode(s), a] += 1
+        return a
+
+
+def _work(task):
+    algorithm, num_episodes, seed_seq, values, counts, parameters, config = task
+    rng = FastRNG(seed_seq)
+    game = _make_game(config, rng)
+
+    if algorithm == "MC":
+        agent = Agent(game, rng=rng, **parameters)
+        agent.MC_run(num_episodes)
+        return agent.tables.S_MC, agent.tables.SS_MC, agent.tables.N_MC
+
+    if algorithm == "TD":
+        agent = Agent(game, rng=rng, **parameters)
+        agent.tables.TD_values[:] = values
+        agent.tables.N_TD[:] = counts
+        agent.TD_run(num_episodes)
+        return agent.tables.TD_values, agent.tables.N_TD - counts
+
+    agent = _CountingAgent(game, rng, **parameters)
+    agent.tables.Q_values[:] = values
+    agent.tables.N_Q[:] = counts
+    agent.Q_run(num_episodes)
+    return agent.tables.Q_values, agent.tables.N_Q - counts, agent.N_SA
+
+
+def _merge_average(values, results, weights):
+    # Average of the workers' values weighted by their visits; unvisited entries are unchanged
+    total = sum(weights)
+    weighted = sum(w * v for w, v in zip(weights, results))
+    visited = total > 0
+    values[visited] = weighted[visited] / total[visited]
+
+
+def _merge(tables, algorithm, results):
+    if algorithm == "MC":
+        for S, SS, N in results:
+            tables.S_MC += S
+            tables.SS_MC += SS
+            tables.N_MC += N
+        visited = tables.N_MC > 0
+        tables.MC_values[visited] = tables.S_MC[visited] / tables.N_MC[visited]
+
+    elif algorithm == "TD":
+        counts = [n for _, n in results]
+        _merge_average(tables.TD_values, [v for v, _ in results], counts)
+        tables.N_TD += sum(counts)
+
+    else:
+        _merge_average(tables.Q_values, [q for q, _, _ in results], [n_sa for _, _, n_sa in results])
+        tables.N_Q += sum(n for _, n, _ in results)
+
+
+def parallel_run(agent, algorithm, num_episodes, workers=2, sync_interval=10000, seed=0):
+    """
+    Train agent's tables with MC_run, TD_run or Q_run in several processes
+
+    :param agent:           the Agent whose tables are updated in place
+    :param algorithm:       "MC", "TD" or "Q"
+    :param num_episodes:    the total number of episodes over all workers
+    :param workers:         the number of worker processes
+    :param sync_interval:   the number of episodes each worker plays between two merges
+    :param seed:            the master seed of all the workers' random streams
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"unknown algorithm {algorithm!r}, expected one of {ALGORITHMS}")
+
+    tables = agent.tables
+    config = game_config(agent.simulator)
+    streams = np.random.SeedSequence(seed).spawn(workers)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        remaining = num_episodes
+        while remaining > 0:
+            round_episodes = min(remaining, sync_interval * workers)
+            remaining -= round_episodes
+
+            if algorithm == "MC":
+                values, counts = None, None
+            elif algorithm == "TD":
+                values, counts = tables.TD_values, tables.N_TD
+            else:
+                values, counts = tables.Q_values, tables.N_Q
+
+            tasks = []
+            for w, stream in enumerate(streams):
+                # Split the round evenly, giving the remainder to the first workers
+                episodes = round_episodes // workers + (w < round_episodes % workers)
+                tasks.append((algorithm, episodes, stream.spawn(1)[0], values, counts, agent.parameters(), config))
+
+            results = pool.map(_work, tasks) if pool else list(map(_work, tasks))
+            _merge(tables, algorithm, results)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
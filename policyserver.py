@@ -0,0 +1,463 @@
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import struct
+import asyncio
+
+import numpy as np
+
+from game import ActionSpace
+from rules import RuleSet, DEFAULT_RULES
+from tables import legal_mask
+from snapshot import load_snapshot
+from checkpoint import latest_checkpoint
+from convergence import greedy_actions
+
+'''
+    Policy server: one process holds a trained Agent snapshot and answers the state -> action
+    and state -> Q values queries of many clients over a Unix or localhost TCP socket.
+
+    The protocol is binary and little-endian. On connecting, the server sends HELLO:
+        - MAGIC (8 bytes) and the protocol version
+        - the number of entries of a state, of actions (Q values per state) and of states
+        - the generation of the policy, which goes up by one on every reload
+    A request is a REQUEST struct (request id, op, number of states) followed by the states,
+    each as `width` int8 entries, e.g. (user_sum, user_A_active, dealer_first). The response
+    is a RESPONSE struct (request id, op, status, generation, number of states) followed by
+        - OP_ACTIONS:   one uint8 action per state, UNKNOWN_ACTION for states that aren't in
+                        the policy's state index
+        - OP_Q_VALUES:  num_actions float64 Q values per state, NaN for unknown states
+    Responses come back in the order of the requests of a connection, so clients can pipeline.
+
+    Requests of all connections go through one queue. The batcher takes every request that is
+    waiting (up to max_batch states, after waiting at most max_delay seconds for more), and
+    answers them all with one vectorized lookup: states are encoded to state indices through
+    a dense lookup array, and actions come from the greedy actions of the Q values, worked out
+    once per policy (see convergence.greedy_actions).
+
+    The policy is reloaded, without closing any connection, when its snapshot changes (or a
+    newer checkpoint shows up when serving a checkpoint directory) and on SIGHUP. A snapshot
+    with a different state layout or number of actions is refused and the old policy kept.
+
+        python policyserver.py serve saved --unix /tmp/blackjack.sock
+        python policyserver.py load --unix /tmp/blackjack.sock --connections 16 --batch 32
+'''
+MAGIC = b"BJPOLICY"
+VERSION = 1
+HELLO = struct.Struct("<8sHBBII")
+REQUEST = struct.Struct("<IBI")
+RESPONSE = struct.Struct("<IBBII")
+
+# Ops of a request
+OP_ACTIONS = 1
+OP_Q_VALUES = 2
+
+# Status of a response
+OK = 0
+BAD_REQUEST = 1
+
+UNKNOWN_ACTION = 255
+HOST = "127.0.0.1"
+PORT = 8765
+MAX_BATCH = 65536           # States answered by one lookup
+MAX_REQUEST = 65536         # States in one request
+RELOAD_INTERVAL = 1.0
+
+
+class PolicyError(ValueError):
+    pass
+
+
+class Policy:
+    def __init__(self, tables, rules=DEFAULT_RULES, generation=0, path=None):
+        """
+        The greedy policy and Q values of Agent tables, for lookups by batches of states
+
+        :param tables:      a tables.Tables, e.g. from snapshot.load_snapshot
+        :param rules:       the rules.RuleSet the tables were trained with, for the legal actions
+        """
+        actions = ActionSpace(rules)
+        if tables.Q_values.shape[1] != actions.num_actions:
+            raise PolicyError(f"the tables have {tables.Q_values.shape[1]} actions, the rules have {actions.num_actions}")
+        self.index = tables.index
+        self.rules = rules
+        self.generation = generation
+        self.path = path
+        self.num_actions = actions.num_actions
+        self.Q_values = np.ascontiguousarray(tables.Q_values, dtype=np.float64)
+        self.actions = greedy_actions(self.Q_values, None if actions.num_actions == 2 else legal_mask(self.index, actions))
+        self.actions = self.actions.astype(np.uint8)
+
+        # Dense lookup from the entries of a state, less their smallest values, to its index.
+        # Terminal states of an ExtendedStateIndex are shorter, and are padded with zeros; they
+        # don't collide with the other states since their first entry is below 2
+        self.width = max(len(s) for s in self.index.states)
+        entries = np.array([s + (0,) * (self.width - len(s)) for s in self.index.states], dtype=np.int64)
+        self.lows = entries.min(axis=0)
+        self.dims = tuple(int(d) for d in entries.max(axis=0) - self.lows + 1)
+        self.lookup = np.full(int(np.prod(self.dims)), -1, dtype=np.int64)
+        self.lookup[np.ravel_multi_index((entries - self.lows).T, self.dims)] = np.arange(len(entries))
+
+    @staticmethod
+    def load(path, rules=DEFAULT_RULES, generation=0):
+        tables, _ = load_snapshot(path)
+        return Policy(tables, rules, generation, path)
+
+    def layout(self):
+        return self.width, self.num_actions, len(self.index)
+
+    def encode(self, states):
+        """
+        :param states:  an int (n, width) array of states
+        :return:        their state indices, -1 for states that aren't in the index
+        """
+        offsets = states.astype(np.int64) - self.lows
+        inside = np.all((offsets >= 0) & (offsets < self.dims), axis=1)
+        idx = np.full(len(states), -1, dtype=np.int64)
+        if inside.any():
+            idx[inside] = self.lookup[np.ravel_multi_index(offsets[inside].T, self.dims)]
+        return idx
+
+    def decide(self, idx):
+        return np.where(idx >= 0, self.actions[idx], UNKNOWN_ACTION).astype(np.uint8)
+
+    def q_values(self, idx):
+        return np.where((idx >= 0)[:, None], self.Q_values[idx], np.nan)
+
+
+class PolicyServer:
+    def __init__(self, path, rules=DEFAULT_RULES, max_batch=MAX_BATCH, max_delay=0.0,
+                 reload_interval=RELOAD_INTERVAL, log=None):
+        """
+        :param path:            a snapshot, or a checkpoint directory to serve its latest checkpoint
+        :param rules:           the rules.RuleSet the snapshots were trained with
+        :param max_batch:       answer at most this many states with one lookup
+        :param max_delay:       after the first request of a batch, wait up to this many seconds
+                                for more requests to join it
+        :param reload_interval: the seconds between checks for a new snapshot, 0 to only
+                                reload on SIGHUP
+        :param log:             a function of one message, by default printing to stderr
+        """
+        self.path = path
+        self.rules = rules
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.reload_interval = reload_interval
+        self.log = log or (lambda message: print(message, file=sys.stderr))
+        self.policy = None
+        self.version = None     # (path, mtime, size) of the last snapshot loaded or refused
+        self.queue = None
+        self.reloading = None
+        self.connections = 0
+        self.served = 0         # States answered
+
+    def snapshot_path(self):
+        if os.path.isdir(self.path):
+            return latest_checkpoint(self.path)
+        return self.path
+
+    def snapshot_version(self):
+        path = self.snapshot_path()
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return path, stat.st_mtime_ns, stat.st_size
+
+    async def reload(self, force=False):
+        # Load the snapshot if it changed, and swap it in between two batches
+        version = self.snapshot_version()
+        if version is None or (version == self.version and not force):
+            return False
+        generation = self.policy.generation + 1 if self.policy else 0
+        loop = asyncio.get_running_loop()
+        try:
+            policy = await loop.run_in_executor(None, Policy.load, version[0], self.rules, generation)
+        except (OSError, ValueError) as e:
+            # E.g. a snapshot still being written; it is tried again once it changes
+            self.log(f"Could not load {version[0]}: {e}")
+            self.version = version
+            return False
+        if self.policy is not None and policy.layout() != self.policy.layout():
+            self.log(f"Refused {version[0]}: its layout {policy.layout()} differs from {self.policy.layout()}")
+            self.version = version
+            return False
+        self.policy, self.version = policy, version
+        self.log(f"Serving {version[0]} as generation {generation}")
+        return True
+
+    async def __watch(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.reloading.wait(), self.reload_interval or None)
+            except asyncio.TimeoutError:
+                pass
+            force = self.reloading.is_set()
+            self.reloading.clear()
+            await self.reload(force)
+
+    async def __batch(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.max_delay:
+                await asyncio.sleep(self.max_delay)
+            else:
+                # Let the connections that have data ready queue their requests
+                await asyncio.sleep(0)
+            size = len(batch[0][2])
+            while size < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                size += len(batch[-1][2])
+            self.answer(batch)
+
+    def answer(self, batch):
+        # Answer a batch of (writer, request id, states, op) with one lookup of all their states
+        policy = self.policy
+        idx = policy.encode(np.concatenate([states for _, _, states, _ in batch]))
+        actions = q_values = None
+        if any(op == OP_ACTIONS for _, _, _, op in batch):
+            actions = policy.decide(idx)
+        if any(op == OP_Q_VALUES for _, _, _, op in batch):
+            q_values = policy.q_values(idx)
+        start = 0
+        for writer, request_id, states, op in batch:
+            end = start + len(states)
+            payload = actions[start:end] if op == OP_ACTIONS else q_values[start:end]
+            writer.write(RESPONSE.pack(request_id, op, OK, policy.generation, len(states)) + payload.tobytes())
+            start = end
+        self.served += len(idx)
+
+    async def handle(self, reader, writer):
+        width, num_actions, num_states = self.policy.layout()
+        writer.write(HELLO.pack(MAGIC, VERSION, width, num_actions, num_states, self.policy.generation))
+        self.connections += 1
+        try:
+            while True:
+                request_id, op, count = REQUEST.unpack(await reader.readexactly(REQUEST.size))
+                if op not in (OP_ACTIONS, OP_Q_VALUES) or count > MAX_REQUEST:
+                    writer.write(RESPONSE.pack(request_id, op, BAD_REQUEST, self.policy.generation, 0))
+                    # The states that follow can't be skipped safely, so the connection ends
+                    await writer.drain()
+                    break
+                data = await reader.readexactly(count * width)
+                states = np.frombuffer(data, dtype=np.int8).reshape(count, width)
+                self.queue.put_nowait((writer, request_id, states, op))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def serve(self, unix=None, host=HOST, port=PORT, ready=None):
+        """
+        Serve until cancelled
+
+        :param unix:    the path of a Unix socket to listen on, instead of host and port
+        :param ready:   an optional asyncio.Event set once the server listens
+        """
+        self.queue = asyncio.Queue()
+        self.reloading = asyncio.Event()
+        if not await self.reload(force=True):
+            raise PolicyError(f"no snapshot to serve at {self.path}")
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.reloading.set)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            pass
+        if unix:
+            if os.path.exists(unix):
+                os.unlink(unix)
+            server = await asyncio.start_unix_server(self.handle, unix)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        tasks = [asyncio.ensure_future(self.__batch()), asyncio.ensure_future(self.__watch())]
+        self.log(f"Listening on {unix or f'{host}:{port}'}")
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if unix and os.path.exists(unix):
+                os.unlink(unix)
+
+
+def _check_hello(data):
+    magic, version, width, num_actions, num_states, generation = HELLO.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        raise PolicyError("not a policy server of this protocol version")
+    return width, num_actions, num_states, generation
+
+
+def _request(request_id, op, states, width):
+    states = np.asarray(states, dtype=np.int8).reshape(-1, width)
+    return REQUEST.pack(request_id, op, len(states)) + states.tobytes()
+
+
+def _payload_size(op, count, num_actions):
+    return count if op == OP_ACTIONS else count * num_actions * 8
+
+
+def _parse(op, payload, count, num_actions):
+    if op == OP_ACTIONS:
+        return np.frombuffer(payload, dtype=np.uint8)
+    return np.frombuffer(payload, dtype=np.float64).reshape(count, num_actions)
+
+
+class PolicyClient:
+    def __init__(self, unix=None, host=HOST, port=PORT, timeout=None):
+        """
+        A blocking client of a PolicyServer, e.g. for a table bot
+
+        :param unix:    the path of the server's Unix socket, instead of host and port
+        """
+        if unix:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.settimeout(timeout)
+            self.socket.connect(unix)
+        else:
+            self.socket = socket.create_connection((host, port), timeout)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.width, self.num_actions, self.num_states, self.generation = _check_hello(self.__read(HELLO.size))
+        self.next_id = 0
+
+    def __read(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.socket.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("the policy server closed the connection")
+            data += chunk
+        return bytes(data)
+
+    def __query(self, op, states):
+        self.next_id += 1
+        self.socket.sendall(_request(self.next_id, op, states, self.width))
+        request_id, op, status, self.generation, count = RESPONSE.unpack(self.__read(RESPONSE.size))
+        if status != OK:
+            raise PolicyError(f"the policy server refused request {request_id}")
+        return _parse(op, self.__read(_payload_size(op, count, self.num_actions)), count, self.num_actions)
+
+    def actions(self, states):
+        # The greedy action of every state, UNKNOWN_ACTION for states the policy doesn't have
+        return self.__query(OP_ACTIONS, states)
+
+    def q_values(self, states):
+        # A (len(states), num_actions) array of the Q values of every state
+        return self.__query(OP_Q_VALUES, states)
+
+    def decide(self, state):
+        # The action of a single state, like Agent.autoplay_decision
+        return int(self.actions([state])[0])
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def _connect(unix, host, port):
+    if unix:
+        return await asyncio.open_unix_connection(unix)
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return reader, writer
+
+
+async def load_test(unix=None, host=HOST, port=PORT, connections=8, batch=16, seconds=10.0, op=OP_ACTIONS, seed=0):
+    """
+    Query a PolicyServer from many connections at once, each sending one request at a time
+
+    :param batch:   the states of every request, drawn at random from the non-terminal states
+    :return:        a dict with the requests, states, elapsed seconds, throughput and the
+                    p50/p90/p99/max latency of the requests in milliseconds
+    """
+    latencies = []
+    generator = np.random.default_rng(seed)
+
+    async def client(k):
+        reader, writer = await _connect(unix, host, port)
+        width, num_actions, _, _ = _check_hello(await reader.readexactly(HELLO.size))
+        # Non-terminal states of the basic layout, with 0 for any extra entries
+        states = np.zeros((batch, width), dtype=np.int8)
+        states[:, 0] = generator.integers(2, 21, batch)
+        states[:, 1] = generator.integers(0, 2, batch)
+        states[:, 2] = generator.integers(1, 11, batch)
+        size = _payload_size(op, batch, num_actions)
+        request_id = 0
+        try:
+            while time.perf_counter() < end:
+                request_id += 1
+                start = time.perf_counter()
+                writer.write(_request(request_id, op, states, width))
+                _, _, status, _, count = RESPONSE.unpack(await reader.readexactly(RESPONSE.size))
+                if status != OK:
+                    raise PolicyError(f"the policy server refused request {request_id} of connection {k}")
+                await reader.readexactly(size)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    end = start + seconds
+    await asyncio.gather(*(client(k) for k in range(connections)))
+    elapsed = time.perf_counter() - start
+    if not latencies:
+        raise PolicyError("no request was answered")
+    p50, p90, p99 = (float(x) * 1e3 for x in np.percentile(latencies, [50, 90, 99]))
+    return {"requests": len(latencies), "states": len(latencies) * batch, "seconds": elapsed,
+            "requests_per_second": len(latencies) / elapsed, "states_per_second": len(latencies) * batch / elapsed,
+            "p50_ms": p50, "p90_ms": p90, "p99_ms": p99, "max_ms": max(latencies) * 1e3}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve a trained policy to many clients')
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="serve a snapshot, or the latest checkpoint of a directory")
+    serve.add_argument("path")
+    serve.add_argument("--rules", type=json.loads, default={},
+                       help='the rules the snapshot was trained with, as JSON, e.g. \'{"double": true}\'')
+    serve.add_argument("--max-batch", type=int, default=MAX_BATCH, help="most states answered by one lookup")
+    serve.add_argument("--max-delay", type=float, default=0.0, help="seconds a batch waits for more requests")
+    serve.add_argument("--reload-interval", type=float, default=RELOAD_INTERVAL,
+                       help="seconds between checks for a new snapshot, 0 to only reload on SIGHUP")
+    load = commands.add_parser("load", help="generate load and report latency and throughput")
+    load.add_argument("--connections", "-c", type=int, default=8)
+    load.add_argument("--batch", "-b", type=int, default=16, help="states per request")
+    load.add_argument("--seconds", "-s", type=float, default=10.0)
+    load.add_argument("--q-values", action="store_true", help="query Q values instead of actions")
+    load.add_argument("--seed", type=int, default=0)
+    for command in (serve, load):
+        command.add_argument("--unix", help="a Unix socket path, instead of --host and --port")
+        command.add_argument("--host", default=HOST)
+        command.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+
+    try:
+        if args.command == "serve":
+            server = PolicyServer(args.path, RuleSet(**args.rules), args.max_batch, args.max_delay, args.reload_interval)
+            asyncio.run(server.serve(args.unix, args.host, args.port))
+        else:
+            op = OP_Q_VALUES if args.q_values else OP_ACTIONS
+            result = asyncio.run(load_test(args.unix, args.host, args.port, args.connections, args.batch,
+                                           args.seconds, op, args.seed))
+            print(f"{result['requests']} requests, {result['states']} states in {result['seconds']:.1f}s: "
+                  f"{result['requests_per_second']:.0f} requests/s, {result['states_per_second']:.0f} states/s")
+            print(f"latency p50 {result['p50_ms']:.3f}ms  p90 {result['p90_ms']:.3f}ms  "
+                  f"p99 {result['p99_ms']:.3f}ms  max {result['max_ms']:.3f}ms")
+    except KeyboardInterrupt:
+        pass
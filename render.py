@@ -0,0 +1,301 @@
+import os
+import time
+
+import pygame
+
+from game import cards, WIN_STATE
+
+'''
+    Drawing of the Blackjack board for main.GameRunner.
+
+    Everything that never changes (the background, the Hit and Stand buttons, the instructions
+    and the frame of the info box) is drawn once into Board.background. The rest of the board
+    is split into regions that don't overlap, each with a fixed rect and a key: the content it
+    shows, e.g. the text of an info line or the user's cards. Board.render only redraws the
+    regions whose key changed since the last frame (restoring the background under them first,
+    clipped to their rect), and only passes their rects to pygame.display.update. Label
+    surfaces come from a LabelCache keyed by their text and color, so a label that shows the
+    same text again isn't rendered again.
+
+    With the "dummy" SDL video driver the board renders without a window, which is how
+    bench.py and `python render.py` time frames:
+
+        python render.py --frames 2000
+'''
+BLACK = (0,0,0)
+WHITE = (255,255,255)
+BLUE = (0,0,139)
+GREEN = (0x44,0xff,0x44)
+RED = (0xff, 0x44, 0x44)
+BACKGROUND = (0x00, 0x62, 0xbe)
+
+SCREEN_SIZE = (640, 480)
+PADDING = 5
+
+GAME_OVER_TEXT_POS = (240, 20)
+
+OPS_BTN_Y = 430
+OPS_TXT_Y = OPS_BTN_Y + 3
+
+OPS_INSTR_X = 10
+OPS_INSTR_Y = 460
+
+OPS_BTN_HEIGHT = 23
+
+USR_CARD_HEIGHT = 275
+
+INFO_BOX = (10, 170, 600, 95)
+INFO_LINES_Y = (180, 200, 220, 240)
+
+# Toggle buttons: x and width of the button, x of its label and the label text
+TOGGLES = {
+    "MC": (180, 75, 190, '[M]C - '),
+    "TD": (265, 75, 277, '[T]D - '),
+    "QL": (350, 75, 359, '[Q]L - '),
+    "play": (435, 115, 444, '[A]uto Play - '),
+}
+MODES = ("off", "on")
+BUTTON_COLORS = (RED, GREEN)
+
+
+def draw_label_hl(surface, pos, label, padding=PADDING, bg=WHITE, wd=2, border=True):
+    specs = [(bg, 0)]
+    if border:
+        specs += [(BLACK, wd)]
+    for color, width in specs:
+        x = pos[0] - padding
+        y = pos[1] - padding
+        w = label.get_width() + padding * 2
+        h = label.get_height() + padding * 2
+        pygame.draw.rect(surface, color, (x, y, w, h), width)
+
+
+def load_cards(path='resources'):
+    # The image of every card, and the image of the back of a card
+    card_imgs = {card: pygame.image.load(os.path.join(path, 'cards', f"{card[0]}_{card[1]}.png")) for card in cards}
+    return card_imgs, pygame.image.load(os.path.join(path, 'cardback.png'))
+
+
+class LabelCache:
+    def __init__(self, font, max_size=1024):
+        """
+        Rendered text surfaces, keyed by their text and color
+
+        :param max_size:    the number of labels kept; the cache starts over when it is full,
+                            since labels of values that changed are rarely shown again
+        """
+        self.font = font
+        self.max_size = max_size
+        self.labels = {}
+
+    def __call__(self, text, color):
+        label = self.labels.get((text, color))
+        if label is None:
+            if len(self.labels) >= self.max_size:
+                self.labels.clear()
+            label = self.labels[text, color] = self.font.render(text, 1, color)
+        return label
+
+
+class Board:
+    def __init__(self, screen, font, card_imgs, card_back):
+        self.screen = screen
+        self.label = LabelCache(font)
+        self.card_imgs = card_imgs
+        self.card_back = card_back
+
+        # Buttons, for clicks
+        self.hitB = pygame.Rect(10, OPS_BTN_Y, 75, OPS_BTN_HEIGHT)
+        self.standB = pygame.Rect(95, OPS_BTN_Y, 75, OPS_BTN_HEIGHT)
+        self.toggles = {name: pygame.Rect(x, OPS_BTN_Y, w, OPS_BTN_HEIGHT) for name, (x, w, _, _) in TOGGLES.items()}
+
+        self.background = pygame.Surface(screen.get_size()).convert()
+        self.background.fill(BACKGROUND)
+        pygame.draw.rect(self.background, WHITE, self.hitB)
+        pygame.draw.rect(self.background, WHITE, self.standB)
+        self.background.blit(self.label('[H]it', BLACK), (37, OPS_TXT_Y))
+        self.background.blit(self.label('[S]tand', BLACK), (113, OPS_TXT_Y))
+        self.background.blit(self.label('Click on the button or type the initial character of the operation to play '
+                                        'or toggle modes', BLACK), (OPS_INSTR_X, OPS_INSTR_Y))
+        for width, color in [(0, WHITE), (2, BLACK)]:
+            pygame.draw.rect(self.background, color, INFO_BOX, width)
+        self.background.blit(self.label('Press 1 to save AI state', BLACK), (350, 380))
+        self.background.blit(self.label('Press 2 to load from AI\'s saved state', BLACK), (350, 400))
+
+        # name -> (rect, function drawing the region's key). The rects don't overlap, and a
+        # region never draws outside of its rect
+        width, height = screen.get_size()
+        self.regions = {
+            "table": (pygame.Rect(0, 0, 515, USR_CARD_HEIGHT - 115), self.draw_table),
+            "stats": (pygame.Rect(515, 18, width - 515, 80), self.draw_stats),
+            "user": (pygame.Rect(0, USR_CARD_HEIGHT, width, OPS_BTN_Y - USR_CARD_HEIGHT - 2), self.draw_user),
+        }
+        for k, y in enumerate(INFO_LINES_Y):
+            self.regions[f"info{k}"] = (pygame.Rect(INFO_BOX[0] + 2, y - 2, INFO_BOX[2] - 4, 20), self.draw_info_line(y))
+        names = list(TOGGLES)
+        for name, next_name in zip(names, names[1:] + [None]):
+            x = TOGGLES[name][0]
+            end = TOGGLES[next_name][0] if next_name else width
+            self.regions[name] = (pygame.Rect(x, OPS_BTN_Y, end - x, OPS_INSTR_Y - OPS_BTN_Y), self.draw_toggle(name))
+
+        self.keys = {}          # The key each region shows on the screen
+        self.frames = 0
+
+    def invalidate(self):
+        # Redraw the whole board on the next frame, e.g. after the window was exposed
+        self.keys = {}
+
+    def region_keys(self, game, values, modes):
+        """
+        The content of every region
+
+        :param values:  the Agent or the tables.Snapshot whose values are shown
+        :param modes:   (MC, TD, QL, auto play) switches
+        """
+        state = game.state
+        over = game.game_over() or game.stand
+        keys = {
+            "table": (tuple(game.dealCard) if over else game.dealCard[0], state == WIN_STATE if over else None),
+            "stats": (game.winNum, game.loseNum),
+            "user": tuple(game.userCard),
+            "info0": 'State (user_sum, user_has_Ace, dealer_first) ={}'.format(state),
+            "info1": 'Current state\'s (MC value, #samples): ({:f}, {})'.format(
+                values.MC_values[state],
+                values.N_MC[state]
+            ),
+            "info2": 'Current state\'s (TD value, #samples): ({:f}, {})'.format(
+                values.TD_values[state],
+                values.N_TD[state]
+            ),
+            "info3": 'Current stats\'s Q values ([Hit, Stand], #samples): ([{:f},{:f}], {})'.format(
+                values.Q_values[state][0],
+                values.Q_values[state][1],
+                values.N_Q[state],
+            ),
+        }
+        keys.update(zip(TOGGLES, (bool(on) for on in modes)))
+        return keys
+
+    def render(self, game, values, modes, full=False):
+        """
+        Draw the regions whose content changed and update them on the display
+
+        :param full:    redraw and update the whole board
+        :return:        the rects that were updated
+        """
+        if full:
+            self.invalidate()
+        keys = self.region_keys(game, values, modes)
+        if not self.keys:
+            self.screen.blit(self.background, (0, 0))
+        dirty = []
+        for name, key in keys.items():
+            if self.keys.get(name, self) == key:
+                continue
+            rect, draw = self.regions[name]
+            self.screen.set_clip(rect)
+            self.screen.blit(self.background, rect, rect)
+            draw(key)
+            dirty.append(rect)
+        self.screen.set_clip(None)
+
+        if not self.keys:
+            pygame.display.update()
+            dirty = [self.screen.get_rect()]
+        elif dirty:
+            pygame.display.update(dirty)
+        self.keys = keys
+        self.frames += 1
+        return dirty
+
+    def draw_table(self, key):
+        dealer_cards, won = key
+        if won is not None:
+            result_txt = self.label('End of Round. You WON!' if won else 'End of Round. You LOST!', RED)
+            draw_label_hl(self.screen, GAME_OVER_TEXT_POS, result_txt)
+            self.screen.blit(result_txt, GAME_OVER_TEXT_POS)
+            for i, card in enumerate(dealer_cards):
+                x = 10 + i * 20
+                self.screen.blit(self.card_imgs[card], (x, 10))
+        else:
+            self.screen.blit(self.card_imgs[dealer_cards], (10, 10))
+            self.screen.blit(self.card_back, (30, 10))
+
+    def draw_stats(self, key):
+        wins, losses = key
+        if losses == 0 and wins == 0:
+            win_rate = 0.
+        else:
+            win_rate = wins / (wins + losses)
+        self.screen.blit(self.label('Wins: {}'.format(wins), WHITE), (520, 23))
+        self.screen.blit(self.label('Losses: {}'.format(losses), WHITE), (520, 48))
+        self.screen.blit(self.label('Win rate: {:.2f}%'.format(win_rate * 100), WHITE), (520, 73))
+
+    def draw_user(self, key):
+        for i, card in enumerate(key):
+            x = 10 + i * 20
+            self.screen.blit(self.card_imgs[card], (x, USR_CARD_HEIGHT))
+
+    def draw_info_line(self, y):
+        def draw(text):
+            self.screen.blit(self.label(text, BLACK), (20, y))
+        return draw
+
+    def draw_toggle(self, name):
+        _, _, label_x, text = TOGGLES[name]
+
+        def draw(on):
+            pygame.draw.rect(self.screen, BUTTON_COLORS[on], self.toggles[name])
+            self.screen.blit(self.label(text + MODES[on], BLUE), (label_x, OPS_TXT_Y))
+        return draw
+
+
+def headless_board(path='resources'):
+    # A Board on a window-less display, for benchmarks
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.init()
+    screen = pygame.display.set_mode(SCREEN_SIZE)
+    return Board(screen, pygame.font.SysFont("arial", 15), *load_cards(path))
+
+
+def frame_times(board, agent, frames, full=False, hand_every=30):
+    """
+    Time frames of board while agent learns, as they are drawn in the GUI
+
+    Between two frames the values of the current state change as if one TD update had been
+    done, and every hand_every frames a new hand is dealt, so most frames redraw a few regions
+    and some redraw most of them.
+
+    :param full:    redraw and update the whole board on every frame, as GameRunner used to
+    :return:        the seconds of every frame
+    """
+    game = agent.simulator
+    game.reset()
+    times = []
+    for frame in range(frames):
+        if frame % hand_every == 0:
+            game.reset()
+        i = agent.index.encode(game.state)
+        agent.tables.N_TD[i] += 1
+        agent.tables.TD_values[i] += 0.001
+        start = time.perf_counter()
+        board.render(game, agent, (False, True, False, False), full)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+if __name__ == '__main__':
+    import argparse
+    import statistics
+
+    from ai import Agent
+
+    parser = argparse.ArgumentParser(description='Time the drawing of the board, without a window')
+    parser.add_argument('--frames', '-n', type=int, default=2000)
+    args = parser.parse_args()
+
+    board = headless_board()
+    for full in (False, True):
+        times = sorted(frame_times(board, Agent(), args.frames, full))
+        print(f"{'full' if full else 'dirty regions':14} mean {statistics.mean(times) * 1e3:.3f}ms  "
+              f"p50 {times[len(times) // 2] * 1e3:.3f}ms  p99 {times[int(len(times) * 0.99)] * 1e3:.3f}ms")
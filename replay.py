@@ -0,0 +1,289 @@
+import multiprocessing
+
+import numpy as np
+
+from ai import Agent, DISCOUNT, ALPHA
+from rng import FastRNG
+
+'''
+    Experience replay for TD and Q-learning.
+
+    A ReplayBuffer is a ring buffer of transitions (state, action, reward, next_state, done)
+    held in preallocated arrays, with states stored by state index. `reward` is the reward of
+    `state` (see Game.check_reward), and `done` marks the transitions out of a terminal state,
+    whose next_state is meaningless and whose next value is 0.
+
+    Simulation fills the buffer (fill(), optionally in worker processes), and the learner
+    drains it in minibatches with td_update() and q_update(). The targets of a minibatch are
+    computed from the values before it, and its updates are then applied as one vectorized
+    scatter: the updates of a state that shows up several times in the batch are composed in
+    closed form, each with the alpha(n) of its own visit, exactly as the one-at-a-time loops
+    of Agent.TD_run and Agent.Q_run would apply them. A minibatch of size 1 repeats TD_run on
+    the same transitions, up to rounding.
+
+    Buffers are saved to and loaded from .npz files, so episodes simulated once can be replayed
+    to compare algorithms and learning rates without simulating them again.
+'''
+CAPACITY = 1000000
+BATCH_SIZE = 256
+
+
+class ReplayBuffer:
+    def __init__(self, capacity=CAPACITY, num_states=None):
+        """
+        :param capacity:    the number of transitions kept; the oldest are overwritten first
+        :param num_states:  the number of states of the index the transitions are encoded with,
+                            checked when replaying into an Agent
+        """
+        self.capacity = capacity
+        self.num_states = num_states
+        self.state = np.zeros(capacity, dtype=np.int32)
+        self.action = np.zeros(capacity, dtype=np.int8)
+        self.reward = np.zeros(capacity)
+        self.next_state = np.zeros(capacity, dtype=np.int32)
+        self.done = np.zeros(capacity, dtype=bool)
+        self.pos = 0        # Where the next transition goes
+        self.size = 0       # The number of transitions held
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, state, action, reward, next_state, done):
+        # Append arrays of transitions, overwriting the oldest ones once the buffer is full
+        n = len(state)
+        if n > self.capacity:
+            state, action, reward, next_state, done = (a[n - self.capacity:] for a in (state, action, reward, next_state, done))
+            n = self.capacity
+        slots = (self.pos + np.arange(n)) % self.capacity
+        self.state[slots] = state
+        self.action[slots] = action
+        self.reward[slots] = reward
+        self.next_state[slots] = next_state
+        self.done[slots] = done
+        self.pos = (self.pos + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def order(self):
+        # Slots of the held transitions, oldest first
+        return (self.pos - self.size + np.arange(self.size)) % self.capacity
+
+    def batch(self, slots):
+        return self.state[slots], self.action[slots], self.reward[slots], self.next_state[slots], self.done[slots]
+
+    def batches(self, batch_size=BATCH_SIZE):
+        # All the held transitions in minibatches, oldest first
+        order = self.order()
+        for start in range(0, self.size, batch_size):
+            yield self.batch(order[start:start + batch_size])
+
+    def sample(self, batch_size, generator):
+        # A minibatch drawn uniformly with replacement, with a np.random.Generator
+        return self.batch(self.order()[generator.integers(0, self.size, batch_size)])
+
+    def fill(self, agent, num_episodes, epsilon=None, workers=1, seed=0):
+        """
+        Simulate episodes with agent's Game and add their transitions
+
+        :param epsilon:     None to follow Agent.default_policy (for TD), or the exploration
+                            rate of the epsilon-greedy policy of agent's Q values (for Q-learning)
+        :param workers:     the number of worker processes. Workers play the default Game with
+                            agent's rules, each with its own rng.FastRNG stream from seed
+        """
+        if self.num_states is None:
+            self.num_states = len(agent.index)
+        if workers <= 1:
+            self.extend(*simulate(agent, num_episodes, epsilon))
+            return
+        if agent.simulator.tracked:
+            raise ValueError("worker processes can only fill from the default infinite-deck Game")
+        Q_values = agent.tables.Q_values if epsilon is not None else None
+        tasks = [(num_episodes // workers + (w < num_episodes % workers), epsilon, stream, agent.rules, Q_values)
+                 for w, stream in enumerate(np.random.SeedSequence(seed).spawn(workers))]
+        with multiprocessing.Pool(workers) as pool:
+            for transitions in pool.map(_work, tasks):
+                self.extend(*transitions)
+
+    def save(self, filename):
+        # Write the held transitions, oldest first, to an .npz file
+        order = self.order()
+        np.savez_compressed(filename, capacity=self.capacity, num_states=-1 if self.num_states is None else self.num_states,
+                            state=self.state[order], action=self.action[order], reward=self.reward[order],
+                            next_state=self.next_state[order], done=self.done[order])
+
+    @staticmethod
+    def load(filename, capacity=None):
+        # A ReplayBuffer with the transitions of a file written by save()
+        with np.load(filename) as data:
+            num_states = int(data["num_states"])
+            buffer = ReplayBuffer(capacity or int(data["capacity"]), None if num_states < 0 else num_states)
+            buffer.extend(data["state"], data["action"], data["reward"], data["next_state"], data["done"])
+        return buffer
+
+
+def simulate(agent, num_episodes, epsilon=None):
+    """
+    Transitions of num_episodes episodes played by agent's Game
+
+    :param epsilon: see ReplayBuffer.fill
+    :return:        the arrays (state, action, reward, next_state, done)
+    """
+    game = agent.simulator
+    encode = agent.index.encode
+    policy = agent.default_policy
+    transitions = []
+    for _ in range(num_episodes):
+        game.reset()
+        s = game.state
+        reward = game.check_reward()
+        while s is not None:
+            a = policy(s) if epsilon is None else agent.pick_action(s, epsilon)
+            next_s, hold = game.simulate_one_step(a)
+            done = next_s is None
+            transitions.append((encode(s), a, reward, 0 if done else encode(next_s), done))
+            reward = hold
+            s = next_s
+
+    if not transitions:
+        return np.zeros(0, np.int32), np.zeros(0, np.int8), np.zeros(0), np.zeros(0, np.int32), np.zeros(0, bool)
+    state, action, reward, next_state, done = zip(*transitions)
+    return (np.array(state, dtype=np.int32), np.array(action, dtype=np.int8), np.array(reward, dtype=float),
+            np.array(next_state, dtype=np.int32), np.array(done, dtype=bool))
+
+
+def _work(task):
+    num_episodes, epsilon, seed_seq, rules, Q_values = task
+    agent = Agent(rules=rules, rng=FastRNG(seed_seq))
+    if Q_values is not None:
+        agent.tables.Q_values[:] = Q_values
+    return simulate(agent, num_episodes, epsilon)
+
+
+def _runs(keys):
+    # The order that sorts keys, and the start of every run of equal keys in that order
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    return order, sorted_keys, starts
+
+
+def _visits(state, counts):
+    # The visit number n of every transition of the batch: the count of its state before the
+    # batch, plus one for every earlier transition from the same state in the batch
+    order, sorted_state, starts = _runs(state)
+    occurrence = np.arange(len(state)) - np.repeat(starts, np.diff(np.r_[starts, len(state)]))
+    n = np.empty(len(state), dtype=np.int64)
+    n[order] = counts[sorted_state] + occurrence + 1
+    return n
+
+
+def _apply(values, keys, n, targets, alpha=ALPHA):
+    """
+    Apply the updates v += alpha(n) * (target - v) of a batch to the flat array values, in batch
+    order for every key, with the learning rate schedule alpha. k updates of the same key compose to
+        v * prod(1 - alpha_m) + sum over m of alpha_m * target_m * prod over l > m of (1 - alpha_l)
+    which is computed with cumulative sums of log(1 - alpha) along every run of equal keys.
+    """
+    order, sorted_keys, starts = _runs(keys)
+    alpha = alpha(n[order])
+    # An alpha of 1, as on a first visit with an AlphaSchedule or with a constant rate of 1,
+    # replaces the old value and the updates of its key before it in the batch. Its factor
+    # 1 - alpha of 0 is left out of the logs, and the updates it replaces are dropped instead.
+    replaced_here = alpha == 1
+    replaced = np.logical_or.reduceat(replaced_here, starts)
+    log_keep = np.log1p(-np.where(replaced_here, 0, alpha))
+
+    cum = np.cumsum(log_keep)
+    ends = np.r_[starts[1:], len(keys)] - 1
+    run = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(keys)]))
+    later = cum[ends][run] - cum
+    replacements = np.cumsum(replaced_here)
+    superseded = replacements[ends][run] > replacements
+    added = np.add.reduceat(np.where(superseded, 0, alpha * targets[order] * np.exp(later)), starts)
+    kept = np.where(replaced, 0, np.exp(cum[ends] - np.r_[0, cum][starts]))
+
+    unique = sorted_keys[starts]
+    values[unique] = values[unique] * kept + added
+
+
+def td_update(tables, batch, discount=DISCOUNT, alpha=ALPHA):
+    # Apply a minibatch of transitions to TD_values and N_TD, with targets from the values
+    # before the batch
+    state, _, reward, next_state, done = batch
+    values, counts = tables.TD_values, tables.N_TD
+    targets = reward + discount * np.where(done, 0, values[next_state])
+    n = _visits(state, counts)
+    _apply(values, state, n, targets, alpha)
+    np.add.at(counts, state, 1)
+
+
+def q_update(tables, batch, mask=None, discount=DISCOUNT, alpha=ALPHA):
+    """
+    Apply a minibatch of transitions to Q_values and N_Q, with targets from the values before
+    the batch. Like Q_run, N_Q counts the visits of states, whatever the action.
+
+    :param mask:    the legal actions of every state (see tables.legal_mask), for the max over the
+                    next state's actions; all actions are legal when it is None
+    """
+    state, action, reward, next_state, done = batch
+    values, counts = tables.Q_values, tables.N_Q
+    next_Q = values[next_state] if mask is None else np.where(mask[next_state], values[next_state], -np.inf)
+    targets = reward + discount * np.where(done, 0, next_Q.max(axis=1))
+    n = _visits(state, counts)
+    num_actions = values.shape[1]
+    _apply(values.reshape(-1), state.astype(np.int64) * num_actions + action, n, targets, alpha)
+    np.add.at(counts, state, 1)
+
+
+def replay(agent, algorithm, buffer, batch_size=BATCH_SIZE):
+    """
+    Learn agent's TD or Q values from all the transitions of buffer, oldest first, with the
+    discount and learning rate of agent
+
+    :param algorithm:   "TD" or "Q"
+    """
+    if buffer.num_states is not None and buffer.num_states != len(agent.index):
+        raise ValueError(f"the buffer has {buffer.num_states} states, the agent has {len(agent.index)}")
+    if algorithm == "TD":
+        for batch in buffer.batches(batch_size):
+            td_update(agent.tables, batch, agent.discount, agent.alpha)
+    elif algorithm == "Q":
+        mask = None if agent.actions.num_actions == 2 else agent.legal_mask
+        for batch in buffer.batches(batch_size):
+            q_update(agent.tables, batch, mask, agent.discount, agent.alpha)
+    else:
+        raise ValueError(f"unknown algorithm {algorithm!r}, expected 'TD' or 'Q'")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Experience replay files')
+    commands = parser.add_subparsers(dest="command", required=True)
+    fill = commands.add_parser("fill", help="simulate episodes into a replay file")
+    fill.add_argument("file")
+    fill.add_argument("--episodes", "-n", type=int, default=100000)
+    fill.add_argument("--epsilon", type=float, help="explore with this rate from the Q values of --agent "
+                                                    "instead of following the default policy")
+    fill.add_argument("--agent", help="a saved Agent whose Q values drive the exploration")
+    fill.add_argument("--workers", "-w", type=int, default=1)
+    fill.add_argument("--seed", type=int, default=0)
+    learn = commands.add_parser("replay", help="learn TD or Q values from a replay file")
+    learn.add_argument("file")
+    learn.add_argument("--algorithm", "-a", choices=("TD", "Q"), default="TD")
+    learn.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    learn.add_argument("--output", "-o", help="save the agent to this file")
+    args = parser.parse_args()
+
+    agent = Agent()
+    if args.command == "fill":
+        if args.agent:
+            agent.load(args.agent)
+        buffer = ReplayBuffer(CAPACITY, len(agent.index))
+        buffer.fill(agent, args.episodes, args.epsilon, args.workers, args.seed)
+        buffer.save(args.file)
+        print(f"Wrote {len(buffer)} transitions to {args.file}")
+    else:
+        buffer = ReplayBuffer.load(args.file)
+        agent.replay_run(args.algorithm, buffer, args.batch_size)
+        if args.output:
+            agent.save(args.output)
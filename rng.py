@@ -0,0 +1,104 @@
+import random
+
+'''
+    Random number streams for Game and Agent.
+
+    Both take an `rng` with the same methods as the `random` module that they use:
+        - choice(seq):      a random element of seq, e.g. the next card of the infinite deck
+        - random():         a uniform float in [0, 1), e.g. for epsilon-greedy exploration
+        - randint(a, b):    a random int in a..b
+        - getstate(), setstate(state): JSON-serializable state, for checkpoints
+
+    LegacyRNG is the default. It calls the global `random` module exactly as Game and Agent
+    always have, so random.seed() still controls them and the three-step tester still sees the
+    same sequence of calls.
+
+    FastRNG draws from its own numpy.random.Generator in prefetched blocks, so most calls are
+    a list lookup. Its streams are seeded with np.random.SeedSequence, and spawn() gives
+    independent child streams, e.g. one per worker process, so that multi-process runs are
+    reproducible from a single seed. NumPy is only imported when a FastRNG is made, so that
+    Game doesn't load it.
+'''
+BLOCK = 4096
+
+
+class LegacyRNG:
+    def __init__(self):
+        # The module functions, bound once
+        self.choice = random.choice
+        self.random = random.random
+        self.randint = random.randint
+
+    def getstate(self):
+        return {"kind": "legacy", "state": random.getstate()}
+
+    def setstate(self, state):
+        version, internal, gauss_next = state["state"]
+        random.setstate((version, tuple(internal), gauss_next))
+
+
+class FastRNG:
+    def __init__(self, seed=None, block=BLOCK):
+        """
+        :param seed:    an int, a np.random.SeedSequence, or None for a fresh seed
+        :param block:   the number of values drawn from the generator at a time
+        """
+        import numpy as np
+        self.seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.generator = np.random.Generator(np.random.PCG64(self.seed_seq))
+        self.block = block
+
+        # Prefetched uniforms, and indices for choice() from sequences of length choice_n
+        self.uniforms, self.uniform_pos = [], 0
+        self.indices, self.index_pos, self.choice_n = [], 0, None
+
+    def random(self):
+        if self.uniform_pos == len(self.uniforms):
+            self.uniforms, self.uniform_pos = self.generator.random(self.block).tolist(), 0
+        u = self.uniforms[self.uniform_pos]
+        self.uniform_pos += 1
+        return u
+
+    def randint(self, a, b):
+        return a + int(self.random() * (b - a + 1))
+
+    def choice(self, seq):
+        if self.index_pos == len(self.indices) or len(seq) != self.choice_n:
+            self.choice_n = len(seq)
+            self.indices, self.index_pos = self.generator.integers(0, self.choice_n, self.block).tolist(), 0
+        i = self.indices[self.index_pos]
+        self.index_pos += 1
+        return seq[i]
+
+    def spawn(self, n):
+        # n independent child streams
+        return [FastRNG(seed_seq, self.block) for seed_seq in self.seed_seq.spawn(n)]
+
+    def getstate(self):
+        return {
+            "kind": "fast",
+            "bit_generator": self.generator.bit_generator.state,
+            "uniforms": self.uniforms[self.uniform_pos:],
+            "indices": self.indices[self.index_pos:],
+            "choice_n": self.choice_n,
+        }
+
+    def setstate(self, state):
+        self.generator.bit_generator.state = state["bit_generator"]
+        self.uniforms, self.uniform_pos = list(state["uniforms"]), 0
+        self.indices, self.index_pos = list(state["indices"]), 0
+        self.choice_n = state["choice_n"]
+
+
+def make_rng(kind="legacy", seed=None):
+    """
+    :param kind:    "legacy" for LegacyRNG, which seeds the global `random` module with seed
+                    when it is given, or "fast" for FastRNG(seed)
+    """
+    if kind == "legacy":
+        if seed is not None:
+            random.seed(seed)
+        return LegacyRNG()
+    if kind == "fast":
+        return FastRNG(seed)
+    raise ValueError(f"unknown rng {kind!r}, expected 'legacy' or 'fast'")
@@ -0,0 +1,70 @@
+import hashlib
+
+'''
+    Rule configuration of the game.
+
+    The defaults are the rules game.Game has always played:
+        - the dealer stands on soft 17 (hit_soft_17=False)
+        - the dealer also stops as soon as it reaches the user's total (dealer_stops_at_user)
+        - the dealer does not peek for 21, so a dealer 21 only shows when the round ends
+        - a user 21 made with the first two cards pays the same as any win
+    With dealer_peeks, a dealer 21 made with the first two cards ends the round as soon as the
+    cards are dealt.
+
+    The user can only hit or stand unless the rules allow more actions (see game.ActionSpace):
+        - double:       on the first two cards, double the stake, take one card and stand
+        - split:        on a pair, double the stake and play on with the first card and a new
+                        one, which has the same expected reward as playing both hands of the pair
+                        since cards are drawn with replacement. Split hands can't be split again.
+        - surrender:    on the first two cards, give up and lose half the stake
+'''
+FIELDS = ("hit_soft_17", "dealer_stops_at_user", "dealer_peeks", "blackjack_payout", "double", "split", "surrender")
+
+
+class RuleSet:
+    def __init__(self, hit_soft_17=False, dealer_stops_at_user=True, dealer_peeks=False, blackjack_payout=1,
+                 double=False, split=False, surrender=False):
+        """
+        :param hit_soft_17:             the dealer hits a soft 17 (H17) instead of standing (S17)
+        :param dealer_stops_at_user:    the dealer stops drawing once it reaches the user's total
+        :param dealer_peeks:            the dealer checks for 21 right after the deal
+        :param blackjack_payout:        the reward of a win with 21 on the first two cards, e.g. 1.5
+        :param double, split, surrender: whether the user may double down, split pairs and surrender
+        """
+        self.hit_soft_17 = hit_soft_17
+        self.dealer_stops_at_user = dealer_stops_at_user
+        self.dealer_peeks = dealer_peeks
+        self.blackjack_payout = blackjack_payout
+        self.double = double
+        self.split = split
+        self.surrender = surrender
+
+    def key(self):
+        return tuple(getattr(self, name) for name in FIELDS)
+
+    def hash(self):
+        # Stable digest of the rules, the same in every process, to key cached tables
+        return hashlib.sha1(repr(self.key()).encode()).hexdigest()[:16]
+
+    def __eq__(self, other):
+        return isinstance(other, RuleSet) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return "RuleSet(" + ", ".join(f"{name}={getattr(self, name)!r}" for name in FIELDS) + ")"
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in FIELDS}
+
+    def dealer_stands(self, actual_dealer_sum, dealer_A_active, actual_user_sum):
+        # Whether the dealer stops drawing with actual_dealer_sum against actual_user_sum
+        if self.dealer_stops_at_user and actual_dealer_sum >= actual_user_sum:
+            return True
+        if actual_dealer_sum == 17 and dealer_A_active:
+            return not self.hit_soft_17
+        return actual_dealer_sum >= 17
+
+
+DEFAULT_RULES = RuleSet()
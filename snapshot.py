@@ -0,0 +1,212 @@
+import os
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from game import state_index, make_index
+from tables import Tables, TABLE_NAMES, ALL_TABLES
+
+'''
+    Binary snapshot format of Agent tables.
+
+    A snapshot file is laid out as
+        - MAGIC (8 bytes), the schema version and the header length (two little-endian uint32)
+        - the header, a JSON object padded with spaces up to a multiple of ALIGNMENT bytes:
+            - "version":  the schema version
+            - "discount": the DISCOUNT the tables were trained with
+            - "states":   the state index layout, i.e. the state of every row
+            - "count_range", "phases": the extra entries of the states (see game.ExtendedStateIndex)
+            - "arrays":   name -> {"dtype", "shape", "offset"} of every table
+            - "checksum": CRC-32 of everything after the header
+            - "meta":     free-form JSON, e.g. for training progress
+        - the tables, in ALL_TABLES order, each starting at an offset aligned to ALIGNMENT
+
+    Since the arrays are stored raw at known offsets, a snapshot can be opened with np.memmap,
+    and many processes reading the same file share its pages instead of copying them.
+
+    The text format written by earlier versions of Agent.save (one "key value" line per state,
+    one blank line after each table) can still be read, and converted with
+        python snapshot.py convert <text file> <snapshot file>
+'''
+MAGIC = b"BJSNAP\x00\x01"
+VERSION = 1
+ALIGNMENT = 64
+PREAMBLE = struct.Struct("<8sII")
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def _align(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def is_snapshot(filename):
+    with open(filename, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def save_snapshot(filename, tables, discount, meta=None, fsync=False):
+    """
+    Write tables to a binary snapshot
+
+    :param filename:    the file to write
+    :param tables:      a tables.Tables
+    :param discount:    the DISCOUNT the tables were trained with
+    :param meta:        optional JSON-serializable data stored in the header
+    :param fsync:       flush the file to disk before returning
+    """
+    arrays = [np.ascontiguousarray(getattr(tables, name)) for name in ALL_TABLES]
+
+    # Offsets are relative to the end of the header, so they don't depend on its length
+    layout, offset = {}, 0
+    for name, array in zip(ALL_TABLES, arrays):
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+
+    payload = bytearray(offset)
+    for name, array in zip(ALL_TABLES, arrays):
+        start = layout[name]["offset"]
+        payload[start:start + array.nbytes] = array.tobytes()
+
+    header = json.dumps({
+        "version": VERSION,
+        "discount": discount,
+        "states": tables.index.states,
+        "count_range": tables.index.count_range,
+        "phases": tables.index.phases,
+        "arrays": layout,
+        "checksum": zlib.crc32(payload),
+        "meta": meta or {},
+    }, separators=(",", ":")).encode()
+    header += b" " * (_align(PREAMBLE.size + len(header)) - PREAMBLE.size - len(header))
+
+    with open(filename, "wb") as file:
+        file.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        file.write(header)
+        file.write(payload)
+        if fsync:
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def read_header(filename):
+    """
+    Read the header of a snapshot
+
+    :return:    (header dict, offset of the tables in the file)
+    """
+    with open(filename, "rb") as file:
+        magic, version, header_len = PREAMBLE.unpack(file.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise SnapshotError(f"{filename} is not a snapshot file")
+        if version > VERSION:
+            raise SnapshotError(f"{filename} has schema version {version}, newer than {VERSION}")
+        header = json.loads(file.read(header_len))
+    return header, PREAMBLE.size + header_len
+
+
+def load_snapshot(filename, mmap_mode=None, validate=True):
+    """
+    Read tables from a binary snapshot
+
+    :param filename:    the file to read
+    :param mmap_mode:   None to read the tables into memory, or a np.memmap mode: "r" for
+                        read-only tables shared between processes, "c" for copy-on-write
+    :param validate:    check the checksum of the tables
+    :return:            (tables.Tables, header dict)
+    """
+    header, start = read_header(filename)
+    count_range = header.get("count_range")
+    index = make_index(tuple(count_range) if count_range else None, header.get("phases", False))
+    if [tuple(s) for s in header["states"]] != list(index.states):
+        raise SnapshotError(f"{filename} has a different state layout")
+
+    if mmap_mode is None:
+        with open(filename, "rb") as file:
+            file.seek(start)
+            payload = np.fromfile(file, dtype=np.uint8)
+    else:
+        payload = np.memmap(filename, dtype=np.uint8, mode=mmap_mode, offset=start)
+
+    if validate and zlib.crc32(payload) != header["checksum"]:
+        raise SnapshotError(f"{filename} failed checksum validation")
+
+    # Tables missing from older snapshots start empty
+    tables = Tables(index)
+    for name in ALL_TABLES:
+        spec = header["arrays"].get(name)
+        if spec is None:
+            continue
+        array = np.ndarray(tuple(spec["shape"]), np.dtype(spec["dtype"]), payload, spec["offset"])
+        setattr(tables, name, array)
+    return tables, header
+
+
+def write_text(filename, tables):
+    # Write tables in the text format of earlier versions of Agent.save
+    with open(filename, "w") as file:
+        for name in TABLE_NAMES:
+            for key, entry in zip(tables.index.states, getattr(tables, name).tolist()):
+                key_str = str(key).replace(" ", "")
+                entry_str = str(entry).replace(" ", "")
+                file.write(f"{key_str} {entry_str}\n")
+            file.write("\n")
+
+
+def read_text(filename, index=state_index):
+    """
+    Read tables from the text format of earlier versions of Agent.save, without eval()
+
+    :param index:   the game.StateIndex of the states in the file
+    """
+    with open(filename) as file:
+        blocks = file.read().strip("\n").split("\n\n")
+    if len(blocks) != len(TABLE_NAMES):
+        raise SnapshotError(f"{filename} has {len(blocks)} tables, expected {len(TABLE_NAMES)}")
+    blocks = [[line.split(" ") for line in block.split("\n")] for block in blocks]
+
+    # One Q value per action
+    num_actions = blocks[TABLE_NAMES.index("Q_values")][0][1].count(",") + 1
+    tables = Tables(index, num_actions)
+    encode = tables.index.encode
+
+    for name, block in zip(TABLE_NAMES, blocks):
+        array = getattr(tables, name)
+        for key_str, entry_str in block:
+            key = tuple(int(x) for x in key_str[1:-1].split(","))
+            if entry_str.startswith("["):
+                array[encode(key)] = [float(x) for x in entry_str[1:-1].split(",")]
+            else:
+                array[encode(key)] = float(entry_str)
+    return tables
+
+
+def convert_text(src, dst, discount):
+    # Convert a text file from earlier versions of Agent.save to a snapshot
+    save_snapshot(dst, read_text(src), discount, meta={"converted_from": src})
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from ai import DISCOUNT
+
+    parser = argparse.ArgumentParser(description='Agent snapshot files')
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser("convert", help="convert a text file to a snapshot")
+    convert.add_argument("src")
+    convert.add_argument("dst")
+    info = commands.add_parser("info", help="print the header of a snapshot")
+    info.add_argument("file")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        convert_text(args.src, args.dst, DISCOUNT)
+    else:
+        header, _ = read_header(args.file)
+        header.pop("states")
+        print(json.dumps(header, indent=2))
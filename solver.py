@@ -0,0 +1,161 @@
+from game import Game, ActionSpace, HIT, STAND, WIN_STATE, LOSE_STATE, states
+from ai import Agent, DISCOUNT
+from rules import DEFAULT_RULES
+from dealer import BUST, CARD_PROBS, dealer_table
+
+'''
+    Exact values of the game in game.py, computed from its rules instead of sampled.
+
+    Cards are drawn with replacement, so every draw is one of the 13 ranks with probability
+    1/13. The dealer's hidden card is drawn independently of the user's cards, which makes
+    the state (user_sum, user_A_active, dealer_first) Markov, and every hit strictly increases
+    user_sum, so the values follow from a backward sweep over game.states.
+
+    Rewards follow Agent: non-terminal states give 0, WIN_STATE gives 1 and LOSE_STATE -1, so
+    a state's value is DISCOUNT times the expected value of the next state. The dealer's side
+    comes from dealer.DealerTable, so any rules.RuleSet can be solved. The blackjack payout
+    doesn't change the values, since a 21 on the first two cards ends the round before any state.
+'''
+
+
+class ExactSolver:
+    def __init__(self, discount=DISCOUNT, rules=DEFAULT_RULES):
+        if ActionSpace(rules).phases:
+            raise ValueError("the solver only covers hit and stand")
+        self.discount = discount
+        self.rules = rules
+        self.dealer = dealer_table(rules)
+        self.V = {}     # Value of each state under Agent.default_policy
+        self.Q = {}     # Optimal Q values [Hit, Stand] of each state
+        self.wins = {}  # Memo of win_probability
+        self.solve()
+
+    def dealer_distribution(self, dealer_first, user_total):
+        """
+        Distribution of the dealer's final total when the user stands
+
+        :param dealer_first:    the value of the dealer's visible card
+        :param user_total:      the user's actual sum; by default the dealer stops once it reaches it
+        :return:                an array of probabilities indexed by final total, BUST for over 21
+        """
+        return self.dealer.distribution(dealer_first, user_total)
+
+    def win_probability(self, dealer_first, user_total):
+        # Probability that the user wins by standing at user_total
+        key = dealer_first, user_total
+        if key not in self.wins:
+            finals = self.dealer_distribution(dealer_first, user_total)
+            self.wins[key] = finals[BUST] + finals[:min(user_total, BUST)].sum()
+        return self.wins[key]
+
+    def dealer_21_probability(self, dealer_first):
+        # Probability that the dealer's first two cards make 21, as far as the user can know
+        if self.rules.dealer_peeks:
+            # Otherwise the round would already be over
+            return 0
+        if dealer_first == 1:
+            return CARD_PROBS[10]
+        if dealer_first == 10:
+            return CARD_PROBS[1]
+        return 0
+
+    def hit_outcomes(self, state):
+        # (probability, outcome) pairs after hitting, where the outcome is the next state, or
+        # the expected terminal value when the hit ends the game
+        user_sum, user_A_active, dealer_first = state
+        outcomes = []
+        for value, p in CARD_PROBS.items():
+            next_sum = user_sum + value
+            actual, next_A_active = Game.calculate_hand(next_sum, user_A_active or value == 1)
+            if actual == 21:
+                # Reaching 21 wins unless the dealer already has 21
+                p_21 = self.dealer_21_probability(dealer_first)
+                outcomes.append((p, (1 - p_21) - p_21))
+            elif actual > 21:
+                outcomes.append((p, -1))
+            else:
+                outcomes.append((p, (next_sum, next_A_active, dealer_first)))
+        return outcomes
+
+    @staticmethod
+    def expected(outcomes, state_value):
+        # Expected value of hit_outcomes, using state_value for the non-terminal ones
+        return sum(p * (state_value(o) if isinstance(o, tuple) else o) for p, o in outcomes)
+
+    def solve(self):
+        V, Q = self.V, self.Q
+        V[WIN_STATE], V[LOSE_STATE] = 1, -1
+        Q[WIN_STATE], Q[LOSE_STATE] = [1, 1], [-1, -1]
+
+        # Value iteration; with states swept from the largest user_sum down, each state only
+        # depends on states that are already final, so the second sweep sees no change
+        order = sorted(states[2:], key=lambda s: -s[0])
+        for s in order:
+            V[s], Q[s] = 0, [0, 0]
+        delta = 1
+        while delta > 1e-12:
+            delta = 0
+            for s in order:
+                user_sum, user_A_active, dealer_first = s
+                p_win = self.win_probability(dealer_first, user_sum + user_A_active * 10)
+                stand_value = self.discount * (2 * p_win - 1)
+
+                outcomes = self.hit_outcomes(s)
+                hit_V = self.discount * self.expected(outcomes, V.get)
+                hit_Q = self.discount * self.expected(outcomes, lambda o: max(Q[o]))
+
+                new_V = hit_V if Agent.default_policy(s) == HIT else stand_value
+                delta = max(delta, abs(new_V - V[s]), abs(hit_Q - Q[s][HIT]), abs(stand_value - Q[s][STAND]))
+                V[s], Q[s] = new_V, [hit_Q, stand_value]
+
+    def reachable(self, policy=None):
+        """
+        States that can appear in an episode
+
+        :param policy:  only follow hits that the policy takes; None follows every action
+        :return:        the set of reachable states, including WIN_STATE and LOSE_STATE
+        """
+        # Every non-terminal state whose sum can be dealt as two cards is a starting state
+        frontier = []
+        for first in CARD_PROBS:
+            for second in CARD_PROBS:
+                user_sum = first + second
+                actual, user_A_active = Game.calculate_hand(user_sum, first == 1 or second == 1)
+                if actual < 21:
+                    frontier += [(user_sum, user_A_active, d) for d in range(1, 11)]
+
+        seen = {WIN_STATE, LOSE_STATE}
+        while frontier:
+            s = frontier.pop()
+            if s in seen:
+                continue
+            seen.add(s)
+            if policy is None or policy(s) == HIT:
+                frontier += [o for _, o in self.hit_outcomes(s) if isinstance(o, tuple)]
+        return seen
+
+    def to_agent(self):
+        """
+        An Agent holding the exact values, with one sample counted for every reachable state,
+        ready for Agent.save or for comparing with a trained Agent
+        """
+        agent = Agent(discount=self.discount)
+        evaluated = self.reachable(Agent.default_policy)
+        for s in self.reachable():
+            agent.Q_values[s] = self.Q[s]
+            agent.N_Q[s] = 1
+            if s in evaluated:
+                agent.MC_values[s] = agent.S_MC[s] = agent.TD_values[s] = self.V[s]
+                agent.N_MC[s] = agent.N_TD[s] = 1
+        return agent
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    start = time.perf_counter()
+    agent = ExactSolver().to_agent()
+    print(f"Solved in {(time.perf_counter() - start) * 1000:.1f} ms")
+    if len(sys.argv) > 1:
+        agent.save(sys.argv[1])
@@ -0,0 +1,281 @@
+import os
+import math
+import time
+import multiprocessing
+
+import numpy as np
+
+from ai import Agent
+from rng import FastRNG
+
+'''
+    Statistical regression test of the learning algorithms, for `main.py -t 6`.
+
+    K replicas of MC_run, TD_run and/or Q_run train in parallel processes, each from its own
+    rng.FastRNG stream of np.random.SeedSequence(seed). The spread of a value across the
+    replicas estimates its sampling error, so every value can be tested for a significant
+    difference from a reference, instead of using a fixed tolerance:
+        - a baseline: the replica means and variances of the same test run on a known good
+          version and saved with save_baseline. Values are compared with Welch's t-test, so a
+          change of ai.py or game.py fails the test when it changes what the algorithms learn
+          after the same number of episodes, and passes when it doesn't.
+        - the exact values of solver.ExactSolver, with a one-sample t-test. MC values are
+          unbiased estimates of them, while TD and Q values after a finite number of episodes
+          still carry the bias of bootstrapping from the initial values, so they only pass
+          against the exact values with enough episodes.
+    Only values visited at least min_visits times in every replica are tested. The p-values
+    of all the tested values are corrected for multiple testing, with the Benjamini-Hochberg
+    procedure (the expected share of false discoveries among the flagged values is at most
+    `significance`) or Bonferroni's (the chance of flagging any value by chance is at most
+    `significance`).
+'''
+ALGORITHMS = ("MC", "TD", "Q")
+# Values and visit counts of each algorithm
+TABLES = {"MC": ("MC_values", "N_MC"), "TD": ("TD_values", "N_TD"), "Q": ("Q_values", "N_Q")}
+BASELINE = "stat_baseline.npz"
+
+
+def _betacf(a, b, x):
+    # Continued fraction of the regularized incomplete beta function (modified Lentz's method)
+    tiny = 1e-300
+    c, d = 1.0, 1.0 - (a + b) * x / (a + 1)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 300):
+        for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                          -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+            d = 1.0 + numerator * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            h *= d * c
+        if abs(d * c - 1.0) < 1e-15:
+            break
+    return h
+
+
+def betainc(a, b, x):
+    # The regularized incomplete beta function I_x(a, b)
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x))
+    if x < (a + 1) / (a + b + 2):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1 - x) / b
+
+
+def t_pvalue(t, df):
+    # Two-sided p-value of Student's t statistic with df degrees of freedom
+    if math.isinf(t):
+        return 0.0
+    return betainc(df / 2, 0.5, df / (df + t * t))
+
+
+def benjamini_hochberg(pvalues, q):
+    # Boolean mask of the p-values rejected at false discovery rate q
+    pvalues = np.asarray(pvalues)
+    n = len(pvalues)
+    rejected = np.zeros(n, dtype=bool)
+    if n == 0:
+        return rejected
+    order = np.argsort(pvalues)
+    below = pvalues[order] <= q * np.arange(1, n + 1) / n
+    if below.any():
+        rejected[order[:np.flatnonzero(below)[-1] + 1]] = True
+    return rejected
+
+
+def bonferroni(pvalues, alpha):
+    pvalues = np.asarray(pvalues)
+    return pvalues <= alpha / max(len(pvalues), 1)
+
+
+def _replica(task):
+    # Values and counts of one replica, by algorithm, and the seconds it trained for
+    algorithms, episodes, seed_seq = task
+    start = time.perf_counter()
+    agent = Agent(rng=FastRNG(seed_seq))
+    for name in algorithms:
+        getattr(agent, f"{name}_run")(episodes)
+    tables = agent.tables
+    return {name: (getattr(tables, TABLES[name][0]).copy(), getattr(tables, TABLES[name][1]).copy())
+            for name in algorithms}, time.perf_counter() - start
+
+
+def run_replicas(algorithms, episodes, replicas, seed=0, workers=None):
+    """
+    Train replicas of the algorithms, each with its own random stream
+
+    :param algorithms:  names from ALGORITHMS, trained in this order by every replica
+    :param episodes:    the episodes of every algorithm in every replica
+    :return:            {name: (values, counts)} with one row per replica, e.g. (replicas, states)
+                        for MC values and (replicas, states, actions) for Q values, and the
+                        seconds of training summed over the replicas
+    """
+    workers = workers or os.cpu_count() or 1
+    tasks = [(tuple(algorithms), episodes, stream) for stream in np.random.SeedSequence(seed).spawn(replicas)]
+    if workers > 1:
+        with multiprocessing.Pool(min(workers, replicas)) as pool:
+            results = pool.map(_replica, tasks)
+    else:
+        results = list(map(_replica, tasks))
+    tables = {name: (np.stack([r[name][0] for r, _ in results]), np.stack([r[name][1] for r, _ in results]))
+              for name in algorithms}
+    return tables, sum(seconds for _, seconds in results)
+
+
+def replica_stats(values, counts, min_visits):
+    """
+    :return:    the mean and the sample variance of every value over the replicas, flattened,
+                and which values were visited at least min_visits times in every replica
+    """
+    replicas = values.shape[0]
+    values = values.reshape(replicas, -1)
+    # Q values share the visit count of their state
+    counts = np.repeat(counts, values.shape[1] // counts.shape[1], axis=1)
+    return values.mean(axis=0), values.var(axis=0, ddof=1), (counts >= min_visits).all(axis=0)
+
+
+def save_baseline(filename, tables, episodes, min_visits):
+    # Save the replica statistics of run_replicas, as the reference of later tests
+    arrays = {}
+    for name, (values, counts) in tables.items():
+        mean, var, tested = replica_stats(values, counts, min_visits)
+        arrays.update({f"{name}_mean": mean, f"{name}_var": var, f"{name}_tested": tested})
+    np.savez(filename, episodes=episodes, replicas=next(iter(tables.values()))[0].shape[0],
+             algorithms=np.array(list(tables)), **arrays)
+
+
+def exact_reference():
+    # The exact values and which of them exist, by algorithm, flattened like replica_stats
+    from solver import ExactSolver
+    exact = ExactSolver().to_agent().tables
+    reference = {}
+    for name, (values_name, counts_name) in TABLES.items():
+        values = getattr(exact, values_name)
+        counts = getattr(exact, counts_name)
+        width = values.size // counts.size
+        reference[name] = (values.reshape(-1), np.repeat(counts > 0, width))
+    return reference
+
+
+class Result:
+    def __init__(self, name, index, width, flagged, tested, mean, reference, stderr, pvalues, correction, significance):
+        self.name = name
+        self.index = index          # The state index of the Agents
+        self.width = width          # Values per state: 1, or the number of actions for Q
+        self.flagged = flagged      # Positions of the flagged values in the flattened tables
+        self.tested = tested        # The number of values tested
+        self.mean, self.reference, self.stderr, self.pvalues = mean, reference, stderr, pvalues
+        self.correction = correction
+        self.significance = significance
+
+    @property
+    def passed(self):
+        return len(self.flagged) == 0
+
+    def describe(self, k):
+        state = self.index.states[k // self.width]
+        action = f" action {k % self.width}" if self.width > 1 else ""
+        return (f"    {state}{action}: mean {self.mean[k]:+.4f}, reference {self.reference[k]:+.4f}, "
+                f"stderr {self.stderr[k]:.4f}, p {self.pvalues[k]:.2g}")
+
+    def report(self, max_lines=10):
+        verdict = "++++ PASSED" if self.passed else "---- FAILED"
+        lines = [f"{verdict} {self.name}: {len(self.flagged)} of {self.tested} values differ significantly "
+                 f"({self.correction} at {self.significance:g})"]
+        worst = sorted(self.flagged, key=lambda k: self.pvalues[k])
+        lines += [self.describe(k) for k in worst[:max_lines]]
+        if len(worst) > max_lines:
+            lines.append(f"    ... and {len(worst) - max_lines} more")
+        return "\n".join(lines)
+
+
+def compare(name, values, counts, reference, min_visits=50, significance=0.01, correction="fdr"):
+    """
+    Test the values of the replicas of one algorithm against a reference
+
+    :param reference:   a dict with the "mean", "var", "tested" and "replicas" of a baseline,
+                        or with the "values" and "tested" mask of exact values
+    :param correction:  "fdr" for Benjamini-Hochberg or "bonferroni"
+    :return:            a Result
+    """
+    replicas = values.shape[0]
+    width = values[0].size // counts.shape[1]
+    mean, var, tested = replica_stats(values, counts, min_visits)
+    tested = tested & reference["tested"]
+    if "values" in reference:
+        # One-sample t-test against exact values
+        ref = reference["values"]
+        se2 = var / replicas
+        df = np.full(len(mean), replicas - 1.0)
+    else:
+        # Welch's t-test of the two sets of replicas
+        ref, ref_var, ref_replicas = reference["mean"], reference["var"], reference["replicas"]
+        a, b = var / replicas, ref_var / ref_replicas
+        se2 = a + b
+        with np.errstate(divide="ignore", invalid="ignore"):
+            df = np.where(se2 > 0, se2 * se2 / (a * a / (replicas - 1) + b * b / (ref_replicas - 1)), 1.0)
+    stderr = np.sqrt(se2)
+    diff = mean - ref
+
+    positions = np.flatnonzero(tested)
+    pvalues = np.ones(len(mean))
+    for k in positions:
+        if stderr[k] > 0:
+            pvalues[k] = t_pvalue(diff[k] / stderr[k], df[k])
+        else:
+            # No spread: the values agree exactly or not at all
+            pvalues[k] = 1.0 if abs(diff[k]) <= 1e-12 else 0.0
+    reject = benjamini_hochberg if correction == "fdr" else bonferroni
+    flagged = positions[reject(pvalues[positions], significance)]
+    return Result(name, Agent().index, width, list(flagged), len(positions), mean, ref, stderr, pvalues,
+                  correction, significance)
+
+
+def test_statistical(algorithm=0, replicas=16, episodes=50000, workers=None, baseline=BASELINE,
+                     save=False, significance=0.01, correction="fdr", min_visits=50, seed=0):
+    """
+    Run the statistical regression test and print its report
+
+    :param algorithm:   0 for all, or the main.py number of one algorithm: 1 MC, 2 TD, 3 Q
+    :param baseline:    the baseline file, or "exact" to test against the exact values
+    :param save:        save the replicas as the new baseline instead of testing them
+    :return:            whether all the algorithms passed
+    """
+    start = time.perf_counter()
+    algorithms = ALGORITHMS if algorithm == 0 else (ALGORITHMS[algorithm - 1],)
+    workers = workers or os.cpu_count() or 1
+    if not save and baseline != "exact":
+        if not os.path.exists(baseline):
+            raise SystemExit(f"no baseline {baseline}; save one on a known good version with --save-baseline")
+        saved = np.load(baseline)
+        if int(saved["episodes"]) != episodes:
+            raise SystemExit(f"{baseline} was trained with {int(saved['episodes'])} episodes per replica, not {episodes}")
+        missing = set(algorithms) - set(saved["algorithms"].tolist())
+        if missing:
+            raise SystemExit(f"{baseline} has no {', '.join(sorted(missing))} values")
+
+    print(f"Training {replicas} replicas of {', '.join(algorithms)} with {episodes} episodes each on {workers} workers")
+    tables, cpu_seconds = run_replicas(algorithms, episodes, replicas, seed, workers)
+
+    passed = True
+    if save:
+        save_baseline(baseline, tables, episodes, min_visits)
+        print(f"Saved the baseline to {baseline}")
+    else:
+        exact = exact_reference() if baseline == "exact" else None
+        for name in algorithms:
+            if exact is not None:
+                reference = {"values": exact[name][0], "tested": exact[name][1]}
+            else:
+                reference = {"mean": saved[f"{name}_mean"], "var": saved[f"{name}_var"],
+                             "tested": saved[f"{name}_tested"], "replicas": int(saved["replicas"])}
+            result = compare(name, *tables[name], reference, min_visits, significance, correction)
+            print(result.report())
+            passed = passed and result.passed
+    print(f"Wall time {time.perf_counter() - start:.1f}s ({cpu_seconds:.1f}s of training over {workers} workers)")
+    print()
+    return passed
@@ -0,0 +1,204 @@
+import os
+import csv
+import json
+import time
+import hashlib
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from ai import Agent, AlphaSchedule, DISCOUNT, EPSILON, ALPHA
+from game import Game
+from rng import FastRNG
+from evaluate import evaluate
+from convergence import ConvergenceMonitor, greedy_actions
+
+'''
+    Hyperparameter sweeps: train a grid of configurations of the discount, the exploration rate
+    and the learning rate schedule (see ai.AlphaSchedule) in a process pool and score them.
+
+    A configuration is a dict of the algorithm, the number of episodes, the learning
+    parameters, the seed, and how it is scored. Its hash (config_hash) names its result in the
+    cache directory, so a rerun of a sweep only trains the configurations it hasn't finished.
+
+    All configurations of a sweep use common random numbers: the Game deals from one
+    rng.FastRNG stream and the Agent explores with another, both children of the sweep's seed,
+    so configurations start from the same cards and differences in their results come from the
+    parameters, not the luck of the draw. Every run is scored by
+        - converged_at: the episode at which a convergence.ConvergenceMonitor of its algorithm
+          first saw `patience` converged windows in a row, or empty if it never did
+        - win_rate: the win rate of the greedy policy of the Q values over `hands` hands, all
+          configurations playing the same hands (see evaluate.py); MC and TD evaluate the
+          default policy, so only their convergence is compared
+'''
+CACHE_DIR = "sweep-cache"
+FIELDS = ("hash", "algorithm", "episodes", "discount", "epsilon", "alpha", "converged_at", "final_change",
+          "win_rate", "win_rate_low", "win_rate_high", "seconds")
+
+
+def config_hash(config):
+    # Stable digest of a configuration, the same in every process
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def grid(algorithm, episodes, discounts=(DISCOUNT,), epsilons=(EPSILON,), alphas=(ALPHA,), seed=0,
+         hands=100000, window=10000, tolerance=0.1, max_flips=1, patience=3):
+    """
+    Configurations of every combination of discounts, epsilons and alphas
+
+    Parameters an algorithm doesn't use are left out of its configurations, so that they
+    aren't trained again for every value: MC has no exploration rate and no learning rate,
+    and TD follows the default policy without exploring.
+    """
+    epsilons = epsilons if algorithm == "Q" else (None,)
+    alphas = alphas if algorithm != "MC" else (None,)
+    configs = []
+    for discount, epsilon, alpha in itertools.product(discounts, epsilons, alphas):
+        configs.append({"algorithm": algorithm, "episodes": episodes, "discount": discount, "epsilon": epsilon,
+                        "alpha": alpha.to_dict() if alpha is not None else None, "seed": seed, "hands": hands,
+                        "window": window, "tolerance": tolerance, "max_flips": max_flips, "patience": patience})
+    return configs
+
+
+def run_config(config):
+    """
+    Train and score one configuration
+
+    :return:    a dict with FIELDS
+    """
+    start = time.perf_counter()
+    deal_stream, explore_stream = np.random.SeedSequence(config["seed"]).spawn(2)
+    alpha = AlphaSchedule(**config["alpha"]) if config["alpha"] else ALPHA
+    agent = Agent(Game(rng=FastRNG(deal_stream)), rng=FastRNG(explore_stream), discount=config["discount"],
+                  epsilon=config["epsilon"] if config["epsilon"] is not None else EPSILON, alpha=alpha)
+    algorithm = config["algorithm"]
+    run = getattr(agent, f"{algorithm}_run")
+    monitor = ConvergenceMonitor([algorithm], config["window"], config["tolerance"], max_flips=config["max_flips"],
+                                 patience=config["patience"])
+
+    converged_at = None
+    episode = 0
+    monitor.update(agent, episode)
+    while episode < config["episodes"]:
+        n = min(config["window"], config["episodes"] - episode)
+        run(n)
+        episode += n
+        if monitor.update(agent, episode) and converged_at is None:
+            converged_at = episode
+
+    if algorithm == "Q":
+        policy = greedy_actions(agent.tables.Q_values, None if agent.actions.num_actions == 2 else agent.legal_mask)
+    else:
+        policy = Agent.default_policy
+    evaluation = evaluate(policy, config["hands"], config["seed"])
+    return {"hash": config_hash(config), "algorithm": algorithm, "episodes": config["episodes"],
+            "discount": config["discount"], "epsilon": "" if config["epsilon"] is None else config["epsilon"],
+            "alpha": "" if config["alpha"] is None else ",".join(f"{k}={v}" for k, v in config["alpha"].items()),
+            "converged_at": "" if converged_at is None else converged_at,
+            "final_change": monitor.history[-1]["max_change"] if monitor.history else "",
+            "win_rate": evaluation.win_rate, "win_rate_low": evaluation.ci[0], "win_rate_high": evaluation.ci[1],
+            "seconds": time.perf_counter() - start}
+
+
+def _cache_path(cache_dir, config):
+    return os.path.join(cache_dir, config_hash(config) + ".json")
+
+
+def _run_cached(task):
+    # Train a configuration in a worker and save its result to the cache right away, so an
+    # interrupted sweep keeps the configurations it finished
+    config, cache_dir = task
+    result = run_config(config)
+    if cache_dir:
+        path = _cache_path(cache_dir, config)
+        with open(path + ".tmp", "w") as file:
+            json.dump({"config": config, "result": result}, file)
+        os.replace(path + ".tmp", path)
+    return result
+
+
+def sweep(configs, workers=1, cache_dir=CACHE_DIR, log=print):
+    """
+    Train and score configurations, skipping the ones in cache_dir
+
+    :param workers:     the number of worker processes
+    :param cache_dir:   the directory of finished configurations, or None to train all of them
+    :return:            the results of all the configurations, best first: highest win rate,
+                        then fastest convergence
+    """
+    results, pending = [], []
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    for config in configs:
+        path = _cache_path(cache_dir, config) if cache_dir else None
+        if path and os.path.exists(path):
+            with open(path) as file:
+                results.append(json.load(file)["result"])
+        else:
+            pending.append(config)
+    log(f"{len(configs)} configurations, {len(configs) - len(pending)} cached, training {len(pending)}")
+
+    tasks = [(config, cache_dir) for config in pending]
+    if workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            for result in pool.imap_unordered(_run_cached, tasks):
+                results.append(result)
+                log(_summary(result))
+    else:
+        for task in tasks:
+            results.append(_run_cached(task))
+            log(_summary(results[-1]))
+
+    never = float("inf")
+    results.sort(key=lambda r: (-r["win_rate"], never if r["converged_at"] == "" else r["converged_at"], r["hash"]))
+    return results
+
+
+def _summary(result):
+    converged = result["converged_at"] if result["converged_at"] != "" else "never"
+    epsilon = result["epsilon"] if result["epsilon"] != "" else "-"
+    return (f"  {result['algorithm']} discount={result['discount']} epsilon={epsilon} "
+            f"alpha={result['alpha'] or '-'}: win rate {result['win_rate'] * 100:.3f}%, "
+            f"converged at {converged}, {result['seconds']:.1f}s")
+
+
+def write_results(filename, results):
+    with open(filename, "w", newline="") as file:
+        writer = csv.DictWriter(file, FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    def floats(text):
+        return tuple(float(x) for x in text.split(","))
+
+    parser = argparse.ArgumentParser(description='Sweep the learning parameters of an algorithm')
+    parser.add_argument('--algorithm', '-a', choices=("MC", "TD", "Q"), default="Q")
+    parser.add_argument('--episodes', '-n', type=int, default=200000, help='episodes per configuration')
+    parser.add_argument('--discount', type=floats, default=(DISCOUNT,), help='comma-separated discounts')
+    parser.add_argument('--epsilon', type=floats, default=(EPSILON,), help='comma-separated exploration rates')
+    parser.add_argument('--alpha', action='append', type=AlphaSchedule.parse,
+                        help='a learning rate schedule, e.g. "c=10,power=0.8" or "constant=0.05"; repeatable')
+    parser.add_argument('--seed', type=int, default=0, help='the seed shared by all configurations')
+    parser.add_argument('--hands', type=int, default=100000, help='hands to evaluate every greedy policy on')
+    parser.add_argument('--window', type=int, default=10000, help='episodes between convergence checks')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='max value change per window')
+    parser.add_argument('--max-flips', type=int, default=1, help='max greedy policy changes per window')
+    parser.add_argument('--patience', type=int, default=3, help='converged windows in a row needed')
+    parser.add_argument('--workers', '-w', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='where finished configurations are kept')
+    parser.add_argument('--no-cache', action='store_true', help='train every configuration again')
+    parser.add_argument('--output', '-o', default="sweep.csv", help='the CSV results table')
+    args = parser.parse_args()
+
+    configs = grid(args.algorithm, args.episodes, args.discount, args.epsilon, args.alpha or (ALPHA,), args.seed,
+                   args.hands, args.window, args.tolerance, args.max_flips, args.patience)
+    results = sweep(configs, args.workers, None if args.no_cache else args.cache_dir)
+    write_results(args.output, results)
+    print(f"\nBest first, written to {args.output}:")
+    for result in results:
+        print(_summary(result))
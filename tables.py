@@ -0,0 +1,121 @@
+import numpy as np
+
+from game import state_index
+
+# Tables of an Agent, in the order of the text format of Agent.save_text
+TABLE_NAMES = ("MC_values", "TD_values", "Q_values", "S_MC", "N_MC", "N_TD", "N_Q")
+# Tables that are only kept in snapshots
+EXTRA_TABLES = ("SS_MC",)
+ALL_TABLES = TABLE_NAMES + EXTRA_TABLES
+
+# Columns of Q_values when the user can only hit or stand
+NUM_ACTIONS = 2
+
+
+class Tables:
+    """
+    Learning tables of an Agent, stored as NumPy arrays with one row per state index
+    (see game.StateIndex). Values are float64, visit counts are int64, and Q_values is
+    a (num_states, num_actions) matrix with one column per action id (see game.ActionSpace).
+    """
+    def __init__(self, index=state_index, num_actions=NUM_ACTIONS):
+        self.index = index
+        n = len(index)
+
+        # For MC values. MC_values should be equal to S_MC divided by N_MC on each state
+        self.MC_values = np.zeros(n)
+        self.S_MC = np.zeros(n)
+        self.N_MC = np.zeros(n, dtype=np.int64)
+        self.SS_MC = np.zeros(n)    # The sum of squared returns, for the variance of MC values
+
+        # For TD values
+        self.TD_values = np.zeros(n)
+        self.N_TD = np.zeros(n, dtype=np.int64)
+
+        # For Q-learning values. Column 0 is the Q value of "Hit", column 1 of "Stand", and so on
+        self.Q_values = np.zeros((n, num_actions))
+        self.N_Q = np.zeros(n, dtype=np.int64)
+
+    def views(self, *names):
+        # Memoryviews of the named tables for the learning loops. They index by state index
+        # like the arrays, but read and write plain Python numbers, which is much cheaper
+        # than going through NumPy scalars one element at a time.
+        return [memoryview(getattr(self, name)) for name in names]
+
+    def copy(self):
+        tables = Tables.__new__(Tables)
+        tables.index = self.index
+        for name in ALL_TABLES:
+            setattr(tables, name, getattr(self, name).copy())
+        return tables
+
+
+def legal_mask(index, actions):
+    # Boolean (num_states, num_actions) matrix of the legal actions of every state
+    mask = np.zeros((len(index), actions.num_actions), dtype=bool)
+    for i, legal in enumerate(actions.legal_table(index)):
+        mask[i, list(legal)] = True
+    return mask
+
+
+class TableView:
+    """
+    Dict-like view of one table, keyed by state tuples. Reads and writes go straight
+    to the underlying array, so `view[s][a] += x` works for Q values too.
+    """
+    def __init__(self, index, array):
+        self.index = index
+        self.array = array
+
+    def __getitem__(self, state):
+        return self.array[self.index.encode(state)]
+
+    def __setitem__(self, state, value):
+        self.array[self.index.encode(state)] = value
+
+    def __contains__(self, state):
+        return state in self.index.states
+
+    def __iter__(self):
+        return iter(self.index.states)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return iter(self.array)
+
+    def items(self):
+        return zip(self.index.states, self.array)
+
+
+class table_view:
+    # Attribute of Agent that exposes one of its tables as a TableView
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, agent, owner=None):
+        if agent is None:
+            return self
+        tables = agent.tables
+        return TableView(tables.index, getattr(tables, self.name))
+
+
+class TableViews:
+    # Dict-like views of self.tables, keyed by state tuples
+    MC_values = table_view("MC_values")  # The MC value of each state
+    S_MC = table_view("S_MC")            # The sum of returns in each state
+    N_MC = table_view("N_MC")            # The number of samples of each state
+    TD_values = table_view("TD_values")  # The TD value of each state
+    N_TD = table_view("N_TD")            # The number of samples of each state
+    Q_values = table_view("Q_values")    # The Q-Learning value of each state and action
+    N_Q = table_view("N_Q")              # The number of samples of each state
+
+
+class Snapshot(TableViews):
+    # Copy of an Agent's tables with the same dict-like views, e.g. for display
+    def __init__(self, tables):
+        self.tables = tables.copy()
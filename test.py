@@ -41,7 +41,16 @@ def ai_compare(ai_base, ai, algorithm, tolerance, max_diffs=0):
     else:
         print("---- FAILED {} with {} wrong values".format(ALG_TXT[algorithm], diff))
 
-base = Agent()
+# The reference Agent the saved tables are loaded into, made on first use so that importing
+# this module doesn't build one
+_base = None
+
+
+def get_base():
+    global _base
+    if _base is None:
+        _base = Agent()
+    return _base
 
 
 def test_three_steps(algorithm):
@@ -53,6 +62,7 @@ def test_three_steps(algorithm):
     tolerance = 0.001
     max_diffs = 0
     ai = Agent()
+    base = get_base()
 
     for step in range(0, 3):
         base.load(f"test_state_{step + 1}")
@@ -72,6 +82,7 @@ def test_three_steps(algorithm):
 
 def test_divergence(algorithm):
     ai = Agent()
+    base = get_base()
     base.load("test_convergence")
     ai.load("test_convergence")
 
@@ -97,9 +108,15 @@ def test_divergence(algorithm):
         
     print()
 
-def test_convergence(algorithm):
+def test_convergence(algorithm, exact=False):
     ai = Agent()
-    base.load("test_convergence")
+    if exact:
+        # Compare with the exact values instead of the sampled reference
+        from solver import ExactSolver
+        reference = ExactSolver().to_agent()
+    else:
+        reference = get_base()
+        reference.load("test_convergence")
 
     episodes = int(1e6)
     tolerance = 0.25
@@ -111,16 +128,15 @@ def test_convergence(algorithm):
 
     if algorithm == 0 or algorithm == ALG_MC:
         ai_learn(ai, ALG_MC, episodes, print_tester=True)
-        ai_compare(base, ai, ALG_MC, tolerance, max_diffs[ALG_MC])
+        ai_compare(reference, ai, ALG_MC, tolerance, max_diffs[ALG_MC])
     
     if algorithm == 0 or algorithm == ALG_TD:
         ai_learn(ai, ALG_TD, episodes, print_tester=True)
-        ai_compare(base, ai, ALG_TD, tolerance, max_diffs[ALG_TD])
+        ai_compare(reference, ai, ALG_TD, tolerance, max_diffs[ALG_TD])
     
     if algorithm == 0 or algorithm == ALG_QL:
         ai_learn(ai, ALG_QL, episodes, print_tester=True)
-        ai_compare(base, ai, ALG_QL, tolerance, max_diffs[ALG_QL])
+        ai_compare(reference, ai, ALG_QL, tolerance, max_diffs[ALG_QL])
         
     print()
 
-
@@ -0,0 +1,125 @@
+import time
+
+'''
+    Eligibility traces for Agent.TDLambda_run and Agent.QLambda_run.
+
+    A trace is kept only for the states (or state-action pairs) touched in the current
+    episode, as a list of keys and a parallel list of trace values, so every step of an
+    episode updates O(episode length) entries instead of a table with a row per state. With
+    the discount times lambda at 0 the buffer is emptied after every step, and the learners do
+    exactly the one-step updates of TD_run and Q_run.
+
+    `python traces.py` compares how many episodes TD(0) and TD(lambda), and Q-learning and
+    Watkins' Q(lambda), need to get as close to the exact values of solver.py as
+    test_convergence requires of them:
+
+        python traces.py --lambdas 0.3,0.5,0.8 --seeds 5
+'''
+
+
+class EligibilityTraces:
+    def __init__(self, replacing=False):
+        """
+        :param replacing:   set the trace of a visited key to 1 instead of adding 1 to it
+        """
+        self.replacing = replacing
+        self.keys = []          # State indices, or (state index, action) pairs
+        self.values = []        # The trace of every key
+        self.position = {}      # Key -> its position in keys and values
+
+    def __len__(self):
+        return len(self.keys)
+
+    def clear(self):
+        self.keys.clear()
+        self.values.clear()
+        self.position.clear()
+
+    def visit(self, key):
+        k = self.position.get(key)
+        if k is None:
+            self.position[key] = len(self.keys)
+            self.keys.append(key)
+            self.values.append(1.0)
+        elif self.replacing:
+            self.values[k] = 1.0
+        else:
+            self.values[k] += 1.0
+
+    def decay(self, factor):
+        if factor == 0:
+            self.clear()
+        else:
+            values = self.values
+            for k in range(len(values)):
+                values[k] *= factor
+
+
+def wrong_values(agent, reference, algorithm, tolerance=0.25):
+    # The number of values of the algorithm ("TD" or "Q") more than tolerance away from the
+    # reference Agent, counted like test.ai_compare
+    if algorithm == "TD":
+        return int((abs(agent.tables.TD_values - reference.tables.TD_values) > tolerance).sum())
+    return int((abs(agent.tables.Q_values - reference.tables.Q_values) > tolerance).sum())
+
+
+def episodes_to_convergence(agent, run, algorithm, reference, max_diffs, window=10000, max_episodes=int(1e6),
+                            tolerance=0.25):
+    """
+    Train agent with run until at most max_diffs values are wrong
+
+    :param run:         a function training the agent for a number of episodes, e.g.
+                        partial(agent.TDLambda_run, lam=0.8)
+    :return:            the episodes trained, None if max_episodes weren't enough, and the
+                        seconds it took
+    """
+    start = time.perf_counter()
+    episode = 0
+    while episode < max_episodes:
+        run(window)
+        episode += window
+        if wrong_values(agent, reference, algorithm, tolerance) <= max_diffs:
+            return episode, time.perf_counter() - start
+    return None, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    import argparse
+    import statistics
+    from functools import partial
+
+    from ai import Agent
+    from rng import FastRNG
+    from solver import ExactSolver
+
+    parser = argparse.ArgumentParser(description='Episodes to convergence of TD(lambda) and Q(lambda)')
+    parser.add_argument('--lambdas', default="0.3,0.5,0.8", help='comma-separated lambdas besides 0')
+    parser.add_argument('--replacing', action='store_true', help='replacing instead of accumulating traces')
+    parser.add_argument('--seeds', type=int, default=5, help='runs of every learner, from seeds 0, 1, ...')
+    parser.add_argument('--window', type=int, default=10000, help='episodes between checks')
+    parser.add_argument('--max-episodes', type=int, default=int(1e6))
+    args = parser.parse_args()
+
+    reference = ExactSolver().to_agent()
+    # The max_diffs of test_convergence
+    lambdas = [float(x) for x in args.lambdas.split(",")]
+    learners = ([("TD", "TD(0)", "TD_run", None, 20)] +
+                [("TD", f"TD({lam:g})", "TDLambda_run", lam, 20) for lam in lambdas] +
+                [("Q", "Q-learning", "Q_run", None, 20)] +
+                [("Q", f"Q({lam:g})", "QLambda_run", lam, 20) for lam in lambdas])
+
+    print(f"Episodes until at most 20 values are more than 0.25 from the exact values, over {args.seeds} seeds")
+    for algorithm, label, method, lam, max_diffs in learners:
+        episodes, seconds = [], []
+        for seed in range(args.seeds):
+            agent = Agent(rng=FastRNG(seed))
+            run = getattr(agent, method)
+            if lam is not None:
+                run = partial(run, lam=lam, replacing=args.replacing)
+            n, s = episodes_to_convergence(agent, run, algorithm, reference, max_diffs, args.window, args.max_episodes)
+            episodes.append(n)
+            seconds.append(s)
+        done = [n for n in episodes if n is not None]
+        median = f"{statistics.median(done):>9,.0f}" if done else "    never"
+        print(f"  {label:12} median {median} episodes ({len(done)}/{len(episodes)} converged), "
+              f"{statistics.mean(seconds):.1f}s per run")
@@ -0,0 +1,289 @@
+import time
+import argparse
+import threading
+
+from game import Game, Shoe
+from rng import make_rng
+
+# The modules that need NumPy are imported where they are used, so that main.py can build
+# its options from build_parser without loading them
+
+# Agent method of each algorithm
+RUNS = {
+    "MC": "MC_run",
+    "TD": "TD_run",
+    "Q": "Q_run",
+}
+
+
+def checkpoint_meta(meta, monitor=None):
+    # The meta data of a checkpoint, with the state of the convergence monitor so that a
+    # resumed run stops where an uninterrupted one would
+    if monitor is None:
+        return meta
+    return dict(meta or {}, monitor=monitor.getstate())
+
+
+def train(agent, algorithms, episodes, start=0, chunk=1000, checkpointer=None, meta=None,
+          seconds=None, report_every=None, monitor=None, dumper=None):
+    """
+    Train agent with each of the algorithms, in chunks of episodes
+
+    Chunk boundaries are always multiples of chunk counted from episode 0, and checkpoints are
+    only taken on them, so a run resumed from a checkpoint repeats the same sequence of calls.
+
+    :param algorithms:      names from RUNS, run one after the other on every chunk
+    :param episodes:        the number of episodes to reach for each algorithm
+    :param start:           the number of episodes already done, e.g. when resuming
+    :param checkpointer:    an optional checkpoint.Checkpointer
+    :param meta:            extra meta data stored in the checkpoints
+    :param seconds:         stop at the first chunk boundary after this time budget
+    :param report_every:    print the throughput every this many seconds
+    :param monitor:         an optional convergence.ConvergenceMonitor that can stop training
+                            early. Its state is saved in the checkpoints
+    :param dumper:          an optional instrument.StatsDumper of agent.stats
+    :return:                the number of episodes done
+    """
+    runs = [(f"train.{name}", getattr(agent, RUNS[name])) for name in algorithms]
+    episode = start
+    begin = last_report = time.perf_counter()
+    reported = start
+    while episode < episodes:
+        n = min(chunk - episode % chunk, episodes - episode)
+        for name, run in runs:
+            if agent.stats is not None:
+                with agent.stats.timer(name):
+                    run(n)
+            else:
+                run(n)
+        episode += n
+        converged = monitor is not None and monitor.update(agent, episode)
+        if checkpointer and checkpointer.due(episode):
+            checkpointer.save(agent, episode, checkpoint_meta(meta, monitor))
+        if dumper:
+            dumper.maybe_dump(episode)
+        if converged:
+            print(f"Converged after {episode} episodes per algorithm")
+            break
+
+        now = time.perf_counter()
+        if report_every and now - last_report >= report_every:
+            rate = (episode - reported) * len(runs) / (now - last_report)
+            print(f"{episode} episodes per algorithm, {rate:.0f} episodes/s")
+            last_report, reported = now, episode
+        if seconds is not None and now - begin >= seconds:
+            break
+
+    elapsed = time.perf_counter() - begin
+    if report_every and elapsed > 0:
+        total = (episode - start) * len(runs)
+        print(f"Trained {total} episodes in {elapsed:.1f}s, {total / elapsed:.0f} episodes/s")
+    return episode
+
+
+class BackgroundTrainer:
+    """
+    Runs the learning loops of an Agent in a background thread, so that a display loop can
+    redraw at its own pace. The algorithms in `enabled` are run in chunks while holding
+    `lock`, and a read-only tables.Snapshot is published every `publish_every` seconds.
+    """
+    def __init__(self, agent, chunk=50, publish_every=0.05):
+        self.agent = agent
+        self.chunk = chunk
+        self.publish_every = publish_every
+        self.enabled = set()
+        self.lock = threading.Lock()
+        from tables import Snapshot
+        self.snapshot = Snapshot(agent.tables)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def publish(self):
+        from tables import Snapshot
+        with self.lock:
+            self.snapshot = Snapshot(self.agent.tables)
+
+    def __loop(self):
+        last_publish = time.perf_counter()
+        while not self.stopped.is_set():
+            enabled = [name for name in RUNS if name in self.enabled]
+            if not enabled:
+                self.stopped.wait(self.publish_every)
+            with self.lock:
+                for name in enabled:
+                    getattr(self.agent, RUNS[name])(self.chunk)
+            if time.perf_counter() - last_publish >= self.publish_every:
+                self.publish()
+                last_publish = time.perf_counter()
+
+
+def parse_algorithms(text):
+    algorithms = text.split(",")
+    for name in algorithms:
+        if name not in RUNS:
+            raise argparse.ArgumentTypeError(f"unknown algorithm {name!r}, expected one of {', '.join(RUNS)}")
+    return algorithms
+
+
+def parse_positive(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"expected at least 1, not {value}")
+    return value
+
+
+def build_parser(parser=None):
+    parser = parser or argparse.ArgumentParser(description='Train the Blackjack agent')
+    parser.add_argument('--algorithms', '-a', type=parse_algorithms, default=["MC", "TD", "Q"],
+                        help='comma-separated algorithms to run on every chunk: MC, TD, Q')
+    parser.add_argument('--episodes', '-n', type=int, default=int(1e6), help='episodes per algorithm')
+    parser.add_argument('--seconds', type=float, help='time budget; stops at the first chunk after it')
+    parser.add_argument('--report-every', type=float, default=10, help='print episodes/s every T seconds')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random stream')
+    parser.add_argument('--rng', choices=('legacy', 'fast'), default='legacy',
+                        help='random stream: the random module, or a prefetching NumPy generator (see rng.py)')
+    parser.add_argument('--discount', type=float, help='the gamma of all value calculations (default: ai.DISCOUNT)')
+    parser.add_argument('--epsilon', type=float, help='the exploration rate of Q-learning (default: ai.EPSILON)')
+    parser.add_argument('--alpha', help='the learning rate of TD and Q-learning, (c/(c-1+n))**power of the n-th '
+                                        'update of a state, as "c=10,power=1" (the default) or "constant=0.05"')
+    parser.add_argument('--chunk', type=int, default=1000, help='episodes per algorithm between checkpoint checks')
+    parser.add_argument('--checkpoint-dir', default="checkpoints")
+    parser.add_argument('--checkpoint-episodes', type=int, default=100000, help='checkpoint every N episodes')
+    parser.add_argument('--checkpoint-seconds', type=float, default=300, help='checkpoint every T seconds')
+    parser.add_argument('--keep', type=parse_positive, default=3, help='number of checkpoints to keep')
+    parser.add_argument('--resume', action='store_true', help='continue from the latest checkpoint')
+    parser.add_argument('--output', '-o', help='also save the final agent to this file')
+    parser.add_argument('--until-converged', action='store_true',
+                        help='stop early once the values stabilize (see convergence.py)')
+    parser.add_argument('--window', type=int, default=10000, help='episodes between convergence checks')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='max value change per window')
+    parser.add_argument('--stderr-tolerance', type=float, default=0.1, help='max standard error of MC values')
+    parser.add_argument('--max-flips', type=int, default=1, help='max greedy policy changes per window')
+    parser.add_argument('--min-share', type=float, default=1e-4,
+                        help='ignore states visited in fewer than this fraction of the episodes')
+    parser.add_argument('--patience', type=int, default=3, help='converged windows in a row needed to stop')
+    parser.add_argument('--metrics', help='CSV file for the convergence metrics of every window')
+    parser.add_argument('--decks', type=int, help='deal from a finite shoe of this many decks')
+    parser.add_argument('--penetration', type=parse_penetration, default=0.75,
+                        help='share of the shoe dealt before reshuffling, between 0 and 1')
+    parser.add_argument('--true-count', type=parse_range, metavar='LOW,HIGH',
+                        help='add the true count of the shoe, clipped to LOW..HIGH, to the states')
+    parser.add_argument('--fast-game', action='store_true',
+                        help='step the game with precomputed transition tables (see transitions.py)')
+    parser.add_argument('--stats', help='collect counters and timers (see instrument.py) and append them '
+                                        'to this JSON lines file')
+    parser.add_argument('--stats-every', type=float, default=10, help='dump the stats every T seconds')
+    parser.add_argument('--profile', help='sample the training loop and write collapsed stacks for a flame graph '
+                                          'to this file')
+    parser.add_argument('--profile-seconds', type=float, help='only sample the first T seconds of training')
+    parser.add_argument('--profile-interval', type=float, default=0.005, help='seconds between samples')
+    return parser
+
+
+def parse_range(text):
+    try:
+        low, high = (int(x) for x in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected LOW,HIGH, got {text!r}")
+    if low > high:
+        raise argparse.ArgumentTypeError(f"empty range {text!r}")
+    return low, high
+
+
+def parse_penetration(text):
+    value = float(text)
+    if not 0 < value < 1:
+        raise argparse.ArgumentTypeError(f"expected a share between 0 and 1, not {value}")
+    return value
+
+
+def run(args):
+    from ai import Agent, AlphaSchedule, ALPHA, DISCOUNT, EPSILON
+    from checkpoint import Checkpointer, latest_checkpoint, restore
+    from convergence import ConvergenceMonitor
+    from snapshot import read_header
+
+    if args.true_count and not args.decks:
+        raise SystemExit("--true-count needs --decks")
+    if args.true_count and args.fast_game:
+        raise SystemExit("--fast-game doesn't support --true-count")
+    try:
+        alpha = AlphaSchedule.parse(args.alpha) if args.alpha else ALPHA
+    except ValueError as e:
+        raise SystemExit(str(e))
+    discount = DISCOUNT if args.discount is None else args.discount
+    epsilon = EPSILON if args.epsilon is None else args.epsilon
+    shoe = Shoe(args.decks, args.penetration, args.seed) if args.decks else None
+    agent = Agent(Game(shoe, args.true_count, rng=make_rng(args.rng, args.seed), fast=args.fast_game),
+                  discount=discount, epsilon=epsilon, alpha=alpha)
+    meta = {"algorithms": args.algorithms, "chunk": args.chunk, "rng": args.rng, "decks": args.decks,
+            "penetration": args.penetration if shoe else None,
+            "true_count": list(args.true_count) if args.true_count else None,
+            "discount": discount, "epsilon": epsilon, "alpha": alpha.to_dict()}
+    start = 0
+
+    path = latest_checkpoint(args.checkpoint_dir) if args.resume else None
+    if path:
+        saved = read_header(path)[0]["meta"]
+        # Checkpoints of earlier versions always used the random module and the default
+        # learning parameters
+        saved.setdefault("rng", "legacy")
+        for key, value in (("discount", DISCOUNT), ("epsilon", EPSILON), ("alpha", ALPHA.to_dict())):
+            saved.setdefault(key, value)
+        changed = ["--" + key.replace("_", "-") for key in meta if saved.get(key) != meta[key]]
+        if changed:
+            raise SystemExit(f"{path} was trained with different {', '.join(changed)}; resume with the same options")
+        restore(agent, path)
+        start = saved["episode"]
+        print(f"Resuming from {path} at episode {start}")
+
+    monitor = None
+    if args.until_converged or args.metrics:
+        monitor_state = saved.get("monitor") if path else None
+        if path and monitor_state is None:
+            print(f"{path} has no convergence monitor state; convergence is measured from episode {start}")
+        try:
+            monitor = ConvergenceMonitor(args.algorithms, args.window, args.tolerance, args.stderr_tolerance,
+                                         args.max_flips, args.patience if args.until_converged else float("inf"),
+                                         args.min_share, args.metrics, monitor_state)
+        except ValueError as e:
+            raise SystemExit(f"{path}: {e}; resume with the same options")
+
+    dumper = profiler = None
+    if args.stats:
+        from instrument import StatsDumper
+        dumper = StatsDumper(agent.enable_stats(), args.stats, args.stats_every)
+    if args.profile:
+        from instrument import SamplingProfiler
+        profiler = SamplingProfiler(args.profile_interval, args.profile_seconds)
+        profiler.start()
+
+    checkpointer = Checkpointer(args.checkpoint_dir, args.checkpoint_episodes, args.checkpoint_seconds, args.keep, start)
+    episode = start
+    try:
+        episode = train(agent, args.algorithms, args.episodes, start, args.chunk, checkpointer, meta,
+                        args.seconds, args.report_every, monitor, dumper)
+        checkpointer.save(agent, episode, checkpoint_meta(meta, monitor))
+    finally:
+        checkpointer.close()
+        if profiler:
+            profiler.stop()
+            profiler.write(args.profile)
+        if dumper:
+            dumper.dump(episode)
+            print(agent.stats.report())
+
+    if args.output:
+        agent.save(args.output)
+    return agent
+
+
+if __name__ == '__main__':
+    run(build_parser().parse_args())
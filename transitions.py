@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+
+from game import Game, state_index, cards, ranks, get_amt, WIN_STATE, LOSE_STATE
+from rules import DEFAULT_RULES
+
+'''
+    Precomputed transitions of the Game without true-count states, for Game(fast=True).
+
+    A hit only depends on the state, the rank drawn and whether the dealer's two cards make 21
+    (then a user 21 loses), so TransitionTable.hit[dealer_21, state index, rank] is the index of
+    the next state, and -1 for the terminal states that can't be hit. The deal is looked up the
+    same way from the user's first card: deal[dealer_21, first value, dealer_first, rank] is the
+    index of the state after the user's second card. A stand is played out card by card as
+    before, so that the same cards are drawn, but whether the dealer stops is looked up in
+    TransitionTable.stops[user total, dealer sum, dealer has an Ace] instead of being worked
+    out from the rules on every card.
+
+    Tables are built on first use for each RuleSet, cached in memory by its hash, and saved to
+    CACHE_DIR (the BLACKJACK_CACHE_DIR environment variable, by default ~/.cache/blackjack) so
+    that later processes load them instead of building them again.
+'''
+VERSION = 2
+CACHE_DIR = os.environ.get("BLACKJACK_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "blackjack"))
+MAX_DEALER_SUM = 32     # Larger than any dealer sum, with Aces as 1, the dealer can draw to
+
+# Value and rank of each card, by index into game.cards
+CARD_VALUES = [get_amt(card) for card in cards]
+CARD_RANKS = [ranks.index(rank) for rank, _ in cards]
+
+
+class TransitionTable:
+    def __init__(self, rules=DEFAULT_RULES):
+        self.rules = rules
+        self.hit = np.full((2, len(state_index), len(ranks)), -1, dtype=np.int16)
+        for i, state in enumerate(state_index.states):
+            if state[0] < 2:
+                continue
+            for r, rank in enumerate(ranks):
+                for dealer_21 in (0, 1):
+                    self.hit[dealer_21, i, r] = state_index.encode(self.__hit(state, get_amt((rank, None)), dealer_21))
+
+        self.deal = np.full((2, 11, 11, len(ranks)), -1, dtype=np.int16)
+        for first in range(1, 11):
+            for dealer_first in range(1, 11):
+                for r, rank in enumerate(ranks):
+                    for dealer_21 in (0, 1):
+                        # A one-card hand, with an Ace counted as 11
+                        state = first, int(first == 1), dealer_first
+                        self.deal[dealer_21, first, dealer_first, r] = \
+                            state_index.encode(self.__hit(state, get_amt((rank, None)), dealer_21))
+
+        self.stops = np.zeros((22, MAX_DEALER_SUM, 2), dtype=bool)
+        for user_total in range(22):
+            for dealer_sum in range(MAX_DEALER_SUM):
+                for dealer_A in (0, 1):
+                    actual, A_active = Game.calculate_hand(dealer_sum, dealer_A)
+                    self.stops[user_total, dealer_sum, dealer_A] = \
+                        actual >= 21 or rules.dealer_stands(actual, A_active, user_total)
+
+    @staticmethod
+    def __hit(state, value, dealer_21):
+        # The state after drawing a card of value, following Game.make_state
+        user_sum, user_A_active, dealer_first = state
+        # An Ace can only count as 11 if the sum is at most 11, and then user_A_active tells
+        # whether the hand has one
+        user_sum += value
+        actual, A_active = Game.calculate_hand(user_sum, int(user_A_active or value == 1))
+        if actual == 21:
+            return LOSE_STATE if dealer_21 else WIN_STATE
+        if actual > 21:
+            return LOSE_STATE
+        return user_sum, A_active, dealer_first
+
+    def arrays(self):
+        return {"hit": self.hit, "deal": self.deal, "stops": self.stops}
+
+    def save(self, filename):
+        np.savez(filename, version=VERSION, **self.arrays())
+
+    @staticmethod
+    def load(filename, rules=DEFAULT_RULES):
+        # The table saved in filename, or None if it isn't one of this version
+        table = TransitionTable.__new__(TransitionTable)
+        table.rules = rules
+        with np.load(filename) as data:
+            if int(data["version"]) != VERSION:
+                return None
+            table.hit, table.deal, table.stops = data["hit"], data["deal"], data["stops"]
+        if table.hit.shape != (2, len(state_index), len(ranks)) or table.deal.shape != (2, 11, 11, len(ranks)) \
+                or table.stops.shape != (22, MAX_DEALER_SUM, 2):
+            return None
+        return table
+
+
+_tables = {}
+
+
+def transition_table(rules=DEFAULT_RULES, cache_dir=CACHE_DIR):
+    # The TransitionTable of rules: from memory, from cache_dir, or built and saved there
+    key = rules.hash()
+    if key in _tables:
+        return _tables[key]
+    table = None
+    path = os.path.join(cache_dir, f"transitions-{key}.npz") if cache_dir else None
+    if path and os.path.exists(path):
+        try:
+            table = TransitionTable.load(path, rules)
+        except (OSError, ValueError, KeyError):
+            table = None
+    if table is None:
+        table = TransitionTable(rules)
+        if path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                # Write to a temporary file first, so other processes never see half a table
+                tmp = f"{path}.{os.getpid()}.tmp.npz"
+                table.save(tmp)
+                os.replace(tmp, path)
+            except OSError:
+                pass
+    _tables[key] = table
+    return table